@@ -9,8 +9,15 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 
 import os
 
+from django.core.signals import request_started
 from django.core.asgi import get_asgi_application
 
+from data_bridge_app.render_pool import start_render_pool
+
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "cci_data_bridge.settings")
 
 application = get_asgi_application()
+
+# start the pool that renders the Sankey images with the first request in each worker
+# process, see data_bridge_app/render_pool.py
+request_started.connect(start_render_pool)
@@ -0,0 +1,92 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from data_bridge_app.models import Dataset
+from data_bridge_app.views import get_queryset
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the time taken to find datasets with an exact set of filters using "
+        "the filter signature and using the previous loop over every dataset."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sets",
+            type=int,
+            default=50,
+            help="The number of different filter sets to look up",
+        )
+
+    def handle(self, **options):
+        filter_sets = _get_filter_sets(options["sets"])
+        if len(filter_sets) == 0:
+            print("No datasets with filters found")
+            return
+
+        start = time.perf_counter()
+        legacy_results = [_legacy_match(filters) for filters in filter_sets]
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = [set(get_queryset(filters=filters)) for filters in filter_sets]
+        signature_time = time.perf_counter() - start
+
+        differences = 0
+        for legacy_result, result in zip(legacy_results, results):
+            if legacy_result != result:
+                differences += 1
+
+        print(f"Filter sets: {len(filter_sets)}")
+        print(f"Loop:        {legacy_time:.3f}s")
+        print(f"Signature:   {signature_time:.3f}s")
+        if signature_time > 0:
+            print(f"Speed up:    {legacy_time / signature_time:.1f}x")
+        # the loop only keeps one value per filter name, so it can not match a
+        # dataset with more than one value for the same filter name
+        print(f"Filter sets with different results: {differences}")
+
+
+def _get_filter_sets(count):
+    filter_sets = []
+    for dataset in Dataset.objects.filter(filters__isnull=False).distinct():
+        filters = ",".join(str(filter_) for filter_ in dataset.filters.all())
+        if filters not in filter_sets:
+            filter_sets.append(filters)
+        if len(filter_sets) == count:
+            break
+    return filter_sets
+
+
+def _legacy_match(filters):
+    # the exact set matching used before the filter signature was added
+    datasets = Dataset.objects.all().order_by("url")
+    filters = filters.split(",")
+    filter_count = len(filters)
+
+    datasets_to_exclude = []
+    for dataset in datasets:
+        if len(dataset.filters.all()) != filter_count:
+            datasets_to_exclude.append(dataset.id)
+
+    for exclude in datasets_to_exclude:
+        datasets = datasets.exclude(id=exclude)
+
+    filter_dict = {}
+    for filter_ in filters:
+        name, value = filter_.split("=")
+        filter_dict[name] = value
+
+    datasets_to_exclude = []
+    for dataset in datasets:
+        for dataset_filter in dataset.filters.all():
+            if filter_dict.get(dataset_filter.name) != dataset_filter.value:
+                datasets_to_exclude.append(dataset.id)
+                break
+
+    for exclude in datasets_to_exclude:
+        datasets = datasets.exclude(id=exclude)
+
+    return set(datasets)
@@ -0,0 +1,35 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from data_bridge_app.compiled import compile_catalogue
+from data_bridge_app.models import get_catalogue_version
+
+
+class Command(BaseCommand):
+    help = (
+        "Compile the catalogue into a file that the web workers map into memory, "
+        "see data_bridge_app/compiled.py. This is run by import_spreadsheet when "
+        "CATALOGUE_FILE is set."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output",
+            type=str,
+            default=None,
+            help="The file to write, by default the CATALOGUE_FILE setting",
+        )
+
+    def handle(self, **options):
+        path = options["output"] or getattr(settings, "CATALOGUE_FILE", None)
+        if not path:
+            raise CommandError("No --output given and CATALOGUE_FILE is not set")
+
+        version = get_catalogue_version()
+        compile_catalogue(path, version)
+        print(
+            f"Compiled catalogue version {version} to {path}, "
+            f"{os.path.getsize(path)} bytes"
+        )
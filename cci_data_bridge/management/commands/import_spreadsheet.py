@@ -1,13 +1,39 @@
-from django.core.management.base import BaseCommand
+import csv
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
 from openpyxl import load_workbook
 
-from data_bridge_app.models import (
-    Dataset,
-    ECV,
-    Filter,
-    Project,
-    RelationType,
-    Relationship,
+from data_bridge_app.importer import (
+    ImportCatalogue,
+    ImportRows,
+    MappingRow,
+    update_catalogue,
+    write_catalogue,
+)
+from data_bridge_app.models import get_catalogue_source_hash
+from data_bridge_app.sources import (
+    SourceError,
+    fetch_source,
+    get_file_hash,
+    is_url,
+)
+from data_bridge_app.staging import (
+    StagingError,
+    create_staging_database,
+    discard_staging_database,
+    switch_database,
+    validate_database,
 )
 
 ID_1 = 0
@@ -24,270 +50,382 @@ PROVIDER_2 = 10
 ECV_2 = 11
 DESCRIPTION = 12
 
-def get_from_github():
-    import requests
-
-    print('Downloading from source')
-    link = 'https://github.com/cedadev/cci_data_bridge_inputs/raw/8d450b0cbd470a1555ee1d0dbbc68b0874c9f2f1/EEE2000-metadata_mapping.xlsx'
-
-    resp = requests.get(link)
-    with open('/tmp/testfile.xlsx','wb') as f:
-        f.write(resp.content)
+# the names of the columns of the mapping in the CSV, JSON and NDJSON formats, in the
+# order of the columns of the "Mapping" sheet
+COLUMNS = [
+    "id_1",
+    "start_date_1",
+    "end_date_1",
+    "filters_1",
+    "provider_1",
+    "ecvs_1",
+    "relationship_1",
+    "relationship_2",
+    "id_2",
+    "filters_2",
+    "provider_2",
+    "ecvs_2",
+    "description",
+]
+
+# the formats, by file extension
+FORMATS = {
+    ".xlsx": "xlsx",
+    ".csv": "csv",
+    ".json": "json",
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+}
+
+# the providers, with the slug and aliases of the project they belong to
+PROVIDERS = {
+    "C3S Climate Data Store": ("c3s", ""),
+    "CCI Open Data Portal": ("cci", "esa-cci"),
+    "CCI Archive on CEDA": ("cci", "esa-cci"),
+    "OSI SAF": ("osi", "osi-saf"),
+    "CM SAF": ("cm", "cm-saf"),
+}
+
+
+def get_source(source):
+    # get the path and hash of the workbook, downloading it if it is a URL
+    if not source:
+        source = getattr(settings, "IMPORT_SOURCE_URL", None)
+        if not source:
+            raise CommandError("No workbook given and IMPORT_SOURCE_URL is not set")
+    if not is_url(source):
+        return source, get_file_hash(source)
+
+    print(f"Downloading from {source}")
+    try:
+        return fetch_source(source)
+    except SourceError as ex:
+        raise CommandError(str(ex)) from ex
 
-    return '/tmp/testfile.xlsx'
 
 class Command(BaseCommand):
-    def add_arguments(self, parser):
-        parser.add_argument("excel_wb", type=str, help="The excel workbook to import", default=None,nargs="?")
-
-    def handle(self, **options):
-        print("Import data from spreadsheet")
-        excel_wb = options.get("excel_wb")
-        if not excel_wb:
-            excel_wb = get_from_github()
-        _clean()
-        w_book = load_workbook(filename=excel_wb)
-        related_types = _write_related_types(w_book)
-        w_sheet = w_book.get_sheet_by_name("Mapping")
-        providers = _write_providers()
-        ecvs = _write_ecvs(w_sheet)
-        filters = _write_filters(w_sheet)
-        _write_datasets(w_sheet, ecvs, filters, providers, related_types)
-        print("Database updated")
-
-
-def _clean():
-    Dataset.objects.all().delete()
-    ECV.objects.all().delete()
-    Filter.objects.all().delete()
-    Project.objects.all().delete()
-    RelationType.objects.all().delete()
-    Relationship.objects.all().delete()
-
-
-def _write_related_types(w_book):
-    w_sheet = w_book.get_sheet_by_name("Relationship definitions")
-    related_types = {}
-    for row in w_sheet.iter_rows(min_row=4, max_col=4, max_row=w_sheet.max_row):
-        name = row[0].value
-        description = row[1].value
-        if description is None:
-            description = ""
-        related_types[name] = RelationType.objects.create(
-            name=name, description=description
-        )
-
-    return related_types
-
-
-def _write_providers():
-    providers = {}
-    providers["C3S Climate Data Store"] = Project.objects.create(
-        name="C3S Climate Data Store"
-    )
-    providers["CCI Open Data Portal"] = Project.objects.create(
-        name="CCI Open Data Portal"
-    )
-    providers["CCI Archive on CEDA"] = Project.objects.create(
-        name="CCI Archive on CEDA"
+    help = (
+        "Import the catalogue from a mapping. The mapping is an Excel workbook, or a "
+        "CSV, JSON or NDJSON file. In these formats each record is a row of the "
+        "mapping, with the columns named as in COLUMNS, or defines a relation type, "
+        "with 'relation_type' and 'description'. A CSV file has a header row, a JSON "
+        "file is a list of records and an NDJSON file has a record per line. Values "
+        "with several parts, such as the filters, may be given as lists in JSON. "
+        "Several sources may be given, they are read in parallel and merged, with "
+        "the datasets merged by URL and filters."
     )
-    providers["OSI SAF"] = Project.objects.create(
-        name="OSI SAF"
-    )
-    providers["CM SAF"] = Project.objects.create(
-        name="CM SAF"
-    )
-    return providers
-
-
-def _write_ecvs(w_sheet):
-    ecvs_from_ws = _get_ecvs(w_sheet)
-    ecvs = {}
-    for ecv in ecvs_from_ws:
-        ecvs[ecv] = ECV.objects.create(name=ecv)
-
-    return ecvs
-
-
-def _get_ecvs(w_sheet):
-    ecvs = set()
-    for row in w_sheet.iter_rows(min_row=3, max_col=12, max_row=w_sheet.max_row):
-        value = row[ECV_1].value
-        if value is not None:
-            ecvs.update(_get_values(value))
-        value = row[ECV_2].value
-        if value is not None:
-            ecvs.update(_get_values(value))
-    return ecvs
-
-
-def _write_filters(w_sheet):
-    filters_from_ws = _get_filters(w_sheet)
-    filters = {}
-    for filter_ in filters_from_ws:
-        bits = filter_.split("=")
-        filters[filter_] = Filter.objects.create(name=bits[0], value=bits[1])
-
-    return filters
-
-
-def _get_filters(w_sheet):
-    filters = set()
-    for row in w_sheet.iter_rows(min_row=3, max_col=12, max_row=w_sheet.max_row):
-        value = row[FILTER_1].value
-        if value is not None:
-            filters.update(_get_values(value))
-        value = row[FILTER_2].value
-        if value is not None:
-            filters.update(_get_values(value, "drs="))
-    return filters
-
-
-def _write_datasets(w_sheet, ecvs, filters, providers, related_types):
-    for row in w_sheet.iter_rows(min_row=3, max_col=13, max_row=w_sheet.max_row):
-        if row[ID_1].value is None:
-            continue
 
-        # create primary dataset
-        ds_1 = Dataset.objects.create(
-            url=row[ID_1].value,
-            dataset_provider=providers[row[PROVIDER_1].value],
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "sources",
+            type=str,
+            help="The mappings to import, files or URLs, by default "
+            "IMPORT_SOURCE_URL",
+            nargs="*",
         )
-
-        # add start date
-        if row[START_DATE_1].value is not None:
-            ds_1.start_date = str(row[START_DATE_1].value).split(" ")[0]
-            ds_1.start_date = row[START_DATE_1].value
-            ds_1.save()
-
-        # add end date
-        if row[END_DATE_1].value is not None:
-            ds_1.end_date = row[END_DATE_1].value
-            #print(x, ds_1.end_date)
-            ds_1.save()
-
-        # add ECVs
-        if row[ECV_1].value is not None:
-            for ecv in _get_values(row[ECV_1].value):
-                ds_1.ecvs.add(ecvs[ecv])
-
-        # add filters
-        for filter_ in _get_values(row[FILTER_1].value):
-            ds_1.filters.add(filters[filter_])
-
-        if row[ID_2].value is None:
-            continue
-
-        # check if secondary dataset exists
-        matching_datasets = _get_existing_ds(
-            row[ID_2].value, _get_values(row[FILTER_2].value, "drs=")
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=None,
+            help="The number of processes to read the sources with, by default one "
+            "per source up to the number of CPUs",
         )
-        if len(matching_datasets.all()) == 1:
-            ds_2 = matching_datasets[0]
+        parser.add_argument(
+            "--format",
+            choices=sorted(set(FORMATS.values())),
+            default=None,
+            help="The format of the mapping, by default from the file extension",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Import the workbook even if it is the one the catalogue was last "
+            "imported from",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Only add, update and delete the datasets, etc. that have changed, "
+            "rather than replacing the whole catalogue",
+        )
+        parser.add_argument(
+            "--staging",
+            action="store_true",
+            help="Import into a copy of the database, validate it and then switch to "
+            "it, keeping the live database for rollback_import. SQLite only",
+        )
+
+    def handle(self, **options):
+        print("Import data from spreadsheet")
+        sources = [get_source(source) for source in options["sources"] or [None]]
+        if len(sources) == 1:
+            source_hash = sources[0][1]
         else:
-            # create secondary dataset
-            ds_2 = Dataset.objects.create(
-                url=row[ID_2].value,
-                dataset_provider=providers[row[PROVIDER_2].value],
-                start_date="2015-01-01",  # TODO
-                end_date="2023-01-01",  # TODO
+            source_hash = hashlib.sha256(
+                "\n".join(sha256 for _, sha256 in sources).encode()
+            ).hexdigest()
+        if not options["force"] and source_hash == get_catalogue_source_hash():
+            print(
+                "The workbook has not changed since the last import, use --force to "
+                "import it again"
             )
-
-        # add ECVs
-        if row[ECV_2].value is not None:
-            for ecv in _get_values(row[ECV_2].value):
-                ds_2.ecvs.add(ecvs[ecv])
-
-        # add filters
-        for filter_ in _get_values(row[FILTER_2].value, "drs="):
-            ds_2.filters.add(filters[f"{filter_}"])
-
-        # add relationships
-        relationship_types = []
-        for relationship in _get_values(row[RELATIONSHIP_1].value):
-            if "/" in relationship:
-                # not sure of relationship to use, ignore for now
-                print(f"Found '/' in {relationship}, ignoring")
-                continue
-            relationship_types.append(related_types[relationship])
-
-        if len(relationship_types) > 0:
-            description = row[DESCRIPTION].value
-            if description is None:
-                description = ""
-            rel = Relationship.objects.create(
-                from_dataset=ds_1,
-                # relationships=relationship_types,
-                to_dataset=ds_2,
-                description=description,
+            return
+        start = time.monotonic()
+        paths = [path for path, _ in sources]
+        if len(paths) == 1:
+            catalogue = read_catalogue(paths[0], options["format"])
+        else:
+            catalogue = read_catalogues(
+                paths, options["sources"], options["format"], options["jobs"]
             )
-            for relationship_type in relationship_types:
-                rel.relationships.add(relationship_type)
-
-        if row[RELATIONSHIP_2].value is None:
-            # no relationships yet
+        rows = catalogue.rows
+
+        using = DEFAULT_DB_ALIAS
+        if options["staging"]:
+            try:
+                using = create_staging_database()
+            except StagingError as ex:
+                raise CommandError(str(ex)) from ex
+        switched = False
+        try:
+            if options["incremental"]:
+                changes = update_catalogue(catalogue, using, source_hash)
+                version = changes.version
+            else:
+                version = write_catalogue(catalogue, using, source_hash)
+            elapsed = time.monotonic() - start
+            print(
+                f"Imported {rows} rows, {len(catalogue.datasets)} datasets and "
+                f"{len(catalogue.relationships)} relationships in {elapsed:.1f}s, "
+                f"{rows / elapsed:.0f} rows per second"
+            )
+            if options["incremental"]:
+                for line in changes.get_summary():
+                    print(f"  {line}")
+            if version is None:
+                print("No changes, the catalogue version is unchanged")
+                return
+
+            if options["staging"]:
+                problems = validate_database(using)
+                if len(problems) > 0:
+                    raise CommandError(
+                        "The new catalogue is not valid, the live database is "
+                        f"unchanged: {'; '.join(problems)}"
+                    )
+                switch_database()
+                switched = True
+                print("Switched to the new database, see rollback_import to undo")
+        finally:
+            if options["staging"] and not switched:
+                discard_staging_database()
+
+        print(f"Database updated, catalogue version {version.id}")
+        update_catalogue_caches()
+
+
+def update_catalogue_caches():
+    # bring the caches up to date with a new catalogue version
+    if getattr(settings, "CATALOGUE_FILE", None):
+        call_command("compile_catalogue")
+    sankey_cache = caches[getattr(settings, "SANKEY_CACHE", "default")]
+    if not isinstance(sankey_cache, LocMemCache):
+        # a local memory cache is not shared with the web workers
+        call_command("warm_sankey_cache")
+
+
+def read_catalogue(path, format_=None):
+    # read the mapping in a single pass, the rows are not kept in memory
+    catalogue = ImportCatalogue()
+    _read_providers(catalogue)
+    _read_source(path, format_, catalogue)
+    return catalogue
+
+
+def read_catalogues(paths, names, format_=None, jobs=None):
+    # read the mappings in parallel, each in its own process, and merge them in order
+    if jobs is None:
+        jobs = min(len(paths), os.cpu_count() or 1)
+    catalogue = ImportCatalogue()
+    _read_providers(catalogue)
+    conflicts = 0
+    with ProcessPoolExecutor(max_workers=jobs, initializer=django.setup) as executor:
+        results = executor.map(read_rows, paths, [format_] * len(paths))
+        for path, name, rows in zip(paths, names, results):
+            source = ImportCatalogue()
+            _read_providers(source)
+            rows.add_to(source)
+            print(f"Read {source.rows} rows from {name or path}")
+            for conflict in catalogue.merge(source, name or path):
+                print(f"Conflict: {conflict}")
+                conflicts += 1
+    if conflicts > 0:
+        print(f"{conflicts} conflicts, the metadata was kept from the earlier sources")
+    return catalogue
+
+
+def read_rows(path, format_=None):
+    # read the mapping into rows, to be passed back from a worker process
+    rows = ImportRows()
+    _read_source(path, format_, rows)
+    return rows
+
+
+def _read_source(path, format_, target):
+    if format_ is None:
+        format_ = FORMATS.get(os.path.splitext(path)[1].lower(), "xlsx")
+    if format_ == "xlsx":
+        _read_workbook(path, target)
+    else:
+        with open(path, encoding="utf-8-sig", newline="") as file_:
+            if format_ == "csv":
+                records = csv.DictReader(file_)
+            elif format_ == "json":
+                records = _read_json(file_)
+            else:
+                records = _read_ndjson(file_)
+            _read_records(records, target)
+
+
+def _read_workbook(path, catalogue):
+    w_book = load_workbook(filename=path, read_only=True)
+    try:
+        _read_related_types(w_book["Relationship definitions"], catalogue)
+        for row in _read_mapping(w_book["Mapping"]):
+            catalogue.add_row(row)
+    finally:
+        # a read only workbook keeps the file open
+        w_book.close()
+
+
+def _read_json(file_):
+    try:
+        records = json.load(file_)
+    except ValueError as ex:
+        raise CommandError(f"The file is not valid JSON: {ex}") from ex
+    if not isinstance(records, list):
+        raise CommandError("The JSON must be a list of records")
+    return records
+
+
+def _read_ndjson(file_):
+    for number, line in enumerate(file_, 1):
+        if line.strip() == "":
             continue
-
-        relationship_types = []
-        for relationship in _get_values(row[RELATIONSHIP_2].value):
-            if relationship is None:
-                continue
-            if "/" in relationship:
-                print(f"Found '/' in {relationship}, ignoring")
-                continue
-            relationship_types.append(related_types[relationship])
-
-        if len(relationship_types) > 0:
-            description = row[DESCRIPTION].value
-            if description is None:
-                description = ""
-            rel = Relationship.objects.create(
-                from_dataset=ds_2,
-                to_dataset=ds_1,
-                description=description,
+        try:
+            yield json.loads(line)
+        except ValueError as ex:
+            raise CommandError(f"Line {number} is not valid JSON: {ex}") from ex
+
+
+def _read_records(records, catalogue):
+    defined = set()
+    used = {}
+    for number, record in enumerate(records, 1):
+        if not isinstance(record, dict):
+            raise CommandError(
+                f"Record {number} is not an object with a value for each column"
             )
-            for relationship_type in relationship_types:
-                rel.relationships.add(relationship_type)
-
-
-def _get_existing_ds(url, filters):
-    results = Dataset.objects.all()
-
-    # get the datasets for the given url
-    results = results.filter(url=url)
-    if filters is None or filters == "":
-        # return datasets that have no filters
-        return results.filter(filters=None)
-
-    filter_count = len(filters)
+        if record.get("relation_type"):
+            catalogue.add_relation_type(
+                record["relation_type"], record.get("description") or ""
+            )
+            defined.add(record["relation_type"])
+            continue
+        values = []
+        for column in COLUMNS:
+            value = _get_record_value(record.get(column))
+            if value is not None and not isinstance(value, str):
+                raise CommandError(
+                    f"Record {number}: {column} must be text or a list, not {value!r}"
+                )
+            values.append(value)
+        row = _get_row(values)
+        if row.url_1 is not None and row.url_2 is not None:
+            for relation_type in row.relation_types_1 + row.relation_types_2:
+                used[relation_type] = None
+        catalogue.add_row(row)
+
+    # the relation types that are used without being defined
+    for relation_type in used:
+        if relation_type not in defined:
+            catalogue.add_relation_type(relation_type)
+
+
+def _get_record_value(value):
+    # the value of a cell of the "Mapping" sheet that has the same meaning
+    if isinstance(value, list):
+        value = "\n".join(str(item) for item in value)
+    if isinstance(value, str):
+        value = value.replace("\r\n", "\n")
+        if value.strip() == "":
+            return None
+    return value
+
+
+def _read_related_types(w_sheet, catalogue):
+    for name, description in w_sheet.iter_rows(min_row=4, max_col=2, values_only=True):
+        if name is None:
+            continue
+        if description is None:
+            description = ""
+        catalogue.add_relation_type(name, description)
+
+
+def _read_providers(catalogue):
+    for name, (slug, aliases) in PROVIDERS.items():
+        catalogue.add_provider(name, slug, aliases)
+
+
+def _read_mapping(w_sheet):
+    # yield a MappingRow for each row of the "Mapping" sheet
+    for values in w_sheet.iter_rows(min_row=3, max_col=13, values_only=True):
+        yield _get_row(values)
+
+
+def _get_row(values):
+    description = values[DESCRIPTION]
+    if description is None:
+        description = ""
+    return MappingRow(
+        url_1=values[ID_1],
+        provider_1=values[PROVIDER_1],
+        start_date_1=_get_date(values[START_DATE_1]),
+        end_date_1=_get_date(values[END_DATE_1]),
+        ecvs_1=_get_optional_values(values[ECV_1]),
+        filters_1=_get_optional_values(values[FILTER_1]),
+        url_2=values[ID_2],
+        provider_2=values[PROVIDER_2],
+        ecvs_2=_get_optional_values(values[ECV_2]),
+        filters_2=_get_optional_values(values[FILTER_2], "drs="),
+        relation_types_1=_get_relationship_types(values[RELATIONSHIP_1]),
+        relation_types_2=_get_relationship_types(values[RELATIONSHIP_2]),
+        description=description,
+    )
 
-    # first pass remove any results that do not have the same number of filters
-    results_to_exclude = []
-    for result in results:
-        if len(result.filters.all()) != filter_count:
-            results_to_exclude.append(result.id)
 
-    for exclude in results_to_exclude:
-        results = results.exclude(id=exclude)
+def _get_date(value):
+    # a date, or a date and time, as a date or an ISO 8601 string
+    if isinstance(value, str):
+        return value.strip().split(" ")[0].split("T")[0]
+    return value
 
-    # now need to make sure filters match
-    filter_dict = {}
-    for filter_ in filters:
-        name, value = filter_.split("=")
-        filter_dict[name] = value
 
-    results_to_exclude = []
-    for result in results:
-        for dataset_filter in result.filters.all():
-            if filter_dict.get(dataset_filter.name) != dataset_filter.value:
-                results_to_exclude.append(result.id)
-                # no need to check the rest of the filters
-                break
+def _get_relationship_types(value):
+    relationship_types = []
+    for relationship in _get_optional_values(value):
+        if "/" in relationship:
+            # not sure of relationship to use, ignore for now
+            print(f"Found '/' in {relationship}, ignoring")
+            continue
+        relationship_types.append(relationship)
+    return relationship_types
 
-    for exclude in results_to_exclude:
-        results = results.exclude(id=exclude)
 
-    return results
+def _get_optional_values(value, prefix=""):
+    if value is None:
+        return []
+    return _get_values(value, prefix)
 
 
 def _get_values(value, prefix=""):
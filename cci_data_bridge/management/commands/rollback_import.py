@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cci_data_bridge.management.commands.import_spreadsheet import (
+    update_catalogue_caches,
+)
+from data_bridge_app.staging import StagingError, rollback_database
+
+
+class Command(BaseCommand):
+    help = (
+        "Switch back to the database from before the last import_spreadsheet "
+        "--staging, see data_bridge_app/staging.py."
+    )
+
+    def handle(self, **options):
+        try:
+            version = rollback_database()
+        except StagingError as ex:
+            raise CommandError(str(ex)) from ex
+        print(f"Rolled back to the previous database, catalogue version {version.id}")
+        update_catalogue_caches()
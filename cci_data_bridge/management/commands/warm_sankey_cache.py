@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from data_bridge_app.cache import get_project_sankey, get_sankey_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the Sankey diagram for every project, provider and ECV, and store it "
+        "in the SANKEY_CACHE for the current catalogue version. This is run by "
+        "import_spreadsheet when the cache can be shared with the web workers."
+    )
+
+    def handle(self, **options):
+        start = time.monotonic()
+        sankey_index = get_sankey_index()
+        projects = sankey_index.get_all()
+        for project in projects:
+            get_project_sankey(sankey_index, project).get_spec()
+        print(
+            f"Cached {len(projects)} Sankey diagrams in "
+            f"{time.monotonic() - start:.1f}s"
+        )
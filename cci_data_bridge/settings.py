@@ -144,6 +144,80 @@ LOGGING = {
     },
 }
 
+# Caches
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# The "sankey" cache holds the rendered Sankey diagrams, see data_bridge_app/cache.py.
+# The local memory cache evicts the least recently used entries once it holds
+# MAX_ENTRIES. To share the cache between the worker processes use:
+#     "BACKEND": "data_bridge_app.cache.LRUFileBasedCache",
+#     "LOCATION": "/var/tmp/cci_data_bridge_sankey",
+# A shared cache is filled with the diagram for every project, provider and ECV after
+# each import, see the warm_sankey_cache command.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "sankey": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "sankey",
+        "TIMEOUT": None,
+        "OPTIONS": {"MAX_ENTRIES": 100},
+    },
+}
+SANKEY_CACHE = "sankey"
+
+# Sankey level of detail
+# A Sankey diagram with more links than this is simplified, first by leaving out the
+# filters, then by grouping the datasets by provider and ECV, see
+# data_bridge_app/sankey.py.
+SANKEY_MAX_LINKS = 200
+
+# plotly.js
+# The URL of the plotly.js bundle used to draw the Sankey diagrams, for example on a
+# CDN. By default the bundle that comes with plotly is served from a versioned URL.
+PLOTLY_JS_URL = None
+
+# Sankey image renderer
+# "plotly" renders the Sankey images with plotly and the kaleido image engine, in the
+# render pool. "native" lays out and draws them in Python, see
+# data_bridge_app/sankey_image.py, which needs Pillow, version 8.0.0 or later, for PNG
+# and JPEG. Pillow is not installed with the other dependencies, see README.md. Either
+# can be asked for with "renderer=" on the image URLs.
+SANKEY_IMAGE_RENDERER = "plotly"
+
+# Render pool
+# The number of processes each web worker starts, with its first request, to render
+# the Sankey images, the number of images that may wait for a process and the timeout
+# in seconds, see data_bridge_app/render_pool.py. Set RENDER_POOL_WORKERS to 0 to
+# render the images in the web worker.
+RENDER_POOL_WORKERS = 2
+RENDER_POOL_QUEUE = 8
+RENDER_POOL_TIMEOUT = 30
+
+# Catalogue snapshot
+# Serve the read views from an in-process snapshot of the catalogue, see
+# data_bridge_app/snapshot.py. The catalogue version is checked for a new import every
+# CATALOGUE_SNAPSHOT_CHECK_INTERVAL seconds.
+CATALOGUE_SNAPSHOT = False
+CATALOGUE_SNAPSHOT_CHECK_INTERVAL = 10
+
+# Compiled catalogue
+# The file the catalogue is compiled into after each import, which the web workers
+# map into memory, see data_bridge_app/compiled.py. None to not use a compiled file.
+CATALOGUE_FILE = None
+
+# Import source
+# The workbook that import_spreadsheet imports when it is not given one, and the
+# directory the downloaded workbooks are kept in, by default "import_cache" in
+# BASE_DIR, see data_bridge_app/sources.py. The directory must only be writable by the
+# user that runs the import. A workbook is only downloaded again if it has changed, and
+# is not imported again if the catalogue was imported from it.
+IMPORT_SOURCE_URL = (
+    "https://github.com/cedadev/cci_data_bridge_inputs/raw/"
+    "8d450b0cbd470a1555ee1d0dbbc68b0874c9f2f1/EEE2000-metadata_mapping.xlsx"
+)
+IMPORT_CACHE_DIR = None
+
 try:
     # pylint: disable=wildcard-import, unused-wildcard-import
     from cci_data_bridge.local_settings import *
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class DataBridgeAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'data_bridge_app'
+
+    def ready(self):
+        # pylint: disable=import-outside-toplevel, unused-import
+        from data_bridge_app import signals
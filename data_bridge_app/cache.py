@@ -0,0 +1,238 @@
+"""
+Cache
+
+The Sankey figures, as the JSON spec that plotly.js draws in the browser, and the
+images rendered from them, only change when the catalogue is imported, so they are
+kept in a Django cache, see the SANKEY_CACHE setting.
+
+Each entry is keyed by the view, the project or URL and the format, and is stored
+under the catalogue version using the cache's own key versioning. After an import
+the entries for the old version are never read again, and they are evicted as the
+cache fills up.
+
+The "SankeyIndex", which maps the slugs in /sankey/<slug> to the datasets, is cached
+in the same way, so with a warm cache a diagram for a slug is served from the cache
+alone. The index for the current version is also kept in each process, so it is not
+read from the cache, and its URLs not rebuilt, on every request. The
+warm_sankey_cache command, which is run after each import, fills the cache with the
+diagram for every project, provider and ECV.
+
+The local memory cache evicts the least recently used entries when it is full, but
+it is not shared between worker processes, or with the import. "LRUFileBasedCache" is
+a file based cache, which can be shared, that does the same.
+
+"""
+
+import hashlib
+import json
+import os
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.filebased import FileBasedCache
+import plotly.io as pio
+
+from data_bridge_app.compiled import get_compiled_catalogue
+from data_bridge_app.models import get_catalogue_version
+from data_bridge_app.render_pool import render_image
+from data_bridge_app.sankey import SankeyIndex
+from data_bridge_app.sankey_image import render_sankey_image
+
+_MISSING = object()
+
+# the SankeyIndex last used by this process
+_sankey_index = None
+
+
+class CachedSankey:
+    """
+    A Sankey diagram, along with the images rendered from it, cached for the current
+    catalogue version.
+
+    """
+
+    def __init__(self, view, name, diagram, snapshot=None, version=None):
+        """
+        @param view(str): the name of the view
+
+        @param name(str): the project, URL or dataset the diagram is for
+
+        @param diagram(SankeyDiagram): the diagram to use if it is not in the cache
+
+        @param snapshot(CatalogueSnapshot): the snapshot in use, if any
+
+        @param version(int): the catalogue version, if it is already known
+
+        """
+        self.cache = caches[getattr(settings, "SANKEY_CACHE", "default")]
+        self.key_prefix = (
+            f"sankey:{view}:{hashlib.sha256(name.encode('utf-8')).hexdigest()}"
+        )
+        if version is None:
+            version = get_catalogue_cache_version(snapshot)
+        self.version = version
+        self.diagram = diagram
+        self.figure = None
+
+    def get_figure(self):
+        """
+        Get the figure containing the Sankey diagram.
+
+        """
+        if self.figure is None:
+            figure_json = self.get_spec()
+            if self.figure is None:
+                self.figure = pio.from_json(figure_json)
+        return self.figure
+
+    def get_spec(self):
+        """
+        Get the figure containing the Sankey diagram as JSON, with the "data" and
+        "layout" for plotly.js.
+
+        """
+        return self._get_or_set("figure", self._get_figure_json)
+
+    def get_image(self, format_, renderer="plotly"):
+        """
+        Get the Sankey diagram as an image.
+
+        @param format_(str): "png", "svg" or "jpeg"
+
+        @param renderer(str): "plotly" or "native", see data_bridge_app.sankey_image
+
+        @raises RenderError: if the image could not be rendered
+
+        """
+        if renderer == "native":
+            return self._get_or_set(
+                f"native-{format_}",
+                lambda: render_sankey_image(json.loads(self.get_spec()), format_),
+            )
+        return self._get_or_set(
+            format_, lambda: render_image(self.get_figure(), format_)
+        )
+
+    def _get_figure_json(self):
+        self.figure = self.diagram.get_figure()
+        return self.figure.to_json()
+
+    def _get_or_set(self, format_, function):
+        key = f"{self.key_prefix}:{format_}"
+        value = self.cache.get(key, _MISSING, version=self.version)
+        if value is _MISSING:
+            value = function()
+            self.cache.set(key, value, version=self.version)
+        return value
+
+
+def get_sankey_index(snapshot=None):
+    """
+    Get the index of the Sankey diagrams, for the current catalogue version.
+
+    @param snapshot(CatalogueSnapshot): the snapshot in use, if any
+
+    """
+    global _sankey_index  # pylint: disable=global-statement
+
+    version = get_catalogue_cache_version(snapshot)
+    index = _sankey_index
+    if index is not None and index.version == version:
+        return index
+
+    cache = caches[getattr(settings, "SANKEY_CACHE", "default")]
+    index = cache.get("sankey:index", None, version=version)
+    if index is None:
+        index = SankeyIndex.load(snapshot)
+        index.version = version
+        cache.set("sankey:index", index, version=version)
+    _sankey_index = index
+    return index
+
+
+def get_project_sankey(sankey_index, project, snapshot=None, provider=None, ecv=None):
+    """
+    Get the cached Sankey diagram for a project, provider or ECV from the index.
+
+    @param sankey_index(SankeyIndex): the index the project came from
+
+    @param project(SankeyProject): the project
+
+    @param snapshot(CatalogueSnapshot): the snapshot in use, if any
+
+    @param provider(str): only include the datasets from this provider
+
+    @param ecv(str): only include the datasets for this ECV
+
+    """
+    name = project.slug
+    if provider or ecv:
+        name = f"{name}?{urlencode({'provider': provider or '', 'ecv': ecv or ''})}"
+    return CachedSankey(
+        "project",
+        name,
+        project.get_diagram(snapshot, provider, ecv),
+        snapshot,
+        sankey_index.version,
+    )
+
+
+def get_catalogue_cache_version(snapshot=None):
+    """
+    Get the catalogue version to store cache entries under.
+
+    The version comes from the snapshot or the compiled catalogue when they are in
+    use, so that the cache agrees with the data they serve.
+
+    """
+    if snapshot is not None:
+        return snapshot.version
+
+    compiled = get_compiled_catalogue()
+    if compiled is not None:
+        return compiled.version
+
+    return get_catalogue_version()
+
+
+class LRUFileBasedCache(FileBasedCache):
+    """
+    A file based cache that evicts the least recently used entries, rather than
+    random entries, when it holds MAX_ENTRIES.
+
+    The modification time of a cache file is updated each time the entry is read.
+
+    """
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _MISSING, version)
+        if value is _MISSING:
+            return default
+
+        try:
+            os.utime(self._key_to_file(key, version))
+        except FileNotFoundError:
+            # The file may have been removed by another process.
+            pass
+        return value
+
+    def _cull(self):
+        filelist = self._list_cache_files()
+        num_entries = len(filelist)
+        if num_entries < self._max_entries:
+            return
+        if self._cull_frequency == 0:
+            self.clear()
+            return
+
+        filelist.sort(key=_get_mtime)
+        for fname in filelist[: int(num_entries / self._cull_frequency)]:
+            self._delete(fname)
+
+
+def _get_mtime(fname):
+    try:
+        return os.path.getmtime(fname)
+    except FileNotFoundError:
+        return 0
@@ -0,0 +1,482 @@
+"""
+Compiled catalogue
+
+The catalogue can be compiled into a single binary file, see the "compile_catalogue"
+management command, which each web worker maps into memory read-only. The workers can
+then start serving without touching the database.
+
+Only the graph and path views, see data_bridge_app.graph, use the mapped file in
+place, so all of the workers on a machine share one physical copy of what they read.
+The catalogue snapshot used by the list, detail and Sankey views, see
+data_bridge_app.snapshot, is loaded from the file rather than the database, but is
+still copied into Python objects in each worker, so its memory grows with the number
+of workers.
+
+The file is made up of a header, a table of sections and the sections themselves.
+Each section is an array of fixed width integers, so it can be used in place through
+a memoryview without being copied or unpacked:
+    - the strings, all of the URLs, names, etc., stored once in a string pool and
+      referred to everywhere else by their index in the pool
+    - the dataset, filter, relation type and relationship (edge) tables, stored as
+      one array per column, each ordered by id
+    - the ECVs, filters and relation types of each dataset or edge, and the
+      outgoing and incoming edges of each dataset, stored as an offsets array and a
+      values array, the values for row "i" are values[offsets[i]:offsets[i + 1]]
+    - the datasets in (url, id) order, for looking up datasets by URL
+
+Datasets and edges are referred to by their index in their table, not their id.
+
+The file is written to a temporary file, flushed to disk and then renamed, so a
+worker that still has the previous file mapped is not affected, and after a crash the
+file is either the previous one or the complete new one. Workers pick up the new file the next time
+they look for it, see get_compiled_catalogue.
+
+Set CATALOGUE_FILE to the path of the file in the settings to use it.
+
+"""
+
+import bisect
+import datetime
+import mmap
+import os
+import struct
+import threading
+from array import array
+
+from django.conf import settings
+
+from data_bridge_app.models import (
+    Dataset,
+    ECV,
+    Filter,
+    RelationType,
+    Relationship,
+    get_catalogue_version,
+)
+
+MAGIC = b"CDBCATLG"
+FORMAT_VERSION = 1
+
+# the index used for a missing string or date
+NONE = -1
+
+# magic, format version, number of sections, catalogue version
+_HEADER = struct.Struct("<8sIIq")
+# name, type code, offset, number of items
+_SECTION = struct.Struct("<32s4sQQ")
+_ALIGNMENT = 8
+
+# the sections, and the type code of their items
+SECTIONS = {
+    "string_offsets": "q",
+    "string_data": "B",
+    "dataset_ids": "q",
+    "dataset_urls": "i",
+    "dataset_providers": "i",
+    "dataset_start_dates": "i",
+    "dataset_end_dates": "i",
+    "dataset_signatures": "i",
+    "dataset_ecv_offsets": "i",
+    "dataset_ecvs": "i",
+    "dataset_filter_offsets": "i",
+    "dataset_filters": "i",
+    "dataset_url_order": "i",
+    "filter_ids": "q",
+    "filter_names": "i",
+    "filter_values": "i",
+    "relation_type_names": "i",
+    "relation_type_descriptions": "i",
+    "edge_ids": "q",
+    "edge_from": "i",
+    "edge_to": "i",
+    "edge_descriptions": "i",
+    "edge_type_offsets": "i",
+    "edge_types": "i",
+    "out_edge_offsets": "i",
+    "out_edges": "i",
+    "in_edge_offsets": "i",
+    "in_edges": "i",
+    "ecv_names": "i",
+}
+
+_lock = threading.Lock()
+_compiled = None
+
+
+class CompiledCatalogueError(Exception):
+    """
+    The file is not a compiled catalogue, or was compiled by a different version.
+
+    """
+
+
+class CompiledCatalogue:
+    """
+    A compiled catalogue file mapped into memory.
+
+    Each section is available as an attribute of the same name.
+
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as file_:
+            self.stat = os.fstat(file_.fileno())
+            self._mmap = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mmap) < _HEADER.size:
+            raise CompiledCatalogueError(f"{path} is not a compiled catalogue")
+        magic, format_version, section_count, self.version = _HEADER.unpack_from(
+            self._mmap
+        )
+        if magic != MAGIC:
+            raise CompiledCatalogueError(f"{path} is not a compiled catalogue")
+        if format_version != FORMAT_VERSION:
+            raise CompiledCatalogueError(
+                f"{path} has format version {format_version}, expected "
+                f"{FORMAT_VERSION}"
+            )
+
+        view = memoryview(self._mmap)
+        for number in range(section_count):
+            name, typecode, offset, count = _SECTION.unpack_from(
+                self._mmap, _HEADER.size + number * _SECTION.size
+            )
+            typecode = typecode.rstrip(b"\0").decode()
+            size = count * array(typecode).itemsize
+            setattr(
+                self,
+                name.rstrip(b"\0").decode(),
+                view[offset : offset + size].cast(typecode),
+            )
+
+    def __len__(self):
+        return len(self.dataset_ids)
+
+    def string(self, index):
+        """
+        Get a string from the string pool.
+
+        @param index(int): the index of the string, or NONE
+
+        """
+        if index == NONE:
+            return None
+        start = self.string_offsets[index]
+        end = self.string_offsets[index + 1]
+        return bytes(self.string_data[start:end]).decode("utf-8")
+
+    def find_dataset(self, dataset_id):
+        """
+        Get the index of a dataset, or None if there is no dataset with the id.
+
+        """
+        index = bisect.bisect_left(self.dataset_ids, dataset_id)
+        if index < len(self.dataset_ids) and self.dataset_ids[index] == dataset_id:
+            return index
+        return None
+
+    def find_url(self, url):
+        """
+        Get the indexes of the datasets with a URL, in id order.
+
+        """
+        order = self.dataset_url_order
+        start = bisect.bisect_left(order, url, key=self.get_url)
+        end = bisect.bisect_right(order, url, lo=start, key=self.get_url)
+        return list(order[start:end])
+
+    def find_edge(self, relationship_id):
+        """
+        Get the index of a relationship, or None if there is no relationship with the
+        id.
+
+        """
+        index = bisect.bisect_left(self.edge_ids, relationship_id)
+        if index < len(self.edge_ids) and self.edge_ids[index] == relationship_id:
+            return index
+        return None
+
+    def get_url(self, index):
+        return self.string(self.dataset_urls[index])
+
+    def get_provider(self, index):
+        return self.string(self.dataset_providers[index])
+
+    def get_start_date(self, index):
+        return _get_date(self.dataset_start_dates[index])
+
+    def get_end_date(self, index):
+        return _get_date(self.dataset_end_dates[index])
+
+    def get_ecvs(self, index):
+        """
+        Get the names of the ECVs for a dataset.
+
+        """
+        return [
+            self.string(ecv)
+            for ecv in _get_range(self.dataset_ecv_offsets, self.dataset_ecvs, index)
+        ]
+
+    def get_filter_indexes(self, index):
+        """
+        Get the indexes of the filters for a dataset.
+
+        """
+        return _get_range(self.dataset_filter_offsets, self.dataset_filters, index)
+
+    def get_type_indexes(self, edge):
+        """
+        Get the indexes of the relation types of an edge, in name order.
+
+        """
+        return _get_range(self.edge_type_offsets, self.edge_types, edge)
+
+    def get_out_edges(self, index):
+        """
+        Get the indexes of the edges from a dataset, in id order.
+
+        """
+        return _get_range(self.out_edge_offsets, self.out_edges, index)
+
+    def get_in_edges(self, index):
+        """
+        Get the indexes of the edges to a dataset, in id order.
+
+        """
+        return _get_range(self.in_edge_offsets, self.in_edges, index)
+
+
+class _Builder:
+    """
+    Collect the sections for a compiled catalogue.
+
+    """
+
+    def __init__(self):
+        self.sections = {name: array(typecode) for name, typecode in SECTIONS.items()}
+        self.strings = {}
+        self.sections["string_offsets"].append(0)
+
+    def add_string(self, value):
+        if value is None:
+            return NONE
+        index = self.strings.get(value)
+        if index is None:
+            index = len(self.strings)
+            self.strings[value] = index
+            self.sections["string_data"].frombytes(value.encode("utf-8"))
+            self.sections["string_offsets"].append(len(self.sections["string_data"]))
+        return index
+
+    def add_ranges(self, offsets_name, values_name, rows):
+        offsets = self.sections[offsets_name]
+        values = self.sections[values_name]
+        offsets.append(0)
+        for row in rows:
+            values.extend(row)
+            offsets.append(len(values))
+
+    def build(self):
+        sections = self.sections
+        datasets = {}
+        for id_, url, provider, start_date, end_date, signature in (
+            Dataset.objects.order_by("id").values_list(
+                "id",
+                "url",
+                "dataset_provider_id",
+                "start_date",
+                "end_date",
+                "filter_signature",
+            )
+        ):
+            datasets[id_] = len(sections["dataset_ids"])
+            sections["dataset_ids"].append(id_)
+            sections["dataset_urls"].append(self.add_string(url))
+            sections["dataset_providers"].append(self.add_string(provider))
+            sections["dataset_start_dates"].append(_get_ordinal(start_date))
+            sections["dataset_end_dates"].append(_get_ordinal(end_date))
+            sections["dataset_signatures"].append(self.add_string(signature))
+
+        ecvs = [[] for _ in datasets]
+        for dataset_id, ecv in Dataset.ecvs.through.objects.order_by(
+            "dataset_id", "ecv_id"
+        ).values_list("dataset_id", "ecv_id"):
+            if dataset_id in datasets:
+                ecvs[datasets[dataset_id]].append(self.add_string(ecv))
+        self.add_ranges("dataset_ecv_offsets", "dataset_ecvs", ecvs)
+
+        filters = {}
+        for id_, name, value in Filter.objects.order_by("id").values_list(
+            "id", "name", "value"
+        ):
+            filters[id_] = len(sections["filter_ids"])
+            sections["filter_ids"].append(id_)
+            sections["filter_names"].append(self.add_string(name))
+            sections["filter_values"].append(self.add_string(value))
+
+        dataset_filters = [[] for _ in datasets]
+        for dataset_id, filter_id in Dataset.filters.through.objects.order_by(
+            "dataset_id", "filter_id"
+        ).values_list("dataset_id", "filter_id"):
+            if dataset_id in datasets and filter_id in filters:
+                dataset_filters[datasets[dataset_id]].append(filters[filter_id])
+        self.add_ranges("dataset_filter_offsets", "dataset_filters", dataset_filters)
+
+        relation_types = {}
+        for name, description in RelationType.objects.order_by("name").values_list(
+            "name", "description"
+        ):
+            relation_types[name] = len(sections["relation_type_names"])
+            sections["relation_type_names"].append(self.add_string(name))
+            sections["relation_type_descriptions"].append(self.add_string(description))
+
+        edge_types = {}
+        through = Relationship.relationships.through
+        for relationship_id, name in through.objects.order_by(
+            "relationship_id", "relationtype_id"
+        ).values_list("relationship_id", "relationtype_id"):
+            if name in relation_types:
+                edge_types.setdefault(relationship_id, []).append(relation_types[name])
+
+        out_edges = [[] for _ in datasets]
+        in_edges = [[] for _ in datasets]
+        types = []
+        for id_, from_id, to_id, description in Relationship.objects.order_by(
+            "id"
+        ).values_list("id", "from_dataset_id", "to_dataset_id", "description"):
+            if from_id not in datasets or to_id not in datasets:
+                # an import is running, the next version will be complete
+                continue
+            edge = len(sections["edge_ids"])
+            sections["edge_ids"].append(id_)
+            sections["edge_from"].append(datasets[from_id])
+            sections["edge_to"].append(datasets[to_id])
+            sections["edge_descriptions"].append(self.add_string(description))
+            types.append(edge_types.get(id_, []))
+            out_edges[datasets[from_id]].append(edge)
+            in_edges[datasets[to_id]].append(edge)
+        self.add_ranges("edge_type_offsets", "edge_types", types)
+        self.add_ranges("out_edge_offsets", "out_edges", out_edges)
+        self.add_ranges("in_edge_offsets", "in_edges", in_edges)
+
+        # the datasets are in id order, and the sort is stable
+        urls = sections["dataset_urls"]
+        strings = list(self.strings)
+        sections["dataset_url_order"].extend(
+            sorted(range(len(datasets)), key=lambda index: strings[urls[index]])
+        )
+
+        for name in ECV.objects.order_by("name").values_list("name", flat=True):
+            sections["ecv_names"].append(self.add_string(name))
+
+        return sections
+
+
+def compile_catalogue(path, version=None):
+    """
+    Compile the catalogue in the database into a file.
+
+    @param path(str): the file to write, it is replaced if it already exists
+
+    @param version(int): the catalogue version, by default the current version
+
+    """
+    if version is None:
+        version = get_catalogue_version()
+    sections = _Builder().build()
+
+    offset = _align(_HEADER.size + len(sections) * _SECTION.size)
+    table = []
+    for name, values in sections.items():
+        table.append((name, values, offset))
+        offset = _align(offset + len(values) * values.itemsize)
+
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as file_:
+        file_.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(sections), version))
+        for name, values, offset in table:
+            file_.write(
+                _SECTION.pack(
+                    name.encode(), values.typecode.encode(), offset, len(values)
+                )
+            )
+        for name, values, offset in table:
+            file_.write(b"\0" * (offset - file_.tell()))
+            values.tofile(file_)
+        # the data must be on disk before the rename is
+        file_.flush()
+        os.fsync(file_.fileno())
+    os.replace(temp_path, path)
+    _fsync_directory(os.path.dirname(os.path.abspath(path)))
+
+
+def get_compiled_catalogue():
+    """
+    Get the compiled catalogue, mapped into memory.
+
+    The file is mapped again if it has been replaced since it was last mapped.
+
+    @return the compiled catalogue, or None if CATALOGUE_FILE is not set or the file
+        does not exist yet
+
+    """
+    global _compiled  # pylint: disable=global-statement
+
+    path = getattr(settings, "CATALOGUE_FILE", None)
+    if not path:
+        return None
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    compiled = _compiled
+    if compiled is not None and _is_same_file(compiled.stat, stat):
+        return compiled
+
+    with _lock:
+        if _compiled is None or not _is_same_file(_compiled.stat, stat):
+            _compiled = CompiledCatalogue(path)
+        return _compiled
+
+
+def _fsync_directory(path):
+    # make the rename durable, not every platform can open a directory
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _is_same_file(stat, other):
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size) == (
+        other.st_ino,
+        other.st_mtime_ns,
+        other.st_size,
+    )
+
+
+def _get_range(offsets, values, index):
+    return values[offsets[index] : offsets[index + 1]]
+
+
+def _get_ordinal(date):
+    if date is None:
+        return NONE
+    return date.toordinal()
+
+
+def _get_date(ordinal):
+    if ordinal == NONE:
+        return None
+    return datetime.date.fromordinal(ordinal)
+
+
+def _align(offset):
+    return offset + (-offset % _ALIGNMENT)
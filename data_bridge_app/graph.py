@@ -0,0 +1,497 @@
+"""
+Graph
+
+The relationships between datasets form a directed graph. "get_subgraph" finds all
+of the datasets that can be reached from a dataset in up to N hops using a recursive
+common table expression, so the whole walk is done by the database in one query
+rather than one query per hop. The SQL works on both SQLite and PostgreSQL.
+
+Cycles are handled by bounding the walk by depth and keeping the minimum depth at
+which each dataset is reached.
+
+"find_shortest_path" finds the shortest chain of relationships between two sets of
+datasets with a breadth first search from both ends, loading the relationships for
+a whole frontier in one query. The search gives up when it runs out of time or has
+visited too many datasets.
+
+If there is a compiled catalogue, see data_bridge_app.compiled, both are answered
+from its outgoing and incoming edge arrays rather than from the database.
+
+"""
+
+import time
+
+from django.db import connection
+from django.db.models import Q
+
+from data_bridge_app.compiled import get_compiled_catalogue
+from data_bridge_app.models import Dataset, Relationship
+
+DEFAULT_GRAPH_DEPTH = 1
+MAX_GRAPH_DEPTH = 10
+
+DEFAULT_PATH_DEPTH = 6
+MAX_PATH_DEPTH = 20
+
+# the search budget for find_shortest_path
+PATH_MAX_VISITS = 20000
+PATH_TIME_LIMIT = 2.0
+
+# maximum number of ids to put in a single "IN" clause
+FRONTIER_BATCH_SIZE = 500
+
+DIRECTIONS = ["out", "in", "both"]
+
+# the edges to follow for each direction, as (source, target) pairs
+_EDGES_SQL = {
+    "out": "SELECT from_dataset_id, to_dataset_id FROM {relationship}",
+    "in": "SELECT to_dataset_id, from_dataset_id FROM {relationship}",
+    "both": (
+        "SELECT from_dataset_id, to_dataset_id FROM {relationship} "
+        "UNION ALL "
+        "SELECT to_dataset_id, from_dataset_id FROM {relationship}"
+    ),
+}
+
+# the condition for including a relationship between two reached datasets
+_EDGE_DEPTH_SQL = {
+    "out": "from_node.depth < %s",
+    "in": "to_node.depth < %s",
+    "both": "(from_node.depth < %s OR to_node.depth < %s)",
+}
+
+_REACHABLE_SQL = """
+WITH RECURSIVE edges(source_id, target_id) AS (
+    {edges}
+),
+reachable(dataset_id, depth) AS (
+    SELECT CAST(%s AS BIGINT), 0
+    UNION
+    SELECT edges.target_id, reachable.depth + 1
+    FROM reachable
+    JOIN edges ON edges.source_id = reachable.dataset_id
+    WHERE reachable.depth < %s
+),
+nodes(dataset_id, depth) AS (
+    SELECT dataset_id, MIN(depth) FROM reachable GROUP BY dataset_id
+)
+"""
+
+_NODES_SQL = (
+    _REACHABLE_SQL
+    + """
+SELECT nodes.dataset_id, dataset.url, dataset.dataset_provider_id, nodes.depth
+FROM nodes
+JOIN {dataset} dataset ON dataset.id = nodes.dataset_id
+ORDER BY nodes.depth, dataset.url, nodes.dataset_id
+"""
+)
+
+_EDGES_AND_TYPES_SQL = (
+    _REACHABLE_SQL
+    + """
+SELECT relationship.id, relationship.from_dataset_id, relationship.to_dataset_id,
+    relation_type.relationtype_id
+FROM {relationship} relationship
+JOIN nodes from_node ON from_node.dataset_id = relationship.from_dataset_id
+JOIN nodes to_node ON to_node.dataset_id = relationship.to_dataset_id
+LEFT JOIN {relation_types} relation_type
+    ON relation_type.relationship_id = relationship.id
+WHERE {edge_depth}
+ORDER BY relationship.id, relation_type.relationtype_id
+"""
+)
+
+
+def get_subgraph(dataset_id, depth=DEFAULT_GRAPH_DEPTH, direction="out"):
+    """
+    Get the datasets, and the relationships between them, that can be reached from
+    a dataset.
+
+    The result is in a compact form:
+        "nodes": a list of [id, url, dataset provider, depth]
+        "edges": a list of [from id, to id, list of indexes into "relation_types"]
+        "relation_types": a list of relation type names
+
+    @param dataset_id(int): the id of the dataset to start from
+
+    @param depth(int): the maximum number of relationships to follow
+
+    @param direction(str): "out" to follow relationships from a dataset to the
+        related dataset, "in" to follow them backwards, "both" for either way
+
+    @raises ValueError: if the depth or direction are not valid
+
+    """
+    if direction not in DIRECTIONS:
+        raise ValueError(f"Invalid direction {direction}")
+    if depth < 0 or depth > MAX_GRAPH_DEPTH:
+        raise ValueError(f"Invalid depth {depth}, must be 0 to {MAX_GRAPH_DEPTH}")
+
+    compiled = get_compiled_catalogue()
+    if compiled is not None:
+        return _get_compiled_subgraph(compiled, dataset_id, depth, direction)
+
+    tables = {
+        "dataset": connection.ops.quote_name(Dataset._meta.db_table),
+        "relationship": connection.ops.quote_name(Relationship._meta.db_table),
+        "relation_types": connection.ops.quote_name(
+            Relationship.relationships.through._meta.db_table
+        ),
+    }
+    edges = _EDGES_SQL[direction].format(**tables)
+    reachable_params = [dataset_id, depth]
+
+    with connection.cursor() as cursor:
+        cursor.execute(_NODES_SQL.format(edges=edges, **tables), reachable_params)
+        nodes = [list(row) for row in cursor.fetchall()]
+
+        edge_depth = _EDGE_DEPTH_SQL[direction]
+        cursor.execute(
+            _EDGES_AND_TYPES_SQL.format(edges=edges, edge_depth=edge_depth, **tables),
+            reachable_params + [depth] * edge_depth.count("%s"),
+        )
+        rows = cursor.fetchall()
+
+    return _get_graph_j_data(nodes, rows)
+
+
+def _get_compiled_subgraph(compiled, dataset_id, depth, direction):
+    start = compiled.find_dataset(dataset_id)
+    if start is None:
+        return _get_graph_j_data([], [])
+
+    # the minimum depth of each dataset reached, by dataset index
+    depths = {start: 0}
+    frontier = [start]
+    for level in range(1, depth + 1):
+        reached = []
+        for index in frontier:
+            for target in _get_compiled_targets(compiled, index, direction):
+                if target not in depths:
+                    depths[target] = level
+                    reached.append(target)
+        frontier = reached
+
+    nodes = sorted(
+        (
+            [
+                compiled.dataset_ids[index],
+                compiled.get_url(index),
+                compiled.get_provider(index),
+                node_depth,
+            ]
+            for index, node_depth in depths.items()
+        ),
+        key=lambda node: (node[3], node[1], node[0]),
+    )
+
+    rows = []
+    edges = sorted(
+        edge
+        for index in depths
+        for edge in compiled.get_out_edges(index)
+        if compiled.edge_to[edge] in depths
+    )
+    for edge in edges:
+        from_depth = depths[compiled.edge_from[edge]]
+        to_depth = depths[compiled.edge_to[edge]]
+        if direction == "out" and from_depth >= depth:
+            continue
+        if direction == "in" and to_depth >= depth:
+            continue
+        if direction == "both" and min(from_depth, to_depth) >= depth:
+            continue
+
+        relationship = (
+            compiled.edge_ids[edge],
+            compiled.dataset_ids[compiled.edge_from[edge]],
+            compiled.dataset_ids[compiled.edge_to[edge]],
+        )
+        types = compiled.get_type_indexes(edge)
+        if len(types) == 0:
+            rows.append(relationship + (None,))
+        for relation_type in types:
+            name = compiled.string(compiled.relation_type_names[relation_type])
+            rows.append(relationship + (name,))
+
+    return _get_graph_j_data(nodes, rows)
+
+
+def _get_compiled_targets(compiled, index, direction):
+    # the indexes of the datasets one relationship away from a dataset
+    if direction in ["out", "both"]:
+        for edge in compiled.get_out_edges(index):
+            yield compiled.edge_to[edge]
+    if direction in ["in", "both"]:
+        for edge in compiled.get_in_edges(index):
+            yield compiled.edge_from[edge]
+
+
+def _get_graph_j_data(nodes, rows):
+    # rows of (relationship id, from id, to id, relation type), in relationship order
+    relation_types = []
+    type_indexes = {}
+    relationships = {}
+    for relationship_id, from_id, to_id, relation_type in rows:
+        edge = relationships.get(relationship_id)
+        if edge is None:
+            edge = [from_id, to_id, []]
+            relationships[relationship_id] = edge
+        if relation_type is None:
+            continue
+        if relation_type not in type_indexes:
+            type_indexes[relation_type] = len(relation_types)
+            relation_types.append(relation_type)
+        edge[2].append(type_indexes[relation_type])
+
+    return {
+        "nodes": nodes,
+        "edges": list(relationships.values()),
+        "relation_types": relation_types,
+    }
+
+
+class PathSearchLimitExceeded(Exception):
+    """
+    The search for a path ran out of time or visited too many datasets.
+
+    """
+
+
+class _Search:
+    """
+    One end of a bidirectional breadth first search.
+
+    """
+
+    def __init__(self, start_ids, direction, compiled=None):
+        self.direction = direction
+        self.compiled = compiled
+        self.depth = 0
+        self.frontier = set(start_ids)
+        # the dataset and relationship each dataset was reached from
+        self.parents = {dataset_id: None for dataset_id in start_ids}
+
+    def expand(self):
+        """
+        Move the search on by one relationship, returning the new datasets.
+
+        """
+        reached = set()
+        for relationship_id, from_id, to_id in self._get_relationships():
+            steps = []
+            if self.direction in ["out", "both"]:
+                steps.append((from_id, to_id))
+            if self.direction in ["in", "both"]:
+                steps.append((to_id, from_id))
+
+            for source, target in steps:
+                if source in self.frontier and target not in self.parents:
+                    self.parents[target] = (source, relationship_id)
+                    reached.add(target)
+
+        self.depth += 1
+        self.frontier = reached
+        return reached
+
+    def _get_relationships(self):
+        # the (id, from id, to id) of the relationships to follow from the frontier,
+        # in id order within each batch
+        frontier = sorted(self.frontier)
+        if self.compiled is not None:
+            yield from self._get_compiled_relationships(frontier)
+            return
+
+        for start in range(0, len(frontier), FRONTIER_BATCH_SIZE):
+            batch = frontier[start : start + FRONTIER_BATCH_SIZE]
+            query = Q()
+            if self.direction in ["out", "both"]:
+                query |= Q(from_dataset_id__in=batch)
+            if self.direction in ["in", "both"]:
+                query |= Q(to_dataset_id__in=batch)
+
+            yield from Relationship.objects.filter(query).order_by("id").values_list(
+                "id", "from_dataset_id", "to_dataset_id"
+            )
+
+    def _get_compiled_relationships(self, frontier):
+        compiled = self.compiled
+        for start in range(0, len(frontier), FRONTIER_BATCH_SIZE):
+            edges = set()
+            for dataset_id in frontier[start : start + FRONTIER_BATCH_SIZE]:
+                index = compiled.find_dataset(dataset_id)
+                if index is None:
+                    continue
+                if self.direction in ["out", "both"]:
+                    edges.update(compiled.get_out_edges(index))
+                if self.direction in ["in", "both"]:
+                    edges.update(compiled.get_in_edges(index))
+
+            for edge in sorted(edges):
+                yield (
+                    compiled.edge_ids[edge],
+                    compiled.dataset_ids[compiled.edge_from[edge]],
+                    compiled.dataset_ids[compiled.edge_to[edge]],
+                )
+
+    def chain(self, dataset_id):
+        """
+        Get the datasets and relationships from the start of the search to a dataset.
+
+        """
+        datasets = [dataset_id]
+        relationships = []
+        while self.parents[datasets[-1]] is not None:
+            parent, relationship_id = self.parents[datasets[-1]]
+            datasets.append(parent)
+            relationships.append(relationship_id)
+        datasets.reverse()
+        relationships.reverse()
+        return datasets, relationships
+
+
+def find_shortest_path(
+    from_ids,
+    to_ids,
+    max_depth=DEFAULT_PATH_DEPTH,
+    direction="out",
+    max_visits=PATH_MAX_VISITS,
+    time_limit=PATH_TIME_LIMIT,
+):
+    """
+    Find the shortest chain of relationships from any of one set of datasets to any
+    of another.
+
+    The result is None if there is no path of up to "max_depth" relationships,
+    otherwise it has:
+        "datasets": a list of {id, url, dataset_provider}, from start to end
+        "relationships": a list of {from, to, relationship_types, description}
+
+    @param from_ids(list): the ids of the datasets to start from
+
+    @param to_ids(list): the ids of the datasets to finish at
+
+    @param max_depth(int): the maximum number of relationships in the path
+
+    @param direction(str): "out" to follow relationships from a dataset to the
+        related dataset, "in" to follow them backwards, "both" for either way
+
+    @raises ValueError: if the depth or direction are not valid
+
+    @raises PathSearchLimitExceeded: if the search visits more than "max_visits"
+        datasets or takes longer than "time_limit" seconds
+
+    """
+    if direction not in DIRECTIONS:
+        raise ValueError(f"Invalid direction {direction}")
+    if max_depth < 0 or max_depth > MAX_PATH_DEPTH:
+        raise ValueError(f"Invalid max_depth {max_depth}, must be 0 to {MAX_PATH_DEPTH}")
+
+    compiled = get_compiled_catalogue()
+    reverse_direction = {"out": "in", "in": "out", "both": "both"}[direction]
+    forward = _Search(from_ids, direction, compiled)
+    backward = _Search(to_ids, reverse_direction, compiled)
+    deadline = time.monotonic() + time_limit
+
+    meeting = _get_meeting(forward, backward, forward.frontier)
+    while meeting is None and forward.depth + backward.depth < max_depth:
+        # expand the smaller frontier, it should be the cheaper one
+        if len(forward.frontier) <= len(backward.frontier):
+            search = forward
+        else:
+            search = backward
+
+        reached = search.expand()
+        if len(reached) == 0:
+            return None
+        meeting = _get_meeting(forward, backward, reached)
+
+        if len(forward.parents) + len(backward.parents) > max_visits:
+            raise PathSearchLimitExceeded(f"Visited more than {max_visits} datasets")
+        if time.monotonic() > deadline:
+            raise PathSearchLimitExceeded(f"Took longer than {time_limit} seconds")
+
+    if meeting is None:
+        return None
+
+    datasets, relationships = forward.chain(meeting)
+    backward_datasets, backward_relationships = backward.chain(meeting)
+    backward_datasets.reverse()
+    backward_relationships.reverse()
+    datasets.extend(backward_datasets[1:])
+    relationships.extend(backward_relationships)
+
+    if compiled is not None:
+        return _get_compiled_path_j_data(compiled, datasets, relationships)
+    return _get_path_j_data(datasets, relationships)
+
+
+def _get_meeting(forward, backward, reached):
+    for dataset_id in sorted(reached):
+        if dataset_id in forward.parents and dataset_id in backward.parents:
+            return dataset_id
+    return None
+
+
+def _get_path_j_data(dataset_ids, relationship_ids):
+    datasets = Dataset.objects.in_bulk(dataset_ids)
+    relationships = Relationship.objects.in_bulk(relationship_ids)
+    relation_types = {}
+    through = Relationship.relationships.through
+    for relationship_id, relation_type in (
+        through.objects.filter(relationship_id__in=relationship_ids)
+        .order_by("relationship_id", "relationtype_id")
+        .values_list("relationship_id", "relationtype_id")
+    ):
+        relation_types.setdefault(relationship_id, []).append(relation_type)
+
+    return {
+        "datasets": [
+            {
+                "id": dataset_id,
+                "url": datasets[dataset_id].url,
+                "dataset_provider": datasets[dataset_id].dataset_provider_id,
+            }
+            for dataset_id in dataset_ids
+        ],
+        "relationships": [
+            {
+                "from": relationships[relationship_id].from_dataset_id,
+                "to": relationships[relationship_id].to_dataset_id,
+                "relationship_types": relation_types.get(relationship_id, []),
+                "description": relationships[relationship_id].description,
+            }
+            for relationship_id in relationship_ids
+        ],
+    }
+
+
+def _get_compiled_path_j_data(compiled, dataset_ids, relationship_ids):
+    datasets = []
+    for dataset_id in dataset_ids:
+        index = compiled.find_dataset(dataset_id)
+        datasets.append(
+            {
+                "id": dataset_id,
+                "url": compiled.get_url(index),
+                "dataset_provider": compiled.get_provider(index),
+            }
+        )
+
+    relationships = []
+    for relationship_id in relationship_ids:
+        edge = compiled.find_edge(relationship_id)
+        relationships.append(
+            {
+                "from": compiled.dataset_ids[compiled.edge_from[edge]],
+                "to": compiled.dataset_ids[compiled.edge_to[edge]],
+                "relationship_types": [
+                    compiled.string(compiled.relation_type_names[relation_type])
+                    for relation_type in compiled.get_type_indexes(edge)
+                ],
+                "description": compiled.string(compiled.edge_descriptions[edge]),
+            }
+        )
+
+    return {"datasets": datasets, "relationships": relationships}
@@ -0,0 +1,885 @@
+"""
+Importer
+
+The catalogue is imported in two steps. The rows of the mapping, as "MappingRow"s,
+are first added to an "ImportCatalogue" in memory, which dedupes the ECVs, filters and
+datasets, and it is then written to the database by "write_catalogue", with a bulk
+insert per table, in a single transaction. Readers see either the old catalogue or the
+new one, never a partial one.
+
+A mapping may be split across several sources, each read into its own
+"ImportCatalogue" and then merged with "ImportCatalogue.merge". Merging dedupes the
+datasets by URL and filter set and reports the metadata the sources disagree on.
+
+Bulk inserts do not send the signals that keep "Dataset.filter_signature" up to date,
+see data_bridge_app.signals, so the signatures are calculated here instead.
+
+"""
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from data_bridge_app.models import (
+    CatalogueVersion,
+    Dataset,
+    ECV,
+    Filter,
+    Project,
+    RelationType,
+    Relationship,
+    get_catalogue_version,
+    get_filter_signature,
+    parse_filters,
+)
+
+BATCH_SIZE = 500
+
+# The mapping has no dates for the secondary dataset of a row, so these placeholder
+# dates are used for it. When sources are merged they are replaced by the dates from a
+# source where the dataset is a primary dataset, see "ImportCatalogue.merge".
+SECONDARY_START_DATE = "2015-01-01"
+SECONDARY_END_DATE = "2023-01-01"
+
+
+class MappingRow:
+    """
+    A row of the mapping, with its values cleaned. A row has a primary dataset and,
+    optionally, a secondary dataset related to it.
+
+    """
+
+    __slots__ = (
+        "url_1",
+        "provider_1",
+        "start_date_1",
+        "end_date_1",
+        "ecvs_1",
+        "filters_1",
+        "url_2",
+        "provider_2",
+        "ecvs_2",
+        "filters_2",
+        "relation_types_1",
+        "relation_types_2",
+        "description",
+    )
+
+    def __init__(
+        self,
+        url_1=None,
+        provider_1=None,
+        start_date_1=None,
+        end_date_1=None,
+        ecvs_1=(),
+        filters_1=(),
+        url_2=None,
+        provider_2=None,
+        ecvs_2=(),
+        filters_2=(),
+        relation_types_1=(),
+        relation_types_2=(),
+        description="",
+    ):
+        """
+        The "_1" values are for the primary dataset and the "_2" values for the
+        secondary dataset. The ECVs, filters and relation types are lists of names,
+        the filters as "name=value".
+
+        @param relation_types_1(list(str)): the types of the relationship from the
+            primary to the secondary dataset
+
+        @param relation_types_2(list(str)): the types of the relationship from the
+            secondary to the primary dataset
+
+        """
+        self.url_1 = url_1
+        self.provider_1 = provider_1
+        self.start_date_1 = start_date_1
+        self.end_date_1 = end_date_1
+        self.ecvs_1 = ecvs_1
+        self.filters_1 = filters_1
+        self.url_2 = url_2
+        self.provider_2 = provider_2
+        self.ecvs_2 = ecvs_2
+        self.filters_2 = filters_2
+        self.relation_types_1 = relation_types_1
+        self.relation_types_2 = relation_types_2
+        self.description = description
+
+
+class ImportRows:
+    """
+    The relation types and rows read from a source, to be added to an
+    "ImportCatalogue". Unlike a catalogue, they can be passed between processes.
+
+    """
+
+    def __init__(self):
+        # name: description
+        self.relation_types = {}
+        self.rows = []
+
+    def add_relation_type(self, name, description=""):
+        self.relation_types[name] = description
+
+    def add_row(self, row):
+        """
+        @param row(MappingRow): the row
+
+        """
+        self.rows.append(row)
+
+    def add_to(self, catalogue):
+        """
+        Add the relation types and rows to a catalogue.
+
+        @param catalogue(ImportCatalogue): the catalogue
+
+        """
+        for name, description in self.relation_types.items():
+            catalogue.add_relation_type(name, description)
+        for row in self.rows:
+            catalogue.add_row(row)
+
+
+class ImportDataset:
+    """
+    A dataset read from the mapping.
+
+    """
+
+    def __init__(self, url, provider, start_date=None, end_date=None):
+        """
+        @param url(str): the URL of the dataset
+
+        @param provider(str): the name of the provider
+
+        @param start_date(date or str): the start date of the data, if known
+
+        @param end_date(date or str): the end date of the data, if known
+
+        """
+        self.url = url
+        self.provider = provider
+        self.start_date = start_date
+        self.end_date = end_date
+        self.ecvs = {}
+        self.filters = {}
+        self.id = None
+        # is it the primary dataset of a row, rather than only a secondary dataset
+        # with placeholder dates
+        self.primary = False
+
+    def add_ecvs(self, ecvs):
+        """
+        @param ecvs(list(str)): the names of the ECVs
+
+        """
+        for ecv in ecvs:
+            self.ecvs[ecv] = None
+
+    def add_filters(self, filters):
+        """
+        @param filters(list(str)): the filters, as "name=value"
+
+        """
+        for filter_ in filters:
+            self.filters[filter_] = None
+
+    def get_filter_signature(self):
+        return get_filter_signature(parse_filters(self.filters))
+
+
+class ImportRelationship:
+    """
+    A relationship read from the mapping.
+
+    """
+
+    def __init__(self, from_dataset, to_dataset, relation_types, description):
+        """
+        @param from_dataset(ImportDataset): the dataset the relationship is from
+
+        @param to_dataset(ImportDataset): the dataset the relationship is to
+
+        @param relation_types(list(str)): the names of the relation types
+
+        @param description(str): the description of the relationship
+
+        """
+        self.from_dataset = from_dataset
+        self.to_dataset = to_dataset
+        self.relation_types = relation_types
+        self.description = description
+
+
+class ImportCatalogue:
+    """
+    The catalogue read from the mapping, to be written by "write_catalogue".
+
+    Each dict is used as an ordered set, the objects are written in the order they
+    were first added.
+
+    """
+
+    def __init__(self):
+        # name: description
+        self.relation_types = {}
+        # name: (slug, aliases)
+        self.providers = {}
+        self.ecvs = {}
+        self.filters = {}
+        self.datasets = []
+        self.relationships = []
+        # the number of rows with a primary dataset
+        self.rows = 0
+        # (url, filter signature): datasets
+        self._datasets_by_filters = {}
+        # dataset: the name of the source it was merged from
+        self._sources = {}
+        # the keys of the merged relationships
+        self._relationship_keys = set()
+
+    def add_row(self, row):
+        """
+        Add the datasets and relationships from a row of the mapping.
+
+        All of the ECVs and filters are added, even those of a secondary dataset
+        without a primary dataset.
+
+        @param row(MappingRow): the row
+
+        """
+        self.add_ecvs(row.ecvs_1)
+        self.add_ecvs(row.ecvs_2)
+        self.add_filters(row.filters_1)
+        self.add_filters(row.filters_2)
+
+        if row.url_1 is None:
+            return
+        self.rows += 1
+
+        ds_1 = self.add_dataset(
+            row.url_1,
+            row.provider_1,
+            row.ecvs_1,
+            row.filters_1,
+            start_date=row.start_date_1,
+            end_date=row.end_date_1,
+        )
+        ds_1.primary = True
+
+        if row.url_2 is None:
+            return
+
+        # the secondary dataset may already exist
+        ds_2 = self.get_or_add_dataset(
+            row.url_2,
+            row.provider_2,
+            row.ecvs_2,
+            row.filters_2,
+            start_date=SECONDARY_START_DATE,
+            end_date=SECONDARY_END_DATE,
+        )
+
+        if len(row.relation_types_1) > 0:
+            self.add_relationship(ds_1, ds_2, row.relation_types_1, row.description)
+        if len(row.relation_types_2) > 0:
+            self.add_relationship(ds_2, ds_1, row.relation_types_2, row.description)
+
+    def add_relation_type(self, name, description=""):
+        self.relation_types[name] = description
+
+    def add_provider(self, name, slug, aliases=""):
+        self.providers[name] = (slug, aliases)
+
+    def add_ecvs(self, ecvs):
+        """
+        @param ecvs(list(str)): the names of the ECVs
+
+        """
+        for ecv in ecvs:
+            self.ecvs[ecv] = None
+
+    def add_filters(self, filters):
+        """
+        @param filters(list(str)): the filters, as "name=value"
+
+        """
+        for filter_ in filters:
+            self.filters[filter_] = None
+
+    def add_dataset(self, url, provider, ecvs, filters, start_date=None, end_date=None):
+        """
+        Add a new dataset.
+
+        @param url(str): the URL of the dataset
+
+        @param provider(str): the name of the provider
+
+        @param ecvs(list(str)): the names of the ECVs
+
+        @param filters(list(str)): the filters, as "name=value"
+
+        @param start_date(date or str): the start date of the data, if known
+
+        @param end_date(date or str): the end date of the data, if known
+
+        @return the new ImportDataset
+
+        """
+        dataset = ImportDataset(url, provider, start_date, end_date)
+        dataset.add_ecvs(ecvs)
+        dataset.add_filters(filters)
+        self.add_ecvs(dataset.ecvs)
+        self.add_filters(dataset.filters)
+        self.datasets.append(dataset)
+        self._datasets_by_filters.setdefault(
+            (url, dataset.get_filter_signature()), []
+        ).append(dataset)
+        return dataset
+
+    def get_or_add_dataset(
+        self, url, provider, ecvs, filters, start_date=None, end_date=None
+    ):
+        """
+        Get the dataset with the URL and exactly the same set of filters, if there is
+        only one, adding the ECVs to it, otherwise add a new dataset.
+
+        The parameters are those of "add_dataset".
+
+        @return the ImportDataset
+
+        """
+        matching = self._datasets_by_filters.get(
+            (url, get_filter_signature(parse_filters(filters))), []
+        )
+        if len(matching) != 1:
+            return self.add_dataset(url, provider, ecvs, filters, start_date, end_date)
+
+        dataset = matching[0]
+        dataset.add_ecvs(ecvs)
+        self.add_ecvs(dataset.ecvs)
+        return dataset
+
+    def add_relationship(self, from_dataset, to_dataset, relation_types, description):
+        """
+        Add a relationship, the parameters are those of "ImportRelationship".
+
+        """
+        self.relationships.append(
+            ImportRelationship(from_dataset, to_dataset, relation_types, description)
+        )
+
+    def merge(self, catalogue, source):
+        """
+        Merge the catalogue read from another source into this one.
+
+        A dataset with the same URL and set of filters as a dataset from an earlier
+        source is merged into it, adding its ECVs, the n-th such dataset into the n-th
+        one if there are several. Any more such datasets than the earlier sources have
+        are added, so the number of them does not depend on the order of the sources.
+        The datasets of a single source are kept as they are when it is imported on
+        its own.
+
+        If two merged datasets disagree on the provider or the dates the earlier is
+        kept and the conflict reported, a value that is not known is not a conflict.
+        The dates of a dataset that is only a secondary dataset are placeholders, see
+        SECONDARY_START_DATE, they are replaced by those of a primary dataset and are
+        not compared. Relationships that are the same as one from an earlier source
+        are merged.
+
+        @param catalogue(ImportCatalogue): the catalogue to merge
+
+        @param source(str): the name of the source, for the conflicts
+
+        @return a list of the conflicts, as strings
+
+        """
+        conflicts = []
+        for name, description in catalogue.relation_types.items():
+            if not self.relation_types.get(name):
+                self.relation_types[name] = description
+            elif description and self.relation_types[name] != description:
+                conflicts.append(
+                    f"The relation type '{name}' has the description "
+                    f"'{description}' in {source}, but "
+                    f"'{self.relation_types[name]}' in an earlier source"
+                )
+        for name, (slug, aliases) in catalogue.providers.items():
+            self.providers.setdefault(name, (slug, aliases))
+        self.add_ecvs(catalogue.ecvs)
+        self.add_filters(catalogue.filters)
+        self.rows += catalogue.rows
+
+        merged = {}
+        added = {}
+        # key: the number of datasets of the catalogue with it so far
+        counts = {}
+        for dataset in catalogue.datasets:
+            key = (dataset.url, dataset.get_filter_signature())
+            count = counts.get(key, 0)
+            counts[key] = count + 1
+            matching = self._datasets_by_filters.get(key, [])
+            if count >= len(matching):
+                # more such datasets than the earlier sources have
+                self.datasets.append(dataset)
+                added.setdefault(key, []).append(dataset)
+                self._sources[dataset] = source
+                merged[dataset] = dataset
+                continue
+            # the same source read twice is merged dataset by dataset
+            existing = matching[count]
+            existing.add_ecvs(dataset.ecvs)
+            conflicts.extend(_merge_dataset(existing, dataset, source, self._sources))
+            merged[dataset] = existing
+        for key, datasets in added.items():
+            self._datasets_by_filters.setdefault(key, []).extend(datasets)
+
+        keys = set()
+        for relationship in catalogue.relationships:
+            from_dataset = merged[relationship.from_dataset]
+            to_dataset = merged[relationship.to_dataset]
+            key = (
+                from_dataset,
+                to_dataset,
+                relationship.description,
+                tuple(sorted(relationship.relation_types)),
+            )
+            if key not in self._relationship_keys:
+                keys.add(key)
+                self.add_relationship(
+                    from_dataset,
+                    to_dataset,
+                    relationship.relation_types,
+                    relationship.description,
+                )
+        self._relationship_keys.update(keys)
+
+        return conflicts
+
+
+def _merge_dataset(existing, dataset, source, sources):
+    # merge the metadata of a dataset into the dataset from an earlier source with the
+    # same URL and filters, returning the conflicts
+    if dataset.primary and not existing.primary:
+        existing.provider = dataset.provider or existing.provider
+        existing.start_date = dataset.start_date
+        existing.end_date = dataset.end_date
+        existing.primary = True
+        sources[existing] = source
+        return []
+
+    fields = ["provider"]
+    if dataset.primary:
+        fields += ["start_date", "end_date"]
+    conflicts = []
+    for field in fields:
+        value = getattr(dataset, field)
+        existing_value = getattr(existing, field)
+        if field != "provider":
+            value = Dataset._meta.get_field(field).to_python(value)
+            existing_value = Dataset._meta.get_field(field).to_python(existing_value)
+        if value is None or value == existing_value:
+            continue
+        if existing_value is None:
+            setattr(existing, field, value)
+            continue
+        conflicts.append(
+            f"{existing.url} [{', '.join(existing.filters)}]: the "
+            f"{field.replace('_', ' ')} is '{value}' in {source}, but "
+            f"'{existing_value}' in {sources[existing]}"
+        )
+    return conflicts
+
+
+class ImportChanges:
+    """
+    The number of objects of each type added, updated and deleted by
+    "update_catalogue", and the new catalogue version if there were any changes.
+
+    """
+
+    def __init__(self):
+        # name: [added, updated, deleted]
+        self.counts = {}
+        self.version = None
+
+    def __bool__(self):
+        return any(any(counts) for counts in self.counts.values())
+
+    def add(self, name, added=0, updated=0, deleted=0):
+        counts = self.counts.setdefault(name, [0, 0, 0])
+        counts[0] += added
+        counts[1] += updated
+        counts[2] += deleted
+
+    def get_summary(self):
+        """
+        Get a line for each type of object, for example
+        "datasets: 3 added, 1 updated, 0 deleted".
+
+        """
+        return [
+            f"{name}: {added} added, {updated} updated, {deleted} deleted"
+            for name, (added, updated, deleted) in self.counts.items()
+        ]
+
+
+def write_catalogue(catalogue, using=DEFAULT_DB_ALIAS, source_hash=""):
+    """
+    Replace the catalogue in the database, in a single transaction.
+
+    @param catalogue(ImportCatalogue): the catalogue to write
+
+    @param using(str): the alias of the database
+
+    @param source_hash(str): the hash of the workbook the catalogue was read from
+
+    @return the new CatalogueVersion
+
+    """
+    with transaction.atomic(using=using):
+        delete_catalogue(using)
+
+        RelationType.objects.using(using).bulk_create(
+            [
+                RelationType(name=name, description=description)
+                for name, description in catalogue.relation_types.items()
+            ],
+            batch_size=BATCH_SIZE,
+        )
+        Project.objects.using(using).bulk_create(
+            [
+                Project(name=name, slug=slug, aliases=aliases)
+                for name, (slug, aliases) in catalogue.providers.items()
+            ],
+            batch_size=BATCH_SIZE,
+        )
+        ECV.objects.using(using).bulk_create(
+            [ECV(name=name) for name in catalogue.ecvs], batch_size=BATCH_SIZE
+        )
+        filters = _create_filters(catalogue.filters, using)
+        _create_datasets(catalogue.datasets, filters, using)
+        _create_relationships(catalogue.relationships, using)
+
+        return CatalogueVersion.objects.using(using).create(source_hash=source_hash)
+
+
+def update_catalogue(catalogue, using=DEFAULT_DB_ALIAS, source_hash=""):
+    """
+    Update the catalogue in the database to match "catalogue", in a single
+    transaction, only adding, updating and deleting the objects that have changed.
+
+    Datasets are matched on their URL and set of filters, where several datasets
+    have the same URL and filters they are matched in order. A dataset's provider,
+    dates and ECVs are updated in place, relationships are matched on the datasets,
+    description and relation types.
+
+    A new catalogue version is only created if anything changed, otherwise the
+    current version is given the source hash.
+
+    @param catalogue(ImportCatalogue): the catalogue read from the mapping
+
+    @param using(str): the alias of the database
+
+    @param source_hash(str): the hash of the workbook the catalogue was read from
+
+    @return the ImportChanges
+
+    """
+    changes = ImportChanges()
+    with transaction.atomic(using=using):
+        _update_relation_types(catalogue, changes, using)
+        _update_providers(catalogue, changes, using)
+        _update_ecvs(catalogue, changes, using)
+        filters = _update_filters(catalogue, changes, using)
+        _update_datasets(catalogue, filters, changes, using)
+        _update_relationships(catalogue, changes, using)
+        _delete_unused(catalogue, filters, changes, using)
+
+        if changes:
+            changes.version = CatalogueVersion.objects.using(using).create(
+                source_hash=source_hash
+            )
+        elif source_hash:
+            CatalogueVersion.objects.using(using).filter(
+                id=get_catalogue_version(using)
+            ).update(source_hash=source_hash)
+    return changes
+
+
+def delete_catalogue(using=DEFAULT_DB_ALIAS):
+    """
+    Delete the whole catalogue, other than the catalogue versions.
+
+    """
+    Dataset.objects.using(using).delete()
+    ECV.objects.using(using).delete()
+    Filter.objects.using(using).delete()
+    Project.objects.using(using).delete()
+    RelationType.objects.using(using).delete()
+    Relationship.objects.using(using).delete()
+
+
+def _create_filters(filters, using):
+    # create the "name=value" filters, returning the id of each
+    instances = [
+        Filter(name=name, value=value) for name, value in parse_filters(filters)
+    ]
+    Filter.objects.using(using).bulk_create(instances, batch_size=BATCH_SIZE)
+    return {filter_: instance.id for filter_, instance in zip(filters, instances)}
+
+
+def _create_datasets(datasets, filters, using):
+    # create the datasets, with their ECVs and filters, setting the id of each
+    instances = Dataset.objects.using(using).bulk_create(
+        [
+            Dataset(
+                url=dataset.url,
+                dataset_provider_id=dataset.provider,
+                start_date=dataset.start_date,
+                end_date=dataset.end_date,
+                filter_signature=dataset.get_filter_signature(),
+            )
+            for dataset in datasets
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    dataset_ecvs = []
+    dataset_filters = []
+    for dataset, instance in zip(datasets, instances):
+        dataset.id = instance.id
+        for ecv in dataset.ecvs:
+            dataset_ecvs.append(Dataset.ecvs.through(dataset_id=dataset.id, ecv_id=ecv))
+        for filter_ in dataset.filters:
+            dataset_filters.append(
+                Dataset.filters.through(
+                    dataset_id=dataset.id, filter_id=filters[filter_]
+                )
+            )
+    Dataset.ecvs.through.objects.using(using).bulk_create(
+        dataset_ecvs, batch_size=BATCH_SIZE
+    )
+    Dataset.filters.through.objects.using(using).bulk_create(
+        dataset_filters, batch_size=BATCH_SIZE
+    )
+
+
+def _create_relationships(relationships, using):
+    instances = Relationship.objects.using(using).bulk_create(
+        [
+            Relationship(
+                from_dataset_id=relationship.from_dataset.id,
+                to_dataset_id=relationship.to_dataset.id,
+                description=relationship.description,
+            )
+            for relationship in relationships
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    Relationship.relationships.through.objects.using(using).bulk_create(
+        [
+            Relationship.relationships.through(
+                relationship_id=instance.id, relationtype_id=relation_type
+            )
+            for relationship, instance in zip(relationships, instances)
+            for relation_type in relationship.relation_types
+        ],
+        batch_size=BATCH_SIZE,
+    )
+
+
+def _update_relation_types(catalogue, changes, using):
+    existing = dict(
+        RelationType.objects.using(using).values_list("name", "description")
+    )
+    added = []
+    updated = []
+    for name, description in catalogue.relation_types.items():
+        if name not in existing:
+            added.append(RelationType(name=name, description=description))
+        elif existing[name] != description:
+            updated.append(RelationType(name=name, description=description))
+    RelationType.objects.using(using).bulk_create(added, batch_size=BATCH_SIZE)
+    RelationType.objects.using(using).bulk_update(
+        updated, ["description"], batch_size=BATCH_SIZE
+    )
+    changes.add("relation types", len(added), len(updated))
+
+
+def _update_providers(catalogue, changes, using):
+    existing = {
+        name: (slug, aliases)
+        for name, slug, aliases in Project.objects.using(using).values_list(
+            "name", "slug", "aliases"
+        )
+    }
+    added = []
+    updated = []
+    for name, (slug, aliases) in catalogue.providers.items():
+        if name not in existing:
+            added.append(Project(name=name, slug=slug, aliases=aliases))
+        elif existing[name] != (slug, aliases):
+            updated.append(Project(name=name, slug=slug, aliases=aliases))
+    Project.objects.using(using).bulk_create(added, batch_size=BATCH_SIZE)
+    Project.objects.using(using).bulk_update(
+        updated, ["slug", "aliases"], batch_size=BATCH_SIZE
+    )
+    changes.add("providers", len(added), len(updated))
+
+
+def _update_ecvs(catalogue, changes, using):
+    existing = set(ECV.objects.using(using).values_list("name", flat=True))
+    added = [ECV(name=name) for name in catalogue.ecvs if name not in existing]
+    ECV.objects.using(using).bulk_create(added, batch_size=BATCH_SIZE)
+    changes.add("ECVs", len(added))
+
+
+def _update_filters(catalogue, changes, using):
+    # returns the id of each filter in the database, by "name=value"
+    filters = {}
+    rows = Filter.objects.using(using).order_by("id")
+    for filter_id, name, value in rows.values_list("id", "name", "value"):
+        filters.setdefault(f"{name}={value}", filter_id)
+    added = [filter_ for filter_ in catalogue.filters if filter_ not in filters]
+    filters.update(_create_filters(added, using))
+    changes.add("filters", len(added))
+    return filters
+
+
+def _update_datasets(catalogue, filters, changes, using):
+    # the datasets in the database, by URL and filter signature, last first
+    existing = {}
+    rows = Dataset.objects.using(using).order_by("-id")
+    for row in rows.values_list(
+        "id", "url", "filter_signature", "dataset_provider_id", "start_date", "end_date"
+    ):
+        existing.setdefault((row[1], row[2]), []).append(row)
+    existing_ecvs = {}
+    rows = Dataset.ecvs.through.objects.using(using)
+    for through_id, dataset_id, ecv in rows.values_list("id", "dataset_id", "ecv_id"):
+        existing_ecvs.setdefault(dataset_id, {})[ecv] = through_id
+
+    start_date_field = Dataset._meta.get_field("start_date")
+    end_date_field = Dataset._meta.get_field("end_date")
+    added = []
+    updated = []
+    updated_count = 0
+    added_ecvs = []
+    deleted_ecvs = []
+    for dataset in catalogue.datasets:
+        rows = existing.get((dataset.url, dataset.get_filter_signature()))
+        if not rows:
+            added.append(dataset)
+            continue
+
+        dataset.id, _, _, provider, start_date, end_date = rows.pop()
+        instance = Dataset(
+            id=dataset.id,
+            dataset_provider_id=dataset.provider,
+            start_date=start_date_field.to_python(dataset.start_date),
+            end_date=end_date_field.to_python(dataset.end_date),
+        )
+        changed = False
+        if (provider, start_date, end_date) != (
+            instance.dataset_provider_id,
+            instance.start_date,
+            instance.end_date,
+        ):
+            updated.append(instance)
+            changed = True
+
+        ecvs = existing_ecvs.get(dataset.id, {})
+        for ecv in dataset.ecvs:
+            if ecv not in ecvs:
+                added_ecvs.append(
+                    Dataset.ecvs.through(dataset_id=dataset.id, ecv_id=ecv)
+                )
+                changed = True
+        for ecv, through_id in ecvs.items():
+            if ecv not in dataset.ecvs:
+                deleted_ecvs.append(through_id)
+                changed = True
+        if changed:
+            updated_count += 1
+
+    deleted = [row[0] for rows in existing.values() for row in rows]
+    for ids in _batches(deleted):
+        Dataset.objects.using(using).filter(id__in=ids).delete()
+    Dataset.objects.using(using).bulk_update(
+        updated, ["dataset_provider", "start_date", "end_date"], batch_size=BATCH_SIZE
+    )
+    for ids in _batches(deleted_ecvs):
+        Dataset.ecvs.through.objects.using(using).filter(id__in=ids).delete()
+    Dataset.ecvs.through.objects.using(using).bulk_create(
+        added_ecvs, batch_size=BATCH_SIZE
+    )
+    _create_datasets(added, filters, using)
+    changes.add("datasets", len(added), updated_count, len(deleted))
+
+
+def _update_relationships(catalogue, changes, using):
+    # the relationships in the database, by their datasets, description and types
+    relation_types = {}
+    rows = Relationship.relationships.through.objects.using(using)
+    for relationship_id, relation_type in rows.values_list(
+        "relationship_id", "relationtype_id"
+    ):
+        relation_types.setdefault(relationship_id, []).append(relation_type)
+    existing = {}
+    rows = Relationship.objects.using(using).order_by("-id")
+    for relationship_id, from_id, to_id, description in rows.values_list(
+        "id", "from_dataset_id", "to_dataset_id", "description"
+    ):
+        key = (
+            from_id,
+            to_id,
+            description,
+            tuple(sorted(relation_types.get(relationship_id, []))),
+        )
+        existing.setdefault(key, []).append(relationship_id)
+
+    added = []
+    for relationship in catalogue.relationships:
+        key = (
+            relationship.from_dataset.id,
+            relationship.to_dataset.id,
+            relationship.description,
+            tuple(sorted(relationship.relation_types)),
+        )
+        if existing.get(key):
+            existing[key].pop()
+        else:
+            added.append(relationship)
+
+    deleted = [relationship_id for ids in existing.values() for relationship_id in ids]
+    for ids in _batches(deleted):
+        Relationship.objects.using(using).filter(id__in=ids).delete()
+    _create_relationships(added, using)
+    changes.add("relationships", len(added), 0, len(deleted))
+
+
+def _delete_unused(catalogue, filters, changes, using):
+    # delete the objects that are no longer in the catalogue, once nothing uses them
+    used_filters = {filters[filter_] for filter_ in catalogue.filters}
+    deleted = [
+        filter_id
+        for filter_id in set(filters.values())
+        if filter_id not in used_filters
+    ]
+    for ids in _batches(deleted):
+        Filter.objects.using(using).filter(id__in=ids).delete()
+    changes.add("filters", deleted=len(deleted))
+
+    for name, model, names in [
+        ("ECVs", ECV, catalogue.ecvs),
+        ("providers", Project, catalogue.providers),
+        ("relation types", RelationType, catalogue.relation_types),
+    ]:
+        _, counts = model.objects.using(using).exclude(pk__in=list(names)).delete()
+        changes.add(name, deleted=counts.get(model._meta.label, 0))
+
+
+def _batches(values):
+    for start in range(0, len(values), BATCH_SIZE):
+        yield values[start : start + BATCH_SIZE]
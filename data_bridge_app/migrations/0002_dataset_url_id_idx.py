@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_bridge_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dataset',
+            index=models.Index(fields=['url', 'id'], name='dataset_url_id_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:12
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def get_filter_signature(filters):
+    # a copy of data_bridge_app.models.get_filter_signature as it was when this
+    # migration was written, the migration must not change if the model code does
+    canonical = "\n".join(sorted({f"{name}={value}" for name, value in filters}))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def backfill_filter_signatures(apps, schema_editor):
+    Dataset = apps.get_model("data_bridge_app", "Dataset")
+
+    filters = {}
+    for dataset_id, name, value in Dataset.filters.through.objects.values_list(
+        "dataset_id", "filter__name", "filter__value"
+    ):
+        filters.setdefault(dataset_id, []).append((name, value))
+
+    datasets = []
+    for dataset_id, dataset_filters in filters.items():
+        datasets.append(
+            Dataset(id=dataset_id, filter_signature=get_filter_signature(dataset_filters))
+        )
+    Dataset.objects.bulk_update(datasets, ["filter_signature"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_bridge_app', '0002_dataset_url_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataset',
+            name='filter_signature',
+            field=models.CharField(db_index=True, default='e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855', editable=False, help_text='Signature of the set of filters, see get_filter_signature.', max_length=64),
+        ),
+        migrations.RunPython(backfill_filter_signatures, migrations.RunPython.noop),
+    ]
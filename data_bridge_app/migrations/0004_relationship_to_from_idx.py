@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_bridge_app', '0003_dataset_filter_signature'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='relationship',
+            index=models.Index(fields=['to_dataset', 'from_dataset'], name='relationship_to_from_idx'),
+        ),
+    ]
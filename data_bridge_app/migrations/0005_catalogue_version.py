@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_bridge_app', '0004_relationship_to_from_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogueVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, help_text='When this version of the catalogue was imported.')),
+            ],
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:41
+
+from django.db import migrations, models
+
+# the slugs and aliases for the providers created by import_spreadsheet
+PROJECTS = {
+    "C3S Climate Data Store": ("c3s", ""),
+    "CCI Open Data Portal": ("cci", "esa-cci"),
+    "CCI Archive on CEDA": ("cci", "esa-cci"),
+    "CM SAF": ("cm", "cm-saf"),
+    "OSI SAF": ("osi", "osi-saf"),
+}
+
+
+def set_slugs(apps, schema_editor):
+    Project = apps.get_model("data_bridge_app", "Project")
+    for name, (slug, aliases) in PROJECTS.items():
+        Project.objects.filter(name=name).update(slug=slug, aliases=aliases)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_bridge_app', '0005_catalogue_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='aliases',
+            field=models.CharField(blank=True, help_text='Other slugs for the project, separated by commas.', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='slug',
+            field=models.SlugField(blank=True, help_text='The project the provider belongs to, as used in /sankey/<slug>. Providers with the same slug are shown together.'),
+        ),
+        migrations.RunPython(set_slugs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("data_bridge_app", "0006_project_slug"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="catalogueversion",
+            name="source_hash",
+            field=models.CharField(
+                blank=True,
+                help_text="The SHA-256 hash of the workbook the catalogue was imported from.",
+                max_length=64,
+            ),
+        ),
+    ]
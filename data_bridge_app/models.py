@@ -1,4 +1,62 @@
-from django.db import models
+import hashlib
+
+from django.db import DEFAULT_DB_ALIAS, models
+
+
+def get_filter_signature(filters):
+    """
+    Get the canonical signature of a set of filters.
+
+    The signature is the same for any ordering of the filters, so two datasets have
+    the same set of filters if, and only if, they have the same signature.
+
+    @param filters(iterable): (name, value) pairs
+
+    """
+    canonical = "\n".join(sorted({f"{name}={value}" for name, value in filters}))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def parse_filters(filters):
+    """
+    Get the (name, value) pairs from a list of "name=value" strings.
+
+    """
+    pairs = []
+    for filter_ in filters:
+        name, value = filter_.split("=", 1)
+        pairs.append((name, value))
+    return pairs
+
+
+def update_filter_signatures(dataset_ids, using=DEFAULT_DB_ALIAS):
+    """
+    Recalculate the filter signatures for the datasets with the given ids.
+
+    @param dataset_ids(iterable): the ids of the datasets
+
+    @param using(str): the alias of the database the datasets are in
+
+    """
+    dataset_ids = set(dataset_ids)
+    filters = {dataset_id: [] for dataset_id in dataset_ids}
+    through = Dataset.filters.through
+    for dataset_id, name, value in through.objects.using(using).filter(
+        dataset_id__in=dataset_ids
+    ).values_list("dataset_id", "filter__name", "filter__value"):
+        filters[dataset_id].append((name, value))
+
+    datasets = []
+    for dataset_id, dataset_filters in filters.items():
+        datasets.append(
+            Dataset(id=dataset_id, filter_signature=get_filter_signature(dataset_filters))
+        )
+    Dataset.objects.using(using).bulk_update(
+        datasets, ["filter_signature"], batch_size=500
+    )
+
+
+EMPTY_FILTER_SIGNATURE = get_filter_signature([])
 
 class ECV(models.Model):
     name = models.CharField(
@@ -39,9 +97,29 @@ class Project(models.Model):
         primary_key=True,
     )
 
+    slug = models.SlugField(
+        max_length=50,
+        blank=True,
+        help_text="The project the provider belongs to, as used in /sankey/<slug>. "
+        "Providers with the same slug are shown together.",
+    )
+
+    aliases = models.CharField(
+        max_length=200,
+        blank=True,
+        help_text="Other slugs for the project, separated by commas.",
+    )
+
     def __str__(self):
         return self.name
 
+    def get_aliases(self):
+        """
+        Get the other slugs for the project.
+
+        """
+        return [alias.strip() for alias in self.aliases.split(",") if alias.strip()]
+
 
 class Dataset(models.Model):
     url = models.URLField(
@@ -82,6 +160,14 @@ class Dataset(models.Model):
         blank=True,
     )
 
+    filter_signature = models.CharField(
+        max_length=64,
+        default=EMPTY_FILTER_SIGNATURE,
+        db_index=True,
+        editable=False,
+        help_text="Signature of the set of filters, see get_filter_signature.",
+    )
+
     related_datasets = models.ManyToManyField(
         "self",
         symmetrical=False,
@@ -91,6 +177,12 @@ class Dataset(models.Model):
         help_text="List of related datasets.",
     )
 
+    class Meta:
+        indexes = [
+            # used for keyset pagination
+            models.Index(fields=["url", "id"], name="dataset_url_id_idx"),
+        ]
+
     def __str__(self):
         return self.url
 
@@ -127,6 +219,14 @@ class Relationship(models.Model):
         blank=True,
     )
 
+    class Meta:
+        indexes = [
+            # used to find the relationships to a dataset
+            models.Index(
+                fields=["to_dataset", "from_dataset"], name="relationship_to_from_idx"
+            ),
+        ]
+
     # class Meta:
     #     constraints = [
     #         models.UniqueConstraint(
@@ -149,3 +249,56 @@ class Relationship(models.Model):
         if html != "":
             html = f"<p>{html}</p>"
         return html
+
+
+class CatalogueVersion(models.Model):
+    """
+    A new version is created each time the catalogue is imported, readers can use it
+    to tell when any data they have cached is out of date.
+
+    """
+
+    created = models.DateTimeField(
+        auto_now_add=True,
+        help_text="When this version of the catalogue was imported.",
+    )
+
+    source_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        help_text="The SHA-256 hash of the workbook the catalogue was imported from.",
+    )
+
+    def __str__(self):
+        return f"{self.id} ({self.created})"
+
+
+def get_catalogue_version(using=DEFAULT_DB_ALIAS):
+    """
+    Get the current version of the catalogue, 0 if it has never been imported.
+
+    @param using(str): the alias of the database
+
+    """
+    version = (
+        CatalogueVersion.objects.using(using)
+        .order_by("-id")
+        .values_list("id", flat=True)
+    )
+    return version.first() or 0
+
+
+def get_catalogue_source_hash(using=DEFAULT_DB_ALIAS):
+    """
+    Get the hash of the workbook the current catalogue was imported from, "" if it is
+    not known.
+
+    @param using(str): the alias of the database
+
+    """
+    source_hash = (
+        CatalogueVersion.objects.using(using)
+        .order_by("-id")
+        .values_list("source_hash", flat=True)
+    )
+    return source_hash.first() or ""
@@ -0,0 +1,175 @@
+"""
+Pagination
+
+Keyset (cursor) pagination for lists of datasets. Datasets are ordered on (url, id)
+and a page is selected with a "WHERE (url, id) > (last url, last id)" condition and a
+LIMIT, so a deep page costs the same as the first page. There is deliberately no way
+to ask for a page by number or offset.
+
+A cursor is an opaque string holding the direction and the (url, id) key of the row
+the page starts after, or before.
+
+The datasets may also be a list already in (url, id) order, such as the datasets
+from a catalogue snapshot, in which case the page is found with a binary search.
+
+"""
+
+import base64
+import bisect
+import json
+
+from django.db.models import Q
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+NEXT = "next"
+PREV = "prev"
+
+
+class KeysetPage:
+    """
+    A page of datasets along with the cursors for the pages either side of it.
+
+    """
+
+    def __init__(self, object_list, next_cursor, prev_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def has_other_pages(self):
+        return self.next_cursor is not None or self.prev_cursor is not None
+
+
+class KeysetPaginator:
+    """
+    Paginate a dataset queryset using (url, id) as the key.
+
+    """
+
+    def __init__(self, queryset, limit=DEFAULT_PAGE_SIZE):
+        self.queryset = queryset
+        self.limit = limit
+
+    def page(self, cursor=None):
+        """
+        Get the page for the given cursor, or the first page if there is no cursor.
+
+        @param cursor(str): a cursor taken from a previous page
+
+        @raises ValueError: if the cursor is not valid
+
+        """
+        if cursor is None or cursor == "":
+            return self._next_page(None)
+
+        direction, key = decode_cursor(cursor)
+        if direction == PREV:
+            return self._prev_page(key)
+        return self._next_page(key)
+
+    def _next_page(self, key):
+        # get one extra row to find out if there is another page
+        rows = self._get_rows_after(key, self.limit + 1)
+        has_next = len(rows) > self.limit
+        rows = rows[: self.limit]
+
+        next_cursor = None
+        if has_next:
+            next_cursor = encode_cursor(NEXT, rows[-1])
+
+        prev_cursor = None
+        if key is not None and len(rows) > 0:
+            prev_cursor = encode_cursor(PREV, rows[0])
+
+        return KeysetPage(rows, next_cursor, prev_cursor)
+
+    def _prev_page(self, key):
+        # get one extra row to find out if there is another page
+        rows = self._get_rows_before(key, self.limit + 1)
+        has_prev = len(rows) > self.limit
+        rows = rows[: self.limit]
+        rows.reverse()
+
+        prev_cursor = None
+        if has_prev:
+            prev_cursor = encode_cursor(PREV, rows[0])
+
+        next_cursor = None
+        if len(rows) > 0:
+            next_cursor = encode_cursor(NEXT, rows[-1])
+
+        return KeysetPage(rows, next_cursor, prev_cursor)
+
+    def _get_rows_after(self, key, count):
+        if isinstance(self.queryset, list):
+            start = 0
+            if key is not None:
+                start = bisect.bisect_right(self.queryset, key, key=_get_key)
+            return self.queryset[start : start + count]
+
+        datasets = self.queryset.order_by("url", "id")
+        if key is not None:
+            url, id_ = key
+            datasets = datasets.filter(Q(url__gt=url) | Q(url=url, id__gt=id_))
+        return list(datasets[:count])
+
+    def _get_rows_before(self, key, count):
+        # the rows are returned nearest first
+        if isinstance(self.queryset, list):
+            end = bisect.bisect_left(self.queryset, key, key=_get_key)
+            return self.queryset[max(end - count, 0) : end][::-1]
+
+        url, id_ = key
+        datasets = self.queryset.order_by("-url", "-id").filter(
+            Q(url__lt=url) | Q(url=url, id__lt=id_)
+        )
+        return list(datasets[:count])
+
+
+def _get_key(dataset):
+    return (dataset.url, dataset.id)
+
+
+def get_page_size(limit):
+    """
+    Get the page size from the value of a "limit" parameter.
+
+    @raises ValueError: if the limit is not a positive integer
+
+    """
+    if limit is None or limit == "":
+        return DEFAULT_PAGE_SIZE
+
+    limit = int(limit)
+    if limit < 1:
+        raise ValueError(f"Invalid limit {limit}")
+
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def encode_cursor(direction, dataset):
+    value = json.dumps([direction, dataset.url, dataset.id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Get the direction and (url, id) key from a cursor.
+
+    @raises ValueError: if the cursor is not valid
+
+    """
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        direction, url, id_ = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    except (TypeError, ValueError) as ex:
+        raise ValueError(f"Invalid cursor {cursor}") from ex
+
+    if direction not in (NEXT, PREV) or not isinstance(url, str):
+        raise ValueError(f"Invalid cursor {cursor}")
+    if not isinstance(id_, int):
+        raise ValueError(f"Invalid cursor {cursor}")
+
+    return direction, (url, id_)
@@ -0,0 +1,375 @@
+"""
+Render pool
+
+Rendering a figure as a PNG, SVG or JPEG image with plotly needs the kaleido image
+engine, which is slow to start and can take several seconds per image. Rather than
+render in the web worker, the images are rendered by a small pool of separate
+processes, see "RenderPool".
+
+The pool is started with the first request of any kind to each web worker process,
+see "start_render_pool", so the image engine is warming up while the worker serves
+other requests, before the first image is asked for. It is not started when the
+application is loaded, so a server that forks its workers from a preloaded
+application, such as gunicorn with --preload, does not start a pool in the parent
+and share it, and its pipes, between the workers. A pool inherited from the parent
+process is ignored in any case.
+
+Each render process starts the image engine when it starts. A job waits for a free
+process, up to the job timeout, and at most RENDER_POOL_QUEUE jobs may be waiting at
+a time, further jobs are rejected straight away. A process that takes longer than
+the job timeout, or that has stopped, is killed and replaced.
+
+Image traffic therefore ties up at most RENDER_POOL_WORKERS + RENDER_POOL_QUEUE web
+worker threads, for at most the job timeout each, leaving the rest free for the JSON
+API.
+
+"get_render_metrics" returns the queue depth, the number of jobs and the render
+times, for monitoring.
+
+Set RENDER_POOL_WORKERS = 0 in the settings to render in the web worker instead.
+
+"""
+
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from django.conf import settings
+
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE = 8
+DEFAULT_TIMEOUT = 30
+# allowed on top of the job timeout for a new process to start the image engine
+STARTUP_TIMEOUT = 30
+
+LOG = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_pool = None
+
+
+class RenderError(Exception):
+    """
+    An image could not be rendered.
+
+    """
+
+
+class RenderQueueFull(RenderError):
+    """
+    Too many images are already waiting to be rendered.
+
+    """
+
+
+class RenderTimeout(RenderError):
+    """
+    An image was not rendered within the job timeout.
+
+    """
+
+
+class _RenderProcessStopped(RenderError):
+    """
+    The render process stopped, it needs to be replaced.
+
+    """
+
+
+class RenderMetrics:
+    """
+    Counters and timings for a render pool.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.busy = 0
+        self.jobs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.restarts = 0
+        self.total_wait_time = 0.0
+        self.total_render_time = 0.0
+        self.max_render_time = 0.0
+
+    def add(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+            if self.queue_depth > self.max_queue_depth:
+                self.max_queue_depth = self.queue_depth
+
+    def add_render_time(self, render_time):
+        with self._lock:
+            self.jobs += 1
+            self.total_render_time += render_time
+            self.max_render_time = max(self.max_render_time, render_time)
+
+    def as_dict(self):
+        with self._lock:
+            mean_render_time = 0.0
+            if self.jobs > 0:
+                mean_render_time = self.total_render_time / self.jobs
+            return {
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "busy": self.busy,
+                "jobs": self.jobs,
+                "failures": self.failures,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected,
+                "restarts": self.restarts,
+                "total_wait_time": round(self.total_wait_time, 3),
+                "mean_render_time": round(mean_render_time, 3),
+                "max_render_time": round(self.max_render_time, 3),
+            }
+
+
+class _RenderProcess:
+    """
+    A render process, and the pipe used to send it jobs.
+
+    """
+
+    def __init__(self, context):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=_render_main, args=(child_connection,), daemon=True
+        )
+        self.process.start()
+        child_connection.close()
+        self.ready = False
+
+    def render(self, figure_json, format_, timeout):
+        if not self.ready:
+            self._receive(timeout + STARTUP_TIMEOUT)
+            self.ready = True
+
+        try:
+            self.connection.send((figure_json, format_))
+        except (EOFError, OSError) as ex:
+            raise _RenderProcessStopped("The render process stopped") from ex
+        status, value = self._receive(timeout)
+        if status == "error":
+            raise RenderError(value)
+        return value
+
+    def _receive(self, timeout):
+        try:
+            if not self.connection.poll(timeout):
+                raise RenderTimeout(f"Image not rendered within {timeout} seconds")
+            return self.connection.recv()
+        except (EOFError, OSError) as ex:
+            raise _RenderProcessStopped("The render process stopped") from ex
+
+    def stop(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+class RenderPool:
+    """
+    A pool of processes that render figures as images.
+
+    """
+
+    def __init__(self, workers, max_queue, timeout):
+        """
+        @param workers(int): the number of render processes
+
+        @param max_queue(int): the maximum number of jobs waiting for a process
+
+        @param timeout(float): the number of seconds a job may wait for a process and
+            then the number of seconds it may take to render
+
+        """
+        self.timeout = timeout
+        self.metrics = RenderMetrics()
+        # the process the pool belongs to
+        self.pid = os.getpid()
+        self._context = multiprocessing.get_context("spawn")
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        # None stands in for a process that could not be started, it is started
+        # again by the next job to get it
+        self._idle = queue.Queue()
+        for _ in range(workers):
+            self._idle.put(_RenderProcess(self._context))
+
+    def render(self, figure_json, format_):
+        """
+        Render a figure as an image.
+
+        @param figure_json(str): the figure, as JSON
+
+        @param format_(str): "png", "svg" or "jpeg"
+
+        @return the image as bytes
+
+        @raises RenderQueueFull: if too many jobs are waiting
+
+        @raises RenderTimeout: if the job waited, or took, longer than the timeout
+
+        @raises RenderError: if the image could not be rendered
+
+        """
+        if not self._slots.acquire(blocking=False):
+            self.metrics.add("rejected")
+            raise RenderQueueFull("Too many images are waiting to be rendered")
+
+        try:
+            process = self._get_process()
+            try:
+                if process is None:
+                    process = self._start_process()
+                return self._render(process, figure_json, format_)
+            except (RenderTimeout, _RenderProcessStopped):
+                # the process is stuck or has stopped, so start a new one
+                process.stop()
+                process = None
+                self.metrics.add("restarts")
+                process = self._start_process()
+                raise
+            finally:
+                self._idle.put(process)
+        finally:
+            self._slots.release()
+
+    def _start_process(self):
+        try:
+            return _RenderProcess(self._context)
+        except OSError as ex:
+            LOG.warning("Render process not started: %s", ex)
+            raise RenderError(f"The render process could not be started: {ex}") from ex
+
+    def _get_process(self):
+        self.metrics.add("queue_depth")
+        start = time.monotonic()
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty as ex:
+            self.metrics.add("timeouts")
+            raise RenderTimeout(
+                f"No render process free within {self.timeout} seconds"
+            ) from ex
+        finally:
+            self.metrics.add("queue_depth", -1)
+            self.metrics.add("total_wait_time", time.monotonic() - start)
+
+    def _render(self, process, figure_json, format_):
+        self.metrics.add("busy")
+        start = time.monotonic()
+        try:
+            image = process.render(figure_json, format_, self.timeout)
+        except RenderTimeout:
+            self.metrics.add("timeouts")
+            LOG.warning("Render timed out after %ss", self.timeout)
+            raise
+        except RenderError as ex:
+            self.metrics.add("failures")
+            LOG.warning("Render failed: %s", ex)
+            raise
+        finally:
+            self.metrics.add("busy", -1)
+
+        self.metrics.add_render_time(time.monotonic() - start)
+        return image
+
+
+def get_render_pool():
+    """
+    Get the render pool for this process, starting it if need be.
+
+    The pool of another process, inherited by forking, is not used.
+
+    @return the render pool, or None if RENDER_POOL_WORKERS is 0
+
+    """
+    global _pool  # pylint: disable=global-statement
+
+    workers = getattr(settings, "RENDER_POOL_WORKERS", DEFAULT_WORKERS)
+    if workers < 1:
+        return None
+
+    if _pool is None or _pool.pid != os.getpid():
+        with _lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = RenderPool(
+                    workers,
+                    getattr(settings, "RENDER_POOL_QUEUE", DEFAULT_QUEUE),
+                    getattr(settings, "RENDER_POOL_TIMEOUT", DEFAULT_TIMEOUT),
+                )
+    return _pool
+
+
+def start_render_pool(**kwargs):
+    """
+    Start the render pool for this process, if it has not been started.
+
+    This is connected to the "request_started" signal by cci_data_bridge/wsgi.py and
+    asgi.py, so only the processes that serve requests start a pool. A pool that
+    cannot be started is logged, the first image tries again.
+
+    """
+    try:
+        get_render_pool()
+    except (OSError, RenderError) as ex:
+        LOG.warning("Render pool not started: %s", ex)
+
+
+def render_image(figure, format_):
+    """
+    Render a figure as an image, using the render pool if there is one.
+
+    @param figure(Figure): the plotly figure
+
+    @param format_(str): "png", "svg" or "jpeg"
+
+    @return the image as bytes
+
+    @raises RenderError: if the image could not be rendered, see RenderPool.render
+
+    """
+    pool = get_render_pool()
+    if pool is None:
+        return figure.to_image(format=format_)
+    return pool.render(figure.to_json(), format_)
+
+
+def get_render_metrics():
+    """
+    Get the metrics for the render pool, or None if there is no render pool.
+
+    """
+    if _pool is None or _pool.pid != os.getpid():
+        return None
+    return _pool.metrics.as_dict()
+
+
+def _render_main(connection):
+    # runs in the render process
+    # pylint: disable=import-outside-toplevel, broad-exception-caught
+    import plotly.io as pio
+
+    # start the image engine now, rather than on the first job
+    pio.to_image({"data": [], "layout": {}}, format="png")
+
+    result = ("ready", None)
+    while True:
+        try:
+            connection.send(result)
+            figure_json, format_ = connection.recv()
+        except (EOFError, OSError):
+            # the pool has gone
+            return
+
+        try:
+            result = ("ok", pio.to_image(pio.from_json(figure_json), format=format_))
+        except Exception as ex:
+            result = ("error", str(ex))
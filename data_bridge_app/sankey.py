@@ -0,0 +1,786 @@
+"""
+Sankey
+
+The "SankeyDiagram" draws the relationships from a set of datasets, through the
+filters on the datasets at either end, to the related datasets.
+
+All of the relationships for the datasets are loaded up front as a flat edge list,
+see "SankeyEdges", along with the relation type names and the filters of the datasets
+at both ends, in a fixed number of queries. If the datasets come from a catalogue
+snapshot, see data_bridge_app.snapshot, the edges are taken from the snapshot instead
+of the database.
+
+The nodes and links of the diagram are kept in parallel lists, indexed by node or
+link number, which are passed straight to plotly.
+
+A diagram with more than SANKEY_MAX_LINKS links is simplified, so that it stays a
+bounded size to compute, transfer and draw. First the filter chains are collapsed,
+linking the dataset URLs directly. If there are still too many links the datasets are
+grouped by provider and ECV, with one link for all of the relationships between two
+groups. Each group on the left has a drill down URL to a diagram of just the
+datasets in that group.
+
+The "SankeyIndex" lists the diagrams that can be asked for by slug, /sankey/<slug>,
+see "SankeyProject". There is one for each project, from the slugs and aliases in the
+Project table, one for each provider and one for each ECV.
+
+"""
+
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.db.models import Count
+from django.urls import reverse
+from django.utils.text import slugify
+from plotly.offline import plot
+import plotly.graph_objects as go
+
+from data_bridge_app.models import Dataset, ECV, Project, Relationship
+from data_bridge_app.serializers import ID_BATCH_SIZE
+
+SANKEY_COLOUR_1 = "rgba(230, 159, 0, 1.0)"
+SANKEY_COLOUR_2 = "rgba(86, 180, 233, 1.0)"
+SANKEY_COLOUR_3 = "rgba(0, 158, 115, 1.0)"
+SANKEY_COLOUR_4 = "rgba(240, 228, 66, 1.0)"
+SANKEY_COLOUR_5 = "rgba(0, 114, 178 , 1.0)"
+SANKEY_COLOUR_6 = "rgba(213, 94, 0, 1.0)"
+SANKEY_COLOUR_7 = "rgba(204, 121, 167, 1.0)"
+SANKEY_COLOUR_8 = "rgba(0, 0, 0, 1.0)"
+SANKEY_FADE = "0.4"
+
+# the number of links above which a diagram is simplified
+DEFAULT_MAX_LINKS = 200
+
+
+class SankeyEdges:
+    """
+    The relationships from a set of datasets, as a flat edge list.
+
+    "from_ids", "to_ids" and "names" are parallel lists with an entry for each
+    relationship, "names" holds the relation type names joined by ", ".
+
+    "urls" and "filters" map a dataset id to its URL and to its filters, as a list of
+    (name, value) in filter id order, for the datasets at both ends.
+
+    "groups" maps a dataset id to its (provider, ECV), it is only filled in by
+    "load_groups".
+
+    """
+
+    def __init__(self):
+        self.from_ids = []
+        self.to_ids = []
+        self.names = []
+        self.urls = {}
+        self.filters = {}
+        self.groups = {}
+        self.snapshot = None
+
+    @classmethod
+    def load(cls, datasets, snapshot=None):
+        """
+        Load the relationships from the datasets.
+
+        @param datasets(list): the datasets, or dataset records from the snapshot
+
+        @param snapshot(CatalogueSnapshot): the snapshot the datasets came from, if any
+
+        """
+        edges = cls()
+        edges.snapshot = snapshot
+        if snapshot is not None:
+            edges._load_from_snapshot(datasets, snapshot)
+        else:
+            edges._load(datasets)
+        return edges
+
+    def _load_from_snapshot(self, datasets, snapshot):
+        for dataset in datasets:
+            record = snapshot.datasets[dataset.id]
+            for relationship in record.relationship_set:
+                self._add_record(record)
+                self._add_record(relationship.to_dataset)
+                self.from_ids.append(record.id)
+                self.to_ids.append(relationship.to_dataset.id)
+                self.names.append(str(relationship))
+
+    def _add_record(self, record):
+        self.urls[record.id] = record.url
+        self.filters[record.id] = [
+            (filter_.name, filter_.value) for filter_ in record.filters
+        ]
+
+    def _load(self, datasets):
+        ids = []
+        urls = {}
+        for dataset in datasets:
+            ids.append(dataset.id)
+            urls[dataset.id] = dataset.url
+
+        relationships = _get_values_list(
+            Relationship.objects.order_by("from_dataset_id", "id"),
+            "from_dataset_id",
+            ids,
+            "id",
+            "from_dataset_id",
+            "to_dataset_id",
+            "to_dataset__url",
+        )
+
+        relationship_types = {}
+        through = Relationship.relationships.through
+        for relationship_id, relation_type in _get_values_list(
+            through.objects.order_by("relationship_id", "relationtype_id"),
+            "relationship_id",
+            [relationship[0] for relationship in relationships],
+            "relationship_id",
+            "relationtype_id",
+        ):
+            relationship_types.setdefault(relationship_id, []).append(relation_type)
+
+        # the relationships are in the order of the datasets they are from
+        by_dataset = {}
+        for relationship_id, from_id, to_id, to_url in relationships:
+            self.urls[from_id] = urls[from_id]
+            self.urls[to_id] = to_url
+            by_dataset.setdefault(from_id, []).append(
+                (to_id, ", ".join(relationship_types.get(relationship_id, [])))
+            )
+        for from_id in ids:
+            for to_id, name in by_dataset.get(from_id, []):
+                self.from_ids.append(from_id)
+                self.to_ids.append(to_id)
+                self.names.append(name)
+
+        through = Dataset.filters.through
+        for dataset_id, name, value in _get_values_list(
+            through.objects.order_by("dataset_id", "filter_id"),
+            "dataset_id",
+            list(self.urls.keys()),
+            "dataset_id",
+            "filter__name",
+            "filter__value",
+        ):
+            self.filters.setdefault(dataset_id, []).append((name, value))
+
+    def load_groups(self):
+        """
+        Load the provider and ECV of the datasets at both ends of the relationships.
+
+        A dataset with several ECVs is put in the group for the first one by name.
+
+        """
+        if self.snapshot is not None:
+            for dataset_id in self.urls:
+                record = self.snapshot.datasets[dataset_id]
+                self.groups[dataset_id] = (
+                    record.dataset_provider_id,
+                    min(record.ecvs, default=None),
+                )
+            return
+
+        ids = list(self.urls.keys())
+        ecvs = {}
+        for dataset_id, ecv in _get_values_list(
+            Dataset.ecvs.through.objects.all(),
+            "dataset_id",
+            ids,
+            "dataset_id",
+            "ecv_id",
+        ):
+            if dataset_id not in ecvs or ecv < ecvs[dataset_id]:
+                ecvs[dataset_id] = ecv
+        for dataset_id, provider in _get_values_list(
+            Dataset.objects.all(), "id", ids, "id", "dataset_provider_id"
+        ):
+            self.groups[dataset_id] = (provider, ecvs.get(dataset_id))
+
+    def __len__(self):
+        return len(self.from_ids)
+
+
+class SankeyDiagram:
+    """
+    Produce a Sankey diagram.
+
+    """
+
+    def __init__(
+        self, datasets, title, snapshot=None, drill_down_url=None, max_links=None
+    ):
+        """
+        @param datasets(list): the datasets, or dataset records from the snapshot
+
+        @param title(str): the title of the diagram
+
+        @param snapshot(CatalogueSnapshot): the snapshot the datasets came from, if any
+
+        @param drill_down_url(function): takes a provider and an ECV and returns the
+            URL of the diagram for that group of datasets, if this is None the
+            datasets are never grouped
+
+        @param max_links(int): the number of links above which the diagram is
+            simplified, defaults to the SANKEY_MAX_LINKS setting
+
+        """
+        self.datasets = datasets
+        self.title = title
+        self.snapshot = snapshot
+        self.drill_down_url = drill_down_url
+        if max_links is None:
+            max_links = getattr(settings, "SANKEY_MAX_LINKS", DEFAULT_MAX_LINKS)
+        self.max_links = max_links
+        self._clear()
+
+    def _clear(self):
+        # the nodes, indexed by node number, a node is a dataset, a filter or a group
+        # of datasets
+        self.node_labels = []
+        self.node_names = []
+        self.node_colours = []
+        self.node_urls = []
+        # the links, indexed by link number
+        self.source = []
+        self.target = []
+        self.value = []
+        self.link_colours = []
+        self.link_names = []
+        # the node number for a dataset URL
+        self.dataset_nodes = {}
+        # the node number for a filter following a given node
+        self.filter_nodes = {}
+        # the sorted (label, colour) of the filters for each dataset
+        self.filter_chains = {}
+        # the node number for a group on the left or the right of the diagram
+        self.group_nodes = {}
+
+    def get_figure(self):
+        """
+        Generate a figure containing the Sankey diagram.
+
+        """
+        edges = SankeyEdges.load(self.datasets, self.snapshot)
+        self._get_filter_links(edges)
+        if len(self.source) <= self.max_links:
+            return self._plot(self.title)
+
+        self._clear()
+        self._get_dataset_links(edges)
+        if len(self.source) <= self.max_links or self.drill_down_url is None:
+            return self._plot(f"{self.title} (filters not shown)")
+
+        edges.load_groups()
+        if len({edges.groups[from_id] for from_id in edges.from_ids}) < 2:
+            # this is already a single group
+            return self._plot(f"{self.title} (filters not shown)")
+
+        self._clear()
+        self._get_group_links(edges)
+        return self._plot(f"{self.title} (grouped by provider and ECV)")
+
+    def plot_div(self):
+        """
+        Generate a div containing the Sankey diagram.
+
+        """
+        fig = self.get_figure()
+
+        # Getting HTML needed to render the plot.
+        return plot(fig, output_type="div")
+
+    def _get_filter_links(self, edges):
+        faded_colour = _fade(SANKEY_COLOUR_1)
+
+        for from_id, to_id, name in zip(edges.from_ids, edges.to_ids, edges.names):
+            # this could be all datasets for a URL, all CS3 datasets or all CCI
+            # datasets
+            source_index = self._get_dataset_node(
+                edges.urls[from_id], SANKEY_COLOUR_1
+            )
+
+            # the chain of filters on the prime dataset then the related dataset
+            filter_index = source_index
+            from_chain = self._get_filter_chain(edges, from_id)
+            if len(from_chain) > 0:
+                filter_index = self._add_filters(
+                    from_chain, filter_index, faded_colour, name
+                )
+            to_chain = self._get_filter_chain(edges, to_id)
+            if len(to_chain) > 0:
+                filter_index = self._add_filters(
+                    to_chain, filter_index, faded_colour, name
+                )
+
+            # the related dataset is only coloured when there are no filters on the
+            # prime dataset
+            target_colour = SANKEY_COLOUR_1 if len(from_chain) == 0 else None
+            target_index = self._get_dataset_node(edges.urls[to_id], target_colour)
+            self._add_link(filter_index, target_index, faded_colour, name)
+
+    def _get_dataset_links(self, edges):
+        # a link for each pair of dataset URLs, without the filters
+        links = {}
+        for from_id, to_id, name in zip(edges.from_ids, edges.to_ids, edges.names):
+            key = (edges.urls[from_id], edges.urls[to_id])
+            links.setdefault(key, []).append(name)
+
+        faded_colour = _fade(SANKEY_COLOUR_1)
+        for (from_url, to_url), names in links.items():
+            source_index = self._get_dataset_node(from_url, SANKEY_COLOUR_1)
+            target_index = self._get_dataset_node(to_url)
+            self._add_link(
+                source_index, target_index, faded_colour, _get_link_name(names)
+            )
+            self.value[-1] = len(names)
+
+    def _get_group_links(self, edges):
+        # a link for each pair of groups, the groups on the left and the right are
+        # separate nodes
+        links = {}
+        members = {}
+        for from_id, to_id, name in zip(edges.from_ids, edges.to_ids, edges.names):
+            from_group = ("from", edges.groups[from_id])
+            to_group = ("to", edges.groups[to_id])
+            links.setdefault((from_group, to_group), []).append(name)
+            members.setdefault(from_group, set()).add(from_id)
+            members.setdefault(to_group, set()).add(to_id)
+
+        faded_colour = _fade(SANKEY_COLOUR_1)
+        for (from_group, to_group), names in links.items():
+            source_index = self._get_group_node(from_group, members)
+            target_index = self._get_group_node(to_group, members)
+            self._add_link(
+                source_index, target_index, faded_colour, _get_link_name(names)
+            )
+            self.value[-1] = len(names)
+
+    def _get_group_node(self, group, members):
+        """
+        Get the node number for a group of datasets, adding a node if there is not
+        one yet.
+
+        """
+        index = self.group_nodes.get(group)
+        if index is not None:
+            return index
+
+        side, (provider, ecv) = group
+        label = provider if ecv is None else f"{provider}: {ecv}"
+        node_name = f"{len(members[group])} datasets: {label}"
+        colour = None
+        url = None
+        if side == "from":
+            colour = SANKEY_COLOUR_1
+            if ecv is not None:
+                url = self.drill_down_url(provider, ecv)
+                node_name = f"{node_name}, click to view"
+
+        index = self._add_node(label, node_name, colour)
+        self.node_urls[index] = url
+        self.group_nodes[group] = index
+        return index
+
+    def _get_filter_chain(self, edges, dataset_id):
+        chain = self.filter_chains.get(dataset_id)
+        if chain is None:
+            filters = sorted(edges.filters.get(dataset_id, []), key=_filter_sorter)
+            chain = [
+                (f"{name}={value}", _get_filter_colour(name)) for name, value in filters
+            ]
+            self.filter_chains[dataset_id] = chain
+        return chain
+
+    def _add_filters(self, chain, source_index, last_colour, link_name):
+        # we need to include the filters in the diagram
+        first_index = source_index
+
+        for label, colour in chain:
+            filter_index = self._get_filter_node(label, colour, first_index)
+            self._add_link(first_index, filter_index, last_colour, link_name)
+            last_colour = _fade(colour)
+            first_index = filter_index
+
+        return first_index
+
+    def _add_link(self, source_index, target_index, colour, name):
+        self.source.append(source_index)
+        self.target.append(target_index)
+        self.value.append(1)
+        self.link_colours.append(colour)
+        self.link_names.append(name)
+
+    def _get_dataset_node(self, url, colour=None):
+        """
+        Get the node number for a dataset, adding a node if there is not one yet.
+
+        """
+        index = self.dataset_nodes.get(url)
+        if index is None:
+            index = self._add_node(url, f"Dataset: {url}", colour)
+            self.dataset_nodes[url] = index
+        return index
+
+    def _get_filter_node(self, label, colour, source_index):
+        """
+        Get the node number for a filter following the node "source_index", adding a
+        node if there is not one yet.
+
+        Each filter gets a separate node for each node that leads to it.
+
+        """
+        index = self.dataset_nodes.get(label)
+        if index is not None:
+            return index
+
+        key = (source_index, label)
+        index = self.filter_nodes.get(key)
+        if index is None:
+            index = self._add_node(label, f"Dataset filter: {label}", colour)
+            self.filter_nodes[key] = index
+        return index
+
+    def _add_node(self, label, node_name, colour):
+        self.node_labels.append(label)
+        self.node_names.append(node_name)
+        self.node_urls.append(None)
+        if colour is not None:
+            self.node_colours.append(colour)
+        else:
+            self.node_colours.append(SANKEY_COLOUR_7)
+        return len(self.node_labels) - 1
+
+    def _plot(self, title):
+        fig = go.Figure(
+            data=[
+                go.Sankey(
+                    node=dict(
+                        pad=15,
+                        thickness=20,
+                        line=dict(color="black", width=0.5),
+                        label=self.node_labels,
+                        color=self.node_colours,
+                        customdata=self.node_names,
+                        hovertemplate="%{customdata}<extra></extra>",
+                    ),
+                    link=dict(
+                        source=self.source,
+                        target=self.target,
+                        value=self.value,
+                        color=self.link_colours,
+                        customdata=self.link_names,
+                        hovertemplate="%{customdata}<extra></extra>",
+                    ),
+                )
+            ]
+        )
+
+        font_size = 11
+        if len(self.source) < 10:
+            height = 300
+        elif len(self.source) < 20:
+            height = 400
+        elif len(self.source) < 40:
+            height = 600
+        elif len(self.source) < 80:
+            height = 800
+        elif len(self.source) < 120:
+            font_size = 10
+            height = 1500
+        elif len(self.source) < 200:
+            font_size = 10
+            height = 2000
+        else:
+            font_size = 10
+            height = 3000
+
+        fig.update_layout(
+            title_text=title,
+            font_size=font_size,
+            height=height,
+        )
+        if any(url is not None for url in self.node_urls):
+            # used by sankey.js to follow a click on a node
+            fig.update_layout(meta={"drill_down": self.node_urls})
+        return fig
+
+
+class SankeyProject:
+    """
+    A set of datasets with a Sankey diagram, /sankey/<slug>, either the datasets from
+    a list of providers or the datasets for an ECV.
+
+    """
+
+    def __init__(self, slug, label, providers=None, ecv=None):
+        """
+        @param slug(str): the slug used in the URL
+
+        @param label(str): the name used in the title
+
+        @param providers(list): the names of the providers, or None
+
+        @param ecv(str): the name of the ECV, or None
+
+        """
+        self.slug = slug
+        self.label = label
+        self.providers = providers
+        self.ecv = ecv
+        self.dataset_count = 0
+
+    @property
+    def menu_name(self):
+        """
+        The name used in the menu of diagrams.
+
+        """
+        if self.providers is not None and len(self.providers) == 1:
+            return self.providers[0]
+        return self.label
+
+    def get_datasets(self, snapshot=None, provider=None, ecv=None):
+        """
+        Get the datasets, ordered by id.
+
+        @param snapshot(CatalogueSnapshot): the snapshot in use, if any
+
+        @param provider(str): only include the datasets from this provider
+
+        @param ecv(str): only include the datasets for this ECV
+
+        """
+        if snapshot is not None:
+            if self.providers is not None:
+                datasets = snapshot.for_providers(self.providers)
+            else:
+                datasets = snapshot.for_ecv(self.ecv)
+            return [
+                dataset
+                for dataset in datasets
+                if (not provider or dataset.dataset_provider_id == provider)
+                and (not ecv or ecv in dataset.ecvs)
+            ]
+
+        if self.providers is not None:
+            datasets = Dataset.objects.filter(dataset_provider__in=self.providers)
+        else:
+            datasets = Dataset.objects.filter(ecvs=self.ecv)
+        if provider:
+            datasets = datasets.filter(dataset_provider=provider)
+        if ecv:
+            datasets = datasets.filter(ecvs=ecv)
+        return datasets.order_by("id")
+
+    def get_diagram(self, snapshot=None, provider=None, ecv=None):
+        """
+        Get the Sankey diagram for the datasets.
+
+        @param snapshot(CatalogueSnapshot): the snapshot in use, if any
+
+        @param provider(str): only include the datasets from this provider
+
+        @param ecv(str): only include the datasets for this ECV
+
+        """
+        title = f"Sankey Diagram for {self.label} Datasets"
+        group = ": ".join(value for value in [provider, ecv] if value)
+        if group:
+            title = f"{title}, {group}"
+        return SankeyDiagram(
+            self.get_datasets(snapshot, provider, ecv),
+            title,
+            snapshot,
+            self.get_drill_down_url,
+        )
+
+    def get_drill_down_url(self, provider, ecv):
+        """
+        Get the URL of the diagram for a group of the datasets.
+
+        """
+        query = urlencode({"provider": provider, "ecv": ecv})
+        return f"{reverse('sankey', args=[self.slug])}?{query}"
+
+
+class SankeyIndex:
+    """
+    The Sankey diagrams that can be asked for by slug, along with the dataset URLs
+    that have a diagram.
+
+    "projects" maps a slug or alias, in lower case, to a "SankeyProject". A project
+    slug takes precedence over a provider or an ECV with the same slug.
+
+    "menu" lists the projects then the ECVs, for the menu of diagrams.
+
+    "urls" lists the dataset URLs in order, and "url_set" holds the same URLs for
+    "has_url".
+
+    "version" is the catalogue version the index was loaded for.
+
+    """
+
+    def __init__(self):
+        self.projects = {}
+        self.menu = []
+        self.urls = []
+        self.url_set = frozenset()
+        self.version = None
+
+    @classmethod
+    def load(cls, snapshot=None):
+        """
+        Load the projects, providers and ECVs that have datasets.
+
+        @param snapshot(CatalogueSnapshot): the snapshot in use, if any
+
+        """
+        index = cls()
+        if snapshot is not None:
+            provider_counts = {
+                provider: len(ids) for provider, ids in snapshot.by_provider.items()
+            }
+            ecv_counts = {ecv: len(ids) for ecv, ids in snapshot.by_ecv.items()}
+            index.urls = list(snapshot.urls)
+        else:
+            provider_counts = dict(
+                Dataset.objects.values_list("dataset_provider")
+                .annotate(count=Count("id"))
+                .order_by()
+            )
+            ecv_counts = dict(
+                Dataset.ecvs.through.objects.values_list("ecv")
+                .annotate(count=Count("dataset"))
+                .order_by()
+            )
+            index.urls = list(
+                Dataset.objects.values_list("url", flat=True).order_by("url").distinct()
+            )
+
+        index.url_set = frozenset(index.urls)
+
+        projects = {}
+        aliases = {}
+        providers = []
+        for provider in Project.objects.order_by("name"):
+            providers.append(provider.name)
+            if provider.slug:
+                project = projects.get(provider.slug)
+                if project is None:
+                    project = SankeyProject(
+                        provider.slug, provider.slug.upper(), providers=[]
+                    )
+                    projects[provider.slug] = project
+                project.providers.append(provider.name)
+                project.dataset_count += provider_counts.get(provider.name, 0)
+                for alias in provider.get_aliases():
+                    aliases[alias] = provider.slug
+
+        for slug in sorted(projects):
+            index._add(projects[slug], [slug], menu=True)
+        for alias, slug in aliases.items():
+            index._add(projects[slug], [alias])
+
+        for name in providers:
+            project = SankeyProject(slugify(name), name, providers=[name])
+            project.dataset_count = provider_counts.get(name, 0)
+            index._add(project, [project.slug])
+
+        for name in ECV.objects.order_by("name").values_list("name", flat=True):
+            project = SankeyProject(slugify(name), name, ecv=name)
+            project.dataset_count = ecv_counts.get(name, 0)
+            index._add(project, [project.slug, name], menu=True)
+
+        return index
+
+    def _add(self, project, keys, menu=False):
+        if project.dataset_count == 0:
+            return
+        added = False
+        for key in keys:
+            key = key.lower()
+            if key not in self.projects:
+                self.projects[key] = project
+                added = True
+        if menu and added:
+            self.menu.append(project)
+
+    def has_url(self, url):
+        """
+        Is there a dataset with the URL?
+
+        """
+        return url in self.url_set
+
+    def get(self, slug):
+        """
+        Get the project for a slug or an alias, or None.
+
+        """
+        return self.projects.get(slug.lower())
+
+    def get_all(self):
+        """
+        Get each of the projects, providers and ECVs once.
+
+        """
+        projects = []
+        for project in self.projects.values():
+            if project not in projects:
+                projects.append(project)
+        return projects
+
+
+def _get_filter_colour(name):
+    if name in [
+        "processinglevel",
+        "processing_level",
+        "origin",
+    ]:
+        return SANKEY_COLOUR_2
+    if name == "version":
+        return SANKEY_COLOUR_3
+    if name.startswith("sensor"):
+        return SANKEY_COLOUR_4
+    if name == "variable":
+        return SANKEY_COLOUR_5
+    if name.startswith("algorithm") or name.startswith("projection"):
+        return SANKEY_COLOUR_6
+    return SANKEY_COLOUR_7
+
+
+def _filter_sorter(filter_):
+    name = filter_[0]
+    if name == "origin":
+        return 1
+    if name in ["processinglevel", "processing_level"]:
+        return 2
+    if name == "version":
+        return 3
+    if name.startswith("sensor"):
+        return 4
+    if name == "variable":
+        return 5
+    if name.startswith("algorithm"):
+        return 6
+    if name.startswith("projection"):
+        return 7
+    return 8
+
+
+def _get_link_name(names):
+    # the relation types for one or more relationships
+    if len(names) == 1:
+        return names[0]
+    return f"{len(names)} relationships: {'; '.join(sorted(set(names)))}"
+
+
+def _fade(colour):
+    return colour.replace("1.0", SANKEY_FADE)
+
+
+def _get_values_list(queryset, field, ids, *fields):
+    results = []
+    for start in range(0, len(ids), ID_BATCH_SIZE):
+        batch = ids[start : start + ID_BATCH_SIZE]
+        results.extend(queryset.filter(**{f"{field}__in": batch}).values_list(*fields))
+    return results
@@ -0,0 +1,510 @@
+"""
+Sankey image
+
+A renderer for the Sankey diagrams that needs no browser based image engine. The
+layout of the nodes and links is computed from the figure spec, see "SankeyLayout",
+then written straight out as SVG, or drawn as a PNG or JPEG with Pillow. Pillow is
+only needed for PNG and JPEG.
+
+The layout is close to the one plotly.js uses. The nodes are put in columns by their
+distance from the first nodes, with the nodes that have no outgoing links in the last
+column. Each node is as tall as the larger of the total value of its incoming and
+outgoing links. The nodes in each column are moved towards the nodes they are linked
+to a few times, and spread out so that they do not overlap.
+
+The renderer is used for "renderer=native" on the Sankey image views, or for all
+images when SANKEY_IMAGE_RENDERER = "native".
+
+"""
+
+from html import escape
+import io
+import re
+
+from data_bridge_app.render_pool import RenderError
+
+DEFAULT_WIDTH = 1000
+DEFAULT_HEIGHT = 500
+DEFAULT_FONT_SIZE = 12
+MARGIN_LEFT = 80
+MARGIN_RIGHT = 80
+MARGIN_TOP = 100
+MARGIN_BOTTOM = 80
+# the number of times the nodes are moved towards the nodes they are linked to
+ITERATIONS = 6
+# the number of straight lines used for each curve in a PNG or JPEG
+CURVE_STEPS = 16
+# the labels in a PNG or JPEG use Pillow's bitmap font, which is much faster than a
+# scalable font, up to this font size
+BITMAP_FONT_SIZE = 12
+PNG_COMPRESS_LEVEL = 3
+LABEL_GAP = 6
+
+_NUMBER = re.compile(r"[0-9.]+")
+_NAMED_COLOURS = {
+    "black": (0, 0, 0, 1.0),
+    "white": (255, 255, 255, 1.0),
+}
+_DEFAULT_COLOUR = (128, 128, 128, 1.0)
+
+
+class SankeyNode:
+    __slots__ = (
+        "index",
+        "label",
+        "name",
+        "colour",
+        "value",
+        "depth",
+        "x0",
+        "x1",
+        "y0",
+        "y1",
+        "source_links",
+        "target_links",
+    )
+
+    def __init__(self, index, label, name, colour):
+        self.index = index
+        self.label = label
+        self.name = name
+        self.colour = colour
+        self.value = 0
+        self.depth = 0
+        self.x0 = 0.0
+        self.x1 = 0.0
+        self.y0 = 0.0
+        self.y1 = 0.0
+        # the links from and to this node
+        self.source_links = []
+        self.target_links = []
+
+    @property
+    def y_centre(self):
+        return (self.y0 + self.y1) / 2
+
+
+class SankeyLink:
+    __slots__ = ("source", "target", "value", "colour", "name", "width", "y0", "y1")
+
+    def __init__(self, source, target, value, colour, name):
+        self.source = source
+        self.target = target
+        self.value = value
+        self.colour = colour
+        self.name = name
+        self.width = 0.0
+        # the centre of the link where it leaves the source and meets the target
+        self.y0 = 0.0
+        self.y1 = 0.0
+
+
+class SankeyLayout:
+    """
+    The position of each node and link in a Sankey diagram.
+
+    """
+
+    def __init__(self, spec):
+        """
+        @param spec(dict): the figure spec, with the "data" and "layout" for plotly.js
+
+        """
+        layout = spec.get("layout", {})
+        trace = spec["data"][0]
+        node = trace.get("node", {})
+        link = trace.get("link", {})
+
+        self.width = layout.get("width") or DEFAULT_WIDTH
+        self.height = layout.get("height") or DEFAULT_HEIGHT
+        self.font_size = layout.get("font", {}).get("size") or DEFAULT_FONT_SIZE
+        self.title = (layout.get("title") or {}).get("text") or ""
+        self.padding = node.get("pad", 15)
+        self.thickness = node.get("thickness", 20)
+
+        labels = node.get("label", [])
+        self.nodes = [
+            SankeyNode(
+                index,
+                label,
+                _get_item(node.get("customdata"), index, label),
+                _get_item(node.get("color"), index, "black"),
+            )
+            for index, label in enumerate(labels)
+        ]
+
+        self.links = []
+        for index, (source, target, value) in enumerate(
+            zip(link.get("source", []), link.get("target", []), link.get("value", []))
+        ):
+            if source == target or value <= 0:
+                continue
+            self.links.append(
+                SankeyLink(
+                    self.nodes[source],
+                    self.nodes[target],
+                    value,
+                    _get_item(link.get("color"), index, "rgba(0, 0, 0, 0.2)"),
+                    _get_item(link.get("customdata"), index, ""),
+                )
+            )
+
+        for link_ in self.links:
+            link_.source.source_links.append(link_)
+            link_.target.target_links.append(link_)
+
+        # nodes without links are not drawn
+        self.nodes = [
+            node_ for node_ in self.nodes if node_.source_links or node_.target_links
+        ]
+        if len(self.nodes) > 0:
+            self._compute_values()
+            self._compute_depths()
+            self._compute_positions()
+            self._compute_link_positions()
+
+    def _compute_values(self):
+        for node in self.nodes:
+            node.value = max(
+                sum(link.value for link in node.source_links),
+                sum(link.value for link in node.target_links),
+            )
+
+    def _compute_depths(self):
+        # the longest path from a node with no incoming links, a link back to a node
+        # that has already been placed, in a cycle, is ignored
+        incoming = {node.index: len(node.target_links) for node in self.nodes}
+        placed = set()
+        remaining = list(self.nodes)
+        while len(remaining) > 0:
+            ready = [node for node in remaining if incoming[node.index] == 0]
+            if len(ready) == 0:
+                # break a cycle
+                ready = remaining[:1]
+            for node in ready:
+                placed.add(node.index)
+                for link in node.source_links:
+                    if link.target.index in placed:
+                        continue
+                    link.target.depth = max(link.target.depth, node.depth + 1)
+                    incoming[link.target.index] -= 1
+            remaining = [node for node in remaining if node.index not in placed]
+
+        self.max_depth = max(node.depth for node in self.nodes)
+        for node in self.nodes:
+            if len(node.source_links) == 0:
+                node.depth = self.max_depth
+
+    def _compute_positions(self):
+        top = MARGIN_TOP
+        bottom = self.height - MARGIN_BOTTOM
+        inner_width = self.width - MARGIN_LEFT - MARGIN_RIGHT - self.thickness
+        self.columns = [[] for _ in range(self.max_depth + 1)]
+        for node in self.nodes:
+            self.columns[node.depth].append(node)
+            node.x0 = MARGIN_LEFT + inner_width * node.depth / max(self.max_depth, 1)
+            node.x1 = node.x0 + self.thickness
+
+        # shrink the padding if a column has too many nodes to fit
+        for column in self.columns:
+            if len(column) > 1:
+                self.padding = min(
+                    self.padding, (bottom - top) / 2 / (len(column) - 1)
+                )
+
+        scale = min(
+            (bottom - top - (len(column) - 1) * self.padding)
+            / sum(node.value for node in column)
+            for column in self.columns
+            if len(column) > 0
+        )
+        for column in self.columns:
+            y = top
+            for node in column:
+                node.y0 = y
+                node.y1 = y + node.value * scale
+                y = node.y1 + self.padding
+        for link in self.links:
+            link.width = link.value * scale
+
+        alpha = 1.0
+        for _ in range(ITERATIONS):
+            alpha *= 0.99
+            for column in self.columns[1:]:
+                self._relax(column, alpha, "target_links", "source", top, bottom)
+            for column in reversed(self.columns[:-1]):
+                self._relax(column, alpha, "source_links", "target", top, bottom)
+
+    def _relax(self, column, alpha, links_name, other_name, top, bottom):
+        # move each node towards the weighted centre of the nodes it is linked to
+        for node in column:
+            links = getattr(node, links_name)
+            total = sum(link.value for link in links)
+            if total == 0:
+                continue
+            centre = (
+                sum(getattr(link, other_name).y_centre * link.value for link in links)
+                / total
+            )
+            move = (centre - node.y_centre) * alpha
+            node.y0 += move
+            node.y1 += move
+        self._resolve_collisions(column, top, bottom)
+
+    def _resolve_collisions(self, column, top, bottom):
+        column.sort(key=lambda node: node.y0)
+        # push the overlapping nodes down
+        y = top
+        for node in column:
+            move = y - node.y0
+            if move > 0:
+                node.y0 += move
+                node.y1 += move
+            y = node.y1 + self.padding
+        # then push the nodes that went past the bottom back up
+        y = bottom
+        for node in reversed(column):
+            move = node.y1 - y
+            if move > 0:
+                node.y0 -= move
+                node.y1 -= move
+            y = node.y0 - self.padding
+
+    def _compute_link_positions(self):
+        for node in self.nodes:
+            node.source_links.sort(key=lambda link: link.target.y_centre)
+            y = node.y0
+            for link in node.source_links:
+                link.y0 = y + link.width / 2
+                y += link.width
+
+            node.target_links.sort(key=lambda link: link.source.y_centre)
+            y = node.y0
+            for link in node.target_links:
+                link.y1 = y + link.width / 2
+                y += link.width
+
+    def get_label_position(self, node):
+        """
+        Get the (x, y, anchor) of a node label, labels in the right half of the
+        diagram go to the left of the node.
+
+        """
+        if node.x0 > self.width / 2:
+            return node.x0 - LABEL_GAP, node.y_centre, "end"
+        return node.x1 + LABEL_GAP, node.y_centre, "start"
+
+
+def render_sankey_image(spec, format_):
+    """
+    Render a Sankey diagram as an image.
+
+    @param spec(dict): the figure spec, with the "data" and "layout" for plotly.js
+
+    @param format_(str): "png", "svg" or "jpeg"
+
+    @return the image as bytes
+
+    @raises RenderError: if Pillow is needed and is not installed
+
+    """
+    layout = SankeyLayout(spec)
+    if format_ == "svg":
+        return render_svg(layout)
+    return render_bitmap(layout, format_)
+
+
+def render_svg(layout):
+    """
+    Write a Sankey layout as SVG.
+
+    """
+    lines = [
+        '<svg xmlns="http://www.w3.org/2000/svg" '
+        f'width="{layout.width}" height="{layout.height}" '
+        f'viewBox="0 0 {layout.width} {layout.height}" '
+        'font-family="Open Sans, verdana, arial, sans-serif" '
+        f'font-size="{layout.font_size}">',
+        f'<rect width="{layout.width}" height="{layout.height}" fill="white"/>',
+    ]
+    if layout.title:
+        lines.append(
+            f'<text x="{layout.width * 0.05:.1f}" y="{MARGIN_TOP / 2:.1f}" '
+            f'font-size="{_get_title_size(layout)}">{escape(layout.title)}</text>'
+        )
+
+    for link in layout.links:
+        lines.append(
+            f'<path d="{_get_link_path(link)}" {_get_svg_fill(link.colour)}>'
+            f"<title>{escape(str(link.name))}</title></path>"
+        )
+
+    for node in layout.nodes:
+        lines.append(
+            f'<rect x="{node.x0:.1f}" y="{node.y0:.1f}" '
+            f'width="{node.x1 - node.x0:.1f}" height="{max(node.y1 - node.y0, 1):.1f}" '
+            f'{_get_svg_fill(node.colour)} stroke="black" stroke-width="0.5">'
+            f"<title>{escape(str(node.name))}</title></rect>"
+        )
+        x, y, anchor = layout.get_label_position(node)
+        lines.append(
+            f'<text x="{x:.1f}" y="{y:.1f}" text-anchor="{anchor}" '
+            f'dominant-baseline="central">{escape(str(node.label))}</text>'
+        )
+
+    lines.append("</svg>")
+    return "\n".join(lines).encode("utf-8")
+
+
+def render_bitmap(layout, format_):
+    """
+    Draw a Sankey layout as a PNG or JPEG, with Pillow.
+
+    """
+    # pylint: disable=import-outside-toplevel
+    try:
+        from PIL import Image, ImageDraw, ImageFont
+    except ImportError as ex:
+        raise RenderError(
+            f"Pillow is needed to render {format_} images without plotly"
+        ) from ex
+
+    image = Image.new("RGB", (int(layout.width), int(layout.height)), "white")
+    draw = ImageDraw.Draw(image, "RGBA")
+    font = _get_font(ImageFont, layout.font_size)
+    label_font = font
+    if layout.font_size <= BITMAP_FONT_SIZE:
+        label_font = _get_bitmap_font(ImageFont)
+
+    if layout.title:
+        draw.text(
+            (layout.width * 0.05, MARGIN_TOP / 2),
+            layout.title,
+            fill="black",
+            font=_get_font(ImageFont, _get_title_size(layout)),
+            anchor="lm",
+        )
+
+    for link in layout.links:
+        draw.polygon(_get_link_polygon(link), fill=_get_pillow_colour(link.colour))
+
+    for node in layout.nodes:
+        draw.rectangle(
+            (node.x0, node.y0, node.x1, max(node.y1, node.y0 + 1)),
+            fill=_get_pillow_colour(node.colour),
+            outline="black",
+        )
+        x, y, anchor = layout.get_label_position(node)
+        anchor = "rm" if anchor == "end" else "lm"
+        try:
+            draw.text((x, y), str(node.label), "black", label_font, anchor)
+        except UnicodeEncodeError:
+            # the bitmap font only has the Latin-1 characters
+            draw.text((x, y), str(node.label), "black", font, anchor)
+
+    output = io.BytesIO()
+    if format_ == "jpeg":
+        image.save(output, format="JPEG")
+    else:
+        image.save(output, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return output.getvalue()
+
+
+def _get_item(values, index, default):
+    # an item from a list of per node or per link values, or a single value
+    if isinstance(values, list):
+        return values[index] if index < len(values) else default
+    if values is None:
+        return default
+    return values
+
+
+def _get_title_size(layout):
+    return round(layout.font_size * 1.5)
+
+
+def _get_font(image_font, size):
+    try:
+        return image_font.load_default(size)
+    except TypeError:
+        # Pillow before 10.1 only has a fixed size default font
+        return image_font.load_default()
+
+
+def _get_bitmap_font(image_font):
+    if hasattr(image_font, "load_default_imagefont"):
+        return image_font.load_default_imagefont()
+    # before Pillow 10.1 the default font is the bitmap font
+    return image_font.load_default()
+
+
+def _get_link_curve(link):
+    # the control points of the centre line of a link
+    x0 = link.source.x1
+    x1 = link.target.x0
+    middle = (x0 + x1) / 2
+    return x0, x1, middle
+
+
+def _get_link_path(link):
+    x0, x1, middle = _get_link_curve(link)
+    half = link.width / 2
+    return (
+        f"M{x0:.1f},{link.y0 - half:.1f}"
+        f"C{middle:.1f},{link.y0 - half:.1f} {middle:.1f},{link.y1 - half:.1f} "
+        f"{x1:.1f},{link.y1 - half:.1f}"
+        f"L{x1:.1f},{link.y1 + half:.1f}"
+        f"C{middle:.1f},{link.y1 + half:.1f} {middle:.1f},{link.y0 + half:.1f} "
+        f"{x0:.1f},{link.y0 + half:.1f}Z"
+    )
+
+
+def _get_link_polygon(link):
+    x0, x1, middle = _get_link_curve(link)
+    half = link.width / 2
+    top = _get_bezier(x0, link.y0 - half, middle, x1, link.y1 - half)
+    bottom = _get_bezier(x0, link.y0 + half, middle, x1, link.y1 + half)
+    return top + list(reversed(bottom))
+
+
+def _get_bezier(x0, y0, middle, x1, y1):
+    # points along a cubic Bezier curve with control points (middle, y0), (middle, y1)
+    points = []
+    for step in range(CURVE_STEPS + 1):
+        t = step / CURVE_STEPS
+        u = 1 - t
+        x = u**3 * x0 + 3 * u**2 * t * middle + 3 * u * t**2 * middle + t**3 * x1
+        y = u**3 * y0 + 3 * u**2 * t * y0 + 3 * u * t**2 * y1 + t**3 * y1
+        points.append((x, y))
+    return points
+
+
+def _parse_colour(colour):
+    # "rgba(r, g, b, a)", "rgb(r, g, b)", "#rrggbb" or a few named colours
+    colour = str(colour).strip().lower()
+    if colour in _NAMED_COLOURS:
+        return _NAMED_COLOURS[colour]
+    if colour.startswith("#") and len(colour) == 7:
+        return (
+            int(colour[1:3], 16),
+            int(colour[3:5], 16),
+            int(colour[5:7], 16),
+            1.0,
+        )
+    if colour.startswith("rgb"):
+        values = [float(value) for value in _NUMBER.findall(colour)]
+        if len(values) == 3:
+            values.append(1.0)
+        if len(values) == 4:
+            return (int(values[0]), int(values[1]), int(values[2]), values[3])
+    return _DEFAULT_COLOUR
+
+
+def _get_svg_fill(colour):
+    red, green, blue, alpha = _parse_colour(colour)
+    return f'fill="rgb({red},{green},{blue})" fill-opacity="{alpha:g}"'
+
+
+def _get_pillow_colour(colour):
+    red, green, blue, alpha = _parse_colour(colour)
+    return (red, green, blue, round(alpha * 255))
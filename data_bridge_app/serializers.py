@@ -0,0 +1,314 @@
+"""
+Serializers
+
+The "DatasetSerializer" turns a page of datasets into the structures returned by the
+JSON API. All of the rows needed for the page, the ECVs, filters, relationships,
+relation types and related datasets, are loaded in a fixed number of bulk queries
+rather than several queries per dataset.
+
+Optionally the inbound relationships, from other datasets to the datasets in the
+page, are included as well.
+
+If the datasets come from a catalogue snapshot, see data_bridge_app.snapshot, the
+rows are taken from the snapshot instead of the database.
+
+"""
+
+from data_bridge_app.models import Dataset, Relationship
+
+# maximum number of ids to put in a single "IN" clause
+ID_BATCH_SIZE = 500
+
+# number of datasets to fetch from the database at a time when streaming
+STREAM_BATCH_SIZE = 500
+
+
+class DatasetSerializer:
+    """
+    Serialize datasets, along with their outgoing relationships.
+
+    """
+
+    def __init__(self, datasets, include_inbound=False, snapshot=None):
+        self.datasets = list(datasets)
+        self.include_inbound = include_inbound
+        self.snapshot = snapshot
+        self.ecvs = {}
+        self.filters = {}
+        self.relationships = {}
+        self.inbound_relationships = {}
+        self.relationship_types = {}
+        self.related_datasets = {}
+
+    def data(self):
+        """
+        Returns a list of objects that will be serialized as JSON by json.dumps().
+
+        """
+        if self.snapshot is None:
+            self._load()
+        else:
+            self._load_from_snapshot()
+        return [self._get_j_data(dataset) for dataset in self.datasets]
+
+    def _load_from_snapshot(self):
+        records = [self.snapshot.datasets[dataset.id] for dataset in self.datasets]
+        related = {}
+        for record in records:
+            self.relationships[record.id] = [
+                _get_relationship_values(rel) for rel in record.relationship_set
+            ]
+            for rel in record.relationship_set:
+                related[rel.to_dataset.id] = rel.to_dataset
+                self.relationship_types[rel.id] = [t.name for t in rel.relationships]
+
+            if self.include_inbound:
+                self.inbound_relationships[record.id] = [
+                    _get_relationship_values(rel) for rel in record.linked_dataset
+                ]
+                for rel in record.linked_dataset:
+                    related[rel.from_dataset.id] = rel.from_dataset
+                    self.relationship_types[rel.id] = [
+                        t.name for t in rel.relationships
+                    ]
+
+        for related_ds in related.values():
+            self.related_datasets[related_ds.id] = {
+                "id": related_ds.id,
+                "url": related_ds.url,
+                "start_date": related_ds.start_date,
+                "end_date": related_ds.end_date,
+                "dataset_provider_id": related_ds.dataset_provider_id,
+            }
+
+        for record in records + list(related.values()):
+            self.filters[record.id] = [{f.name: f.value} for f in record.filters]
+            self.ecvs[record.id] = list(record.ecvs)
+
+    def _load(self):
+        ids = [dataset.id for dataset in self.datasets]
+
+        relationships = _bulk_values(
+            Relationship.objects.order_by("from_dataset_id", "id"),
+            "from_dataset_id",
+            ids,
+            "id",
+            "from_dataset_id",
+            "to_dataset_id",
+            "description",
+        )
+        for relationship in relationships:
+            self.relationships.setdefault(relationship["from_dataset_id"], []).append(
+                relationship
+            )
+        related_ids = {relationship["to_dataset_id"] for relationship in relationships}
+
+        if self.include_inbound:
+            inbound_relationships = _bulk_values(
+                Relationship.objects.order_by("to_dataset_id", "id"),
+                "to_dataset_id",
+                ids,
+                "id",
+                "from_dataset_id",
+                "to_dataset_id",
+                "description",
+            )
+            for relationship in inbound_relationships:
+                self.inbound_relationships.setdefault(
+                    relationship["to_dataset_id"], []
+                ).append(relationship)
+            relationships = relationships + inbound_relationships
+            related_ids.update(
+                relationship["from_dataset_id"] for relationship in inbound_relationships
+            )
+
+        relationship_ids = list({relationship["id"] for relationship in relationships})
+        through = Relationship.relationships.through
+        for relationship_id, relation_type in _bulk_values_list(
+            through.objects.order_by("relationship_id", "relationtype_id"),
+            "relationship_id",
+            relationship_ids,
+            "relationship_id",
+            "relationtype_id",
+        ):
+            self.relationship_types.setdefault(relationship_id, []).append(
+                relation_type
+            )
+
+        for related_ds in _bulk_values(
+            Dataset.objects.all(),
+            "id",
+            list(related_ids),
+            "id",
+            "url",
+            "start_date",
+            "end_date",
+            "dataset_provider_id",
+        ):
+            self.related_datasets[related_ds["id"]] = related_ds
+
+        through = Dataset.filters.through
+        for dataset_id, name, value in _bulk_values_list(
+            through.objects.order_by("dataset_id", "filter_id"),
+            "dataset_id",
+            list(related_ids.union(ids)),
+            "dataset_id",
+            "filter__name",
+            "filter__value",
+        ):
+            self.filters.setdefault(dataset_id, []).append({name: value})
+
+        through = Dataset.ecvs.through
+        for dataset_id, ecv in _bulk_values_list(
+            through.objects.order_by("dataset_id", "ecv_id"),
+            "dataset_id",
+            ids,
+            "dataset_id",
+            "ecv_id",
+        ):
+            self.ecvs.setdefault(dataset_id, []).append(ecv)
+
+    def _get_j_data(self, dataset):
+        data = {}
+        data["url"] = dataset.url
+        data["dataset_provider"] = dataset.dataset_provider_id
+
+        ecvs = self.ecvs.get(dataset.id, [])
+        if len(ecvs) > 0:
+            data["ecvs"] = list(ecvs)
+
+        filters = self.filters.get(dataset.id, [])
+        if len(filters) > 0:
+            data["filters"] = list(filters)
+
+        combined_relationships = {}
+        for rel in self.relationships.get(dataset.id, []):
+            related_ds = self.related_datasets[rel["to_dataset_id"]]
+            rel_name = ", ".join(self.relationship_types.get(rel["id"], []))
+
+            # do we have an entry for this dataset id?
+            if related_ds["id"] in combined_relationships.keys():
+                # add to existing data
+                combined_relationships[related_ds["id"]]["relationship_types"].append(
+                    rel_name
+                )
+            else:
+                # generate new relationship
+                relationship = {
+                    "relationship_types": [rel_name],
+                    "related_dataset": related_ds["url"],
+                }
+
+                if related_ds["start_date"] is not None:
+                    relationship["related_dataset_start_date"] = related_ds[
+                        "start_date"
+                    ]
+
+                if related_ds["end_date"] is not None:
+                    relationship["related_dataset_end_date"] = related_ds["end_date"]
+
+                relationship["related_dataset_provider"] = related_ds[
+                    "dataset_provider_id"
+                ]
+                relationship["description"] = rel["description"]
+                combined_relationships[related_ds["id"]] = relationship
+
+            # as before, the filters are added to the most recently created entry
+            filters = self.filters.get(related_ds["id"], [])
+            if len(filters) > 0:
+                relationship["filters"] = list(filters)
+
+        data["relationships"] = list(combined_relationships.values())
+
+        if self.include_inbound:
+            data["inbound_relationships"] = self._get_inbound_j_data(dataset)
+
+        return data
+
+    def _get_inbound_j_data(self, dataset):
+        combined_relationships = {}
+        for rel in self.inbound_relationships.get(dataset.id, []):
+            related_ds = self.related_datasets[rel["from_dataset_id"]]
+            rel_name = ", ".join(self.relationship_types.get(rel["id"], []))
+
+            # do we have an entry for this dataset id?
+            relationship = combined_relationships.get(related_ds["id"])
+            if relationship is not None:
+                relationship["relationship_types"].append(rel_name)
+                continue
+
+            relationship = {
+                "relationship_types": [rel_name],
+                "related_dataset": related_ds["url"],
+            }
+
+            if related_ds["start_date"] is not None:
+                relationship["related_dataset_start_date"] = related_ds["start_date"]
+
+            if related_ds["end_date"] is not None:
+                relationship["related_dataset_end_date"] = related_ds["end_date"]
+
+            relationship["related_dataset_provider"] = related_ds["dataset_provider_id"]
+            relationship["description"] = rel["description"]
+
+            filters = self.filters.get(related_ds["id"], [])
+            if len(filters) > 0:
+                relationship["filters"] = list(filters)
+
+            combined_relationships[related_ds["id"]] = relationship
+
+        return list(combined_relationships.values())
+
+
+def iter_serialized_datasets(
+    datasets, include_inbound=False, snapshot=None, batch_size=STREAM_BATCH_SIZE
+):
+    """
+    Yield the serialized datasets one at a time.
+
+    The datasets are read from the database in batches of "batch_size", so only one
+    batch is held in memory at a time.
+
+    """
+    if hasattr(datasets, "iterator"):
+        datasets = datasets.iterator(chunk_size=batch_size)
+
+    batch = []
+    for dataset in datasets:
+        batch.append(dataset)
+        if len(batch) == batch_size:
+            yield from DatasetSerializer(batch, include_inbound, snapshot).data()
+            batch = []
+
+    if len(batch) > 0:
+        yield from DatasetSerializer(batch, include_inbound, snapshot).data()
+
+
+def _get_relationship_values(relationship):
+    return {
+        "id": relationship.id,
+        "from_dataset_id": relationship.from_dataset_id,
+        "to_dataset_id": relationship.to_dataset_id,
+        "description": relationship.description,
+    }
+
+
+def _bulk_values(queryset, field, ids, *fields):
+    results = []
+    for batch in _batches(ids):
+        results.extend(queryset.filter(**{f"{field}__in": batch}).values(*fields))
+    return results
+
+
+def _bulk_values_list(queryset, field, ids, *fields):
+    results = []
+    for batch in _batches(ids):
+        results.extend(
+            queryset.filter(**{f"{field}__in": batch}).values_list(*fields)
+        )
+    return results
+
+
+def _batches(ids):
+    for start in range(0, len(ids), ID_BATCH_SIZE):
+        yield ids[start : start + ID_BATCH_SIZE]
@@ -0,0 +1,47 @@
+"""
+Signals
+
+Keep the "filter_signature" of a dataset up to date when its filters change, either
+by adding or removing filters from the dataset or by editing or deleting a filter.
+
+"""
+
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from data_bridge_app.models import Dataset, Filter, update_filter_signatures
+
+
+@receiver(m2m_changed, sender=Dataset.filters.through)
+def dataset_filters_changed(sender, instance, action, reverse, pk_set, using, **kwargs):
+    if action == "pre_clear" and reverse:
+        # the datasets will not be known after the filter has been cleared
+        instance._filter_dataset_ids = list(instance.filter.values_list("id", flat=True))
+        return
+
+    if action not in ["post_add", "post_remove", "post_clear"]:
+        return
+
+    if not reverse:
+        update_filter_signatures([instance.id], using)
+    elif action == "post_clear":
+        update_filter_signatures(instance._filter_dataset_ids, using)
+    else:
+        update_filter_signatures(pk_set, using)
+
+
+@receiver(post_save, sender=Filter)
+def filter_saved(sender, instance, created, using, **kwargs):
+    if not created:
+        update_filter_signatures(instance.filter.values_list("id", flat=True), using)
+
+
+@receiver(pre_delete, sender=Filter)
+def filter_deleting(sender, instance, **kwargs):
+    # the datasets will not be known after the filter has been deleted
+    instance._filter_dataset_ids = list(instance.filter.values_list("id", flat=True))
+
+
+@receiver(post_delete, sender=Filter)
+def filter_deleted(sender, instance, using, **kwargs):
+    update_filter_signatures(instance._filter_dataset_ids, using)
@@ -0,0 +1,454 @@
+"""
+Snapshot
+
+The catalogue only changes when it is imported, so the read views can be answered
+from a read-only, in-process snapshot of it rather than from the database.
+
+The snapshot holds compact, __slots__ based records for the datasets, filters,
+relation types and relationships, along with indexes by url, provider, ECV, filter
+and filter signature. The records have the same attribute names as the models, and
+"filters.all" etc. work on them, so they can be passed to the templates, the
+serializer and the Sankey diagram in place of model instances.
+
+The snapshot is loaded once per process, in a fixed number of queries in one
+transaction, and is reloaded when the catalogue version changes. The version is only checked every
+CATALOGUE_SNAPSHOT_CHECK_INTERVAL seconds, so in between the read views make no
+database queries at all.
+
+If there is a compiled catalogue, see data_bridge_app.compiled, the snapshot is
+loaded from it rather than from the database, and its version is the version of the
+compiled catalogue. The records are still copied out of the file, so each worker has
+its own snapshot.
+
+Set CATALOGUE_SNAPSHOT = True in the settings to use the snapshot.
+
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from data_bridge_app.compiled import get_compiled_catalogue
+from data_bridge_app.models import (
+    Dataset,
+    ECV,
+    Filter,
+    RelationType,
+    Relationship,
+    get_catalogue_version,
+    get_filter_signature,
+    parse_filters,
+)
+
+DEFAULT_CHECK_INTERVAL = 10
+
+# the number of times to load the snapshot if an import changes the catalogue
+LOAD_ATTEMPTS = 3
+
+_lock = threading.Lock()
+_snapshot = None
+_last_check = None
+
+
+class RelatedList(tuple):
+    """
+    A tuple that can stand in for a related manager, it supports "all()".
+
+    """
+
+    __slots__ = ()
+
+    def all(self):
+        return self
+
+
+class FilterRecord:
+    __slots__ = ("id", "name", "value")
+
+    def __init__(self, id_, name, value):
+        self.id = id_
+        self.name = name
+        self.value = value
+
+    def __str__(self):
+        return f"{self.name}={self.value}"
+
+
+class RelationTypeRecord:
+    __slots__ = ("name", "description")
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+
+    def __str__(self):
+        return self.name
+
+
+class DatasetRecord:
+    __slots__ = (
+        "id",
+        "url",
+        "dataset_provider_id",
+        "start_date",
+        "end_date",
+        "filter_signature",
+        "ecvs",
+        "filters",
+        "relationship_set",
+        "linked_dataset",
+    )
+
+    def __init__(self, id_, url, provider, start_date, end_date, filter_signature):
+        self.id = id_
+        self.url = url
+        self.dataset_provider_id = provider
+        self.start_date = start_date
+        self.end_date = end_date
+        self.filter_signature = filter_signature
+        self.ecvs = RelatedList()
+        self.filters = RelatedList()
+        # the outgoing and incoming relationships
+        self.relationship_set = RelatedList()
+        self.linked_dataset = RelatedList()
+
+    @property
+    def pk(self):
+        return self.id
+
+    @property
+    def dataset_provider(self):
+        # the project name is its primary key
+        return self.dataset_provider_id
+
+    def __str__(self):
+        return self.url
+
+
+class RelationshipRecord:
+    __slots__ = ("id", "from_dataset", "to_dataset", "description", "relationships")
+
+    def __init__(self, id_, from_dataset, to_dataset, description, relationships):
+        self.id = id_
+        self.from_dataset = from_dataset
+        self.to_dataset = to_dataset
+        self.description = description
+        self.relationships = relationships
+
+    @property
+    def from_dataset_id(self):
+        return self.from_dataset.id
+
+    @property
+    def to_dataset_id(self):
+        return self.to_dataset.id
+
+    def __str__(self):
+        return ", ".join(relation_type.name for relation_type in self.relationships)
+
+
+class CatalogueSnapshot:
+    """
+    A read-only copy of the catalogue along with indexes into it.
+
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.datasets = {}
+        self.ecv_names = []
+        # the datasets ordered by (url, id)
+        self.ordered = []
+        self.urls = []
+        self.by_url = {}
+        self.by_provider = {}
+        self.by_ecv = {}
+        self.by_filter = {}
+        self.by_signature = {}
+
+    @classmethod
+    def load(cls, compiled=None):
+        """
+        Load a snapshot of the catalogue.
+
+        The snapshot is loaded from the database in one transaction, and the
+        catalogue version is read before and after it. If an import changed the
+        version in between, as it can where each query sees the latest committed
+        data, the load is tried again. If it keeps changing the snapshot has the
+        version from before the last load, so it is reloaded at the next check.
+
+        @param compiled(CompiledCatalogue): the compiled catalogue to load the
+            snapshot from, by default it is loaded from the database
+
+        """
+        if compiled is not None:
+            snapshot = cls(compiled.version)
+            snapshot._load_compiled(compiled)
+            return snapshot
+
+        for _ in range(LOAD_ATTEMPTS):
+            with transaction.atomic():
+                version = get_catalogue_version()
+                snapshot = cls(version)
+                snapshot._load()
+                if get_catalogue_version() == version:
+                    break
+        return snapshot
+
+    def _load(self):
+        for values in Dataset.objects.order_by("id").values_list(
+            "id",
+            "url",
+            "dataset_provider_id",
+            "start_date",
+            "end_date",
+            "filter_signature",
+        ):
+            self.datasets[values[0]] = DatasetRecord(*values)
+
+        ecvs = {}
+        for dataset_id, ecv in Dataset.ecvs.through.objects.order_by(
+            "dataset_id", "ecv_id"
+        ).values_list("dataset_id", "ecv_id"):
+            ecvs.setdefault(dataset_id, []).append(ecv)
+        self.ecv_names = list(
+            ECV.objects.order_by("name").values_list("name", flat=True)
+        )
+
+        filters = {}
+        for id_, name, value in Filter.objects.values_list("id", "name", "value"):
+            filters[id_] = FilterRecord(id_, name, value)
+        dataset_filters = {}
+        for dataset_id, filter_id in Dataset.filters.through.objects.order_by(
+            "dataset_id", "filter_id"
+        ).values_list("dataset_id", "filter_id"):
+            if filter_id in filters:
+                dataset_filters.setdefault(dataset_id, []).append(filters[filter_id])
+
+        relation_types = {}
+        for name, description in RelationType.objects.values_list(
+            "name", "description"
+        ):
+            relation_types[name] = RelationTypeRecord(name, description)
+        relationship_types = {}
+        through = Relationship.relationships.through
+        for relationship_id, name in through.objects.order_by(
+            "relationship_id", "relationtype_id"
+        ).values_list("relationship_id", "relationtype_id"):
+            if name in relation_types:
+                relationship_types.setdefault(relationship_id, []).append(
+                    relation_types[name]
+                )
+
+        outgoing = {}
+        incoming = {}
+        for id_, from_id, to_id, description in Relationship.objects.order_by(
+            "id"
+        ).values_list("id", "from_dataset_id", "to_dataset_id", "description"):
+            if from_id not in self.datasets or to_id not in self.datasets:
+                # an import is running, the next version will be complete
+                continue
+            relationship = RelationshipRecord(
+                id_,
+                self.datasets[from_id],
+                self.datasets[to_id],
+                description,
+                RelatedList(relationship_types.get(id_, [])),
+            )
+            outgoing.setdefault(from_id, []).append(relationship)
+            incoming.setdefault(to_id, []).append(relationship)
+
+        for dataset in self.datasets.values():
+            dataset.ecvs = RelatedList(ecvs.get(dataset.id, []))
+            dataset.filters = RelatedList(dataset_filters.get(dataset.id, []))
+            dataset.relationship_set = RelatedList(outgoing.get(dataset.id, []))
+            dataset.linked_dataset = RelatedList(incoming.get(dataset.id, []))
+        self._index_all()
+
+    def _load_compiled(self, compiled):
+        records = []
+        for index, id_ in enumerate(compiled.dataset_ids):
+            record = DatasetRecord(
+                id_,
+                compiled.get_url(index),
+                compiled.get_provider(index),
+                compiled.get_start_date(index),
+                compiled.get_end_date(index),
+                compiled.string(compiled.dataset_signatures[index]),
+            )
+            record.ecvs = RelatedList(compiled.get_ecvs(index))
+            records.append(record)
+            self.datasets[id_] = record
+        self.ecv_names = [compiled.string(name) for name in compiled.ecv_names]
+
+        filters = [
+            FilterRecord(id_, compiled.string(name), compiled.string(value))
+            for id_, name, value in zip(
+                compiled.filter_ids, compiled.filter_names, compiled.filter_values
+            )
+        ]
+        relation_types = [
+            RelationTypeRecord(compiled.string(name), compiled.string(description))
+            for name, description in zip(
+                compiled.relation_type_names, compiled.relation_type_descriptions
+            )
+        ]
+        relationships = [
+            RelationshipRecord(
+                id_,
+                records[compiled.edge_from[edge]],
+                records[compiled.edge_to[edge]],
+                compiled.string(compiled.edge_descriptions[edge]),
+                RelatedList(
+                    relation_types[index] for index in compiled.get_type_indexes(edge)
+                ),
+            )
+            for edge, id_ in enumerate(compiled.edge_ids)
+        ]
+
+        for index, record in enumerate(records):
+            record.filters = RelatedList(
+                filters[filter_] for filter_ in compiled.get_filter_indexes(index)
+            )
+            record.relationship_set = RelatedList(
+                relationships[edge] for edge in compiled.get_out_edges(index)
+            )
+            record.linked_dataset = RelatedList(
+                relationships[edge] for edge in compiled.get_in_edges(index)
+            )
+        self._index_all()
+
+    def _index_all(self):
+        for dataset in self.datasets.values():
+            self._index(dataset)
+
+        self.ordered = sorted(self.datasets.values(), key=_get_key)
+        self.urls = sorted(self.by_url.keys())
+
+    def _index(self, dataset):
+        self.by_url.setdefault(dataset.url, []).append(dataset)
+        self.by_provider.setdefault(dataset.dataset_provider_id, set()).add(dataset.id)
+        for ecv in dataset.ecvs:
+            self.by_ecv.setdefault(ecv, set()).add(dataset.id)
+        for filter_ in dataset.filters:
+            self.by_filter.setdefault((filter_.name, filter_.value), set()).add(
+                dataset.id
+            )
+        self.by_signature.setdefault(dataset.filter_signature, set()).add(dataset.id)
+
+    def get_queryset(
+        self, url=None, filters=None, provider=None, ecv=None, filters_match="exact"
+    ):
+        """
+        Get the datasets that match the given parameters, ordered by (url, id).
+
+        This takes the same parameters as data_bridge_app.views.get_queryset.
+
+        @raises ValueError: if the filters or filters_match are not valid
+
+        """
+        ids = None
+        if url is not None and url != "":
+            ids = {dataset.id for dataset in self.by_url.get(url, [])}
+
+        if provider is not None and provider != "":
+            ids = _intersect(ids, self.by_provider.get(provider, set()))
+
+        if ecv is not None and ecv != "":
+            ids = _intersect(ids, self.by_ecv.get(ecv, set()))
+
+        if filters is not None and filters != "" and filters != "*":
+            filters = parse_filters(filters.split(","))
+            ids = _intersect(ids, self._match_filters(filters, filters_match))
+
+        if ids is None:
+            return list(self.ordered)
+        return sorted((self.datasets[id_] for id_ in ids), key=_get_key)
+
+    def _match_filters(self, filters, filters_match):
+        if filters_match == "exact":
+            return self.by_signature.get(get_filter_signature(filters), set())
+
+        matches = [self.by_filter.get(filter_, set()) for filter_ in set(filters)]
+        if filters_match == "all":
+            return set.intersection(*matches)
+        if filters_match == "any":
+            return set.union(*matches)
+        if filters_match == "subset":
+            filters = set(filters)
+            return {
+                dataset.id
+                for dataset in self.datasets.values()
+                if all((f.name, f.value) in filters for f in dataset.filters)
+            }
+
+        raise ValueError(f"Invalid filters_match {filters_match}")
+
+    def for_providers(self, providers):
+        """
+        Get the datasets for any of the given providers, ordered by id.
+
+        """
+        ids = set()
+        for provider in providers:
+            ids.update(self.by_provider.get(provider, set()))
+        return [self.datasets[id_] for id_ in sorted(ids)]
+
+    def for_ecv(self, ecv):
+        """
+        Get the datasets for an ECV, ordered by id.
+
+        """
+        return [self.datasets[id_] for id_ in sorted(self.by_ecv.get(ecv, set()))]
+
+    def for_url(self, url):
+        """
+        Get the datasets for a URL, ordered by id.
+
+        """
+        return list(self.by_url.get(url, []))
+
+
+def get_catalogue_snapshot():
+    """
+    Get the snapshot of the catalogue for this process.
+
+    @return the snapshot, or None if CATALOGUE_SNAPSHOT is not enabled
+
+    """
+    global _snapshot, _last_check  # pylint: disable=global-statement
+
+    if not getattr(settings, "CATALOGUE_SNAPSHOT", False):
+        return None
+
+    interval = getattr(
+        settings, "CATALOGUE_SNAPSHOT_CHECK_INTERVAL", DEFAULT_CHECK_INTERVAL
+    )
+    now = time.monotonic()
+    if _snapshot is not None and now - _last_check < interval:
+        return _snapshot
+
+    with _lock:
+        if _snapshot is None or now - _last_check >= interval:
+            compiled = get_compiled_catalogue()
+            if compiled is not None:
+                version = compiled.version
+            else:
+                version = get_catalogue_version()
+            if _snapshot is None or _snapshot.version != version:
+                _snapshot = CatalogueSnapshot.load(compiled)
+            _last_check = now
+
+    return _snapshot
+
+
+def _get_key(dataset):
+    return (dataset.url, dataset.id)
+
+
+def _intersect(ids, other):
+    if ids is None:
+        return set(other)
+    return ids & other
@@ -0,0 +1,172 @@
+"""
+Sources
+
+The workbook to import can be given as a URL, by default the IMPORT_SOURCE_URL
+setting. Downloads are kept in IMPORT_CACHE_DIR, each under the SHA-256 hash of its
+content, and are revalidated with the ETag and Last-Modified headers of the previous
+download, so an unchanged workbook is not downloaded again.
+
+The cache decides which file is imported, so it must only be writable by the user
+running the import. By default it is in the project directory, not in the shared
+temporary directory, and it is created readable by that user alone.
+
+The hash of the workbook is stored with the catalogue version it was imported into,
+see CatalogueVersion.source_hash, so import_spreadsheet can tell that a workbook has
+already been imported without reading it.
+
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from urllib.parse import urlparse
+
+from django.conf import settings
+
+DEFAULT_CACHE_DIR = "import_cache"
+DEFAULT_EXTENSION = ".xlsx"
+TIMEOUT = 60
+
+# the ETag, Last-Modified header and hash of the last download from each URL
+_INDEX = "sources.json"
+_CHUNK_SIZE = 1024 * 1024
+
+
+class SourceError(Exception):
+    """
+    A source could not be downloaded.
+
+    """
+
+
+def is_url(source):
+    """
+    Is the source an HTTP(S) URL rather than a file?
+
+    """
+    return urlparse(source).scheme in ["http", "https"]
+
+
+def get_file_hash(path):
+    """
+    Get the SHA-256 hash of the content of a file, as hex.
+
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file_:
+        for chunk in iter(lambda: file_.read(_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def fetch_source(url, cache_dir=None):
+    """
+    Get a local copy of a source, downloading it if it has changed.
+
+    @param url(str): the URL of the source
+
+    @param cache_dir(str): the directory to keep the downloads in, by default the
+        IMPORT_CACHE_DIR setting
+
+    @return the path of the local copy and the SHA-256 hash of its content
+
+    @raises SourceError: if the source could not be downloaded
+
+    """
+    # pylint: disable=import-outside-toplevel
+    import requests
+
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    extension = os.path.splitext(urlparse(url).path)[1] or DEFAULT_EXTENSION
+
+    index = _read_index(cache_dir)
+    entry = index.get(url)
+    headers = {}
+    if entry is not None and os.path.exists(
+        _get_path(cache_dir, entry["sha256"], extension)
+    ):
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    else:
+        entry = None
+
+    try:
+        with requests.get(url, headers=headers, timeout=TIMEOUT, stream=True) as resp:
+            if resp.status_code == 304 and entry is not None:
+                return _get_path(cache_dir, entry["sha256"], extension), entry["sha256"]
+            if resp.status_code != 200:
+                raise SourceError(f"Could not download {url}, {resp.status_code}")
+            sha256 = _download(resp, cache_dir, extension)
+    except requests.RequestException as ex:
+        raise SourceError(f"Could not download {url}, {ex}") from ex
+
+    index[url] = {
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "sha256": sha256,
+    }
+    _write_index(cache_dir, index)
+    if entry is not None and entry["sha256"] != sha256:
+        _remove_unused(cache_dir, index, entry["sha256"], extension)
+    return _get_path(cache_dir, sha256, extension), sha256
+
+
+def get_cache_dir():
+    """
+    Get the directory that downloads are kept in, by default "import_cache" in the
+    project directory.
+
+    """
+    return getattr(settings, "IMPORT_CACHE_DIR", None) or os.path.join(
+        settings.BASE_DIR, DEFAULT_CACHE_DIR
+    )
+
+
+def _download(response, cache_dir, extension):
+    # save the response under the hash of its content, returning the hash
+    sha256 = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as file_:
+        try:
+            for chunk in response.iter_content(_CHUNK_SIZE):
+                sha256.update(chunk)
+                file_.write(chunk)
+        except BaseException:
+            file_.close()
+            os.remove(file_.name)
+            raise
+    os.replace(file_.name, _get_path(cache_dir, sha256.hexdigest(), extension))
+    return sha256.hexdigest()
+
+
+def _get_path(cache_dir, sha256, extension):
+    return os.path.join(cache_dir, f"{sha256}{extension}")
+
+
+def _read_index(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, _INDEX), encoding="utf-8") as file_:
+            return json.load(file_)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _write_index(cache_dir, index):
+    with tempfile.NamedTemporaryFile(
+        "w", dir=cache_dir, delete=False, encoding="utf-8"
+    ) as file_:
+        json.dump(index, file_, indent=2)
+    os.replace(file_.name, os.path.join(cache_dir, _INDEX))
+
+
+def _remove_unused(cache_dir, index, sha256, extension):
+    # remove a download that no URL refers to any more
+    if all(entry["sha256"] != sha256 for entry in index.values()):
+        try:
+            os.remove(_get_path(cache_dir, sha256, extension))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,209 @@
+"""
+Staging
+
+An import can be built in a staging copy of the database rather than in the live
+database, see the --staging option of import_spreadsheet. The staging copy is
+validated, see "validate_database", and then "switch_database" renames it over the
+live database. The rename is atomic, so readers see the old catalogue until the switch
+and the new one after it, never an empty or partial catalogue. The web workers open
+the database for each request, so they use the new file from their next request.
+
+The live database is kept as the previous database, and "rollback_database", see the
+rollback_import command, switches back to it.
+
+Only SQLite databases are supported, and not in WAL mode, where the database is more
+than one file.
+
+"""
+
+import os
+import sqlite3
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from data_bridge_app.models import (
+    CatalogueVersion,
+    Dataset,
+    get_catalogue_version,
+    get_filter_signature,
+)
+
+STAGING_ALIAS = "staging"
+PREVIOUS_ALIAS = "previous"
+
+
+class StagingError(Exception):
+    """
+    The database can not be staged, switched or rolled back.
+
+    """
+
+
+def get_database_paths(using=DEFAULT_DB_ALIAS):
+    """
+    Get the paths of the live, staging and previous database files.
+
+    @param using(str): the alias of the live database
+
+    @raises StagingError: if the database is not an SQLite file
+
+    """
+    settings_dict = connections[using].settings_dict
+    if settings_dict["ENGINE"] != "django.db.backends.sqlite3":
+        raise StagingError("Staging is only supported for SQLite databases")
+    live = str(settings_dict["NAME"])
+    if live == ":memory:" or live.startswith("file:"):
+        raise StagingError("Staging is only supported for SQLite database files")
+    return live, f"{live}.staging", f"{live}.previous"
+
+
+def create_staging_database(using=DEFAULT_DB_ALIAS):
+    """
+    Copy the live database to the staging database.
+
+    @param using(str): the alias of the live database
+
+    @return the alias of the staging database
+
+    @raises StagingError: if the database can not be staged
+
+    """
+    _, staging, _ = get_database_paths(using)
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA journal_mode")
+        if cursor.fetchone()[0].lower() == "wal":
+            raise StagingError("Staging is not supported for databases in WAL mode")
+
+    _remove(staging)
+    target = sqlite3.connect(staging)
+    try:
+        # a consistent copy, even if the live database is written to meanwhile
+        connection.connection.backup(target)
+    finally:
+        target.close()
+    return _add_connection(STAGING_ALIAS, staging, using)
+
+
+def discard_staging_database(using=DEFAULT_DB_ALIAS):
+    """
+    Delete the staging database, leaving the live database as it is.
+
+    @param using(str): the alias of the live database
+
+    """
+    _, staging, _ = get_database_paths(using)
+    _remove_connection(STAGING_ALIAS)
+    _remove(staging)
+
+
+def validate_database(using):
+    """
+    Check that a database holds a usable catalogue.
+
+    @param using(str): the alias of the database
+
+    @return a list of the problems found, empty if there are none
+
+    """
+    problems = []
+    with connections[using].cursor() as cursor:
+        cursor.execute("PRAGMA integrity_check")
+        result = [row[0] for row in cursor.fetchall()]
+        if result != ["ok"]:
+            problems.append(f"The integrity check failed: {', '.join(result[:5])}")
+        cursor.execute("PRAGMA foreign_key_check")
+        broken = cursor.fetchall()
+        if len(broken) > 0:
+            problems.append(f"{len(broken)} rows have broken foreign keys")
+
+    if not Dataset.objects.using(using).exists():
+        problems.append("The catalogue is empty")
+
+    # the signatures are not kept up to date by the signals during an import
+    filters = {}
+    rows = Dataset.filters.through.objects.using(using)
+    for dataset_id, name, value in rows.values_list(
+        "dataset_id", "filter__name", "filter__value"
+    ):
+        filters.setdefault(dataset_id, []).append((name, value))
+    mismatched = 0
+    rows = Dataset.objects.using(using)
+    for dataset_id, signature in rows.values_list("id", "filter_signature"):
+        if signature != get_filter_signature(filters.get(dataset_id, [])):
+            mismatched += 1
+    if mismatched > 0:
+        problems.append(f"{mismatched} datasets have the wrong filter signature")
+
+    return problems
+
+
+def switch_database(using=DEFAULT_DB_ALIAS):
+    """
+    Replace the live database with the staging database, keeping the live database
+    as the previous database.
+
+    @param using(str): the alias of the live database
+
+    """
+    live, staging, previous = get_database_paths(using)
+    _remove_connection(STAGING_ALIAS)
+    connections[using].close()
+
+    # the live path always refers to a complete database
+    _remove(previous)
+    os.link(live, previous)
+    os.replace(staging, live)
+
+
+def rollback_database(using=DEFAULT_DB_ALIAS):
+    """
+    Replace the live database with the previous database.
+
+    The previous database is given a new catalogue version, after the version being
+    rolled back, so that nothing cached for the rolled back version is used.
+
+    @param using(str): the alias of the live database
+
+    @return the new CatalogueVersion
+
+    @raises StagingError: if there is no previous database
+
+    """
+    live, _, previous = get_database_paths(using)
+    if not os.path.exists(previous):
+        raise StagingError(f"There is no previous database, {previous}")
+
+    alias = _add_connection(PREVIOUS_ALIAS, previous, using)
+    try:
+        version_id = max(get_catalogue_version(using), get_catalogue_version(alias))
+        version = CatalogueVersion.objects.using(alias).create(id=version_id + 1)
+    finally:
+        _remove_connection(alias)
+
+    connections[using].close()
+    os.replace(previous, live)
+    return version
+
+
+def _add_connection(alias, path, using):
+    # add a connection to the database file, with the settings of the live database
+    _remove_connection(alias)
+    settings_dict = dict(connections[using].settings_dict)
+    settings_dict["NAME"] = path
+    connections.settings[alias] = settings_dict
+    return alias
+
+
+def _remove_connection(alias):
+    if alias in connections.settings:
+        connections[alias].close()
+        del connections[alias]
+        del connections.settings[alias]
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -1,3 +1,2003 @@
-from django.test import TestCase
+import contextlib
+import csv
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from urllib.parse import quote
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, connections
+from django.test import SimpleTestCase, TestCase, override_settings
+from openpyxl import Workbook, load_workbook
+import plotly.graph_objects as go
+
+from cci_data_bridge.management.commands import import_spreadsheet
+from cci_data_bridge.management.commands.import_spreadsheet import read_catalogue
+
+from data_bridge_app.importer import (
+    ImportCatalogue,
+    update_catalogue,
+    write_catalogue,
+)
+from data_bridge_app.models import (
+    ECV,
+    EMPTY_FILTER_SIGNATURE,
+    CatalogueVersion,
+    Dataset,
+    Filter,
+    Project,
+    RelationType,
+    Relationship,
+    get_catalogue_source_hash,
+    get_catalogue_version,
+    get_filter_signature,
+    parse_filters,
+)
+from data_bridge_app import cache, render_pool, sankey, sankey_image
+from data_bridge_app.compiled import CompiledCatalogue, compile_catalogue
+from data_bridge_app.graph import PathSearchLimitExceeded
+from data_bridge_app.render_pool import (
+    RenderError,
+    RenderPool,
+    RenderQueueFull,
+    RenderTimeout,
+)
+from data_bridge_app.sankey import SankeyDiagram, SankeyEdges
+from data_bridge_app.serializers import DatasetSerializer, iter_serialized_datasets
+from data_bridge_app.snapshot import CatalogueSnapshot
+from data_bridge_app.sources import fetch_source, get_cache_dir, get_file_hash
+from data_bridge_app.staging import (
+    PREVIOUS_ALIAS,
+    STAGING_ALIAS,
+    StagingError,
+    create_staging_database,
+    discard_staging_database,
+    get_database_paths,
+    rollback_database,
+    switch_database,
+    validate_database,
+)
+from data_bridge_app.views import SCRIPT_ESCAPES, get_queryset
+
+
+def get_baseline_data(dataset):
+    # the JSON for a dataset as it was before the bulk serializer, one or more
+    # queries per dataset, relationship and related dataset
+    data = {}
+    data["url"] = dataset.url
+    data["dataset_provider"] = dataset.dataset_provider_id
+
+    ecvs = []
+    for ecv in dataset.ecvs.values("name"):
+        ecvs.append(ecv["name"])
+    if len(ecvs) > 0:
+        data["ecvs"] = ecvs
+
+    filters = []
+    for filter_ in dataset.filters.all():
+        filters.append({filter_.name: filter_.value})
+    if len(filters) > 0:
+        data["filters"] = filters
+
+    combiened_relationships = {}
+    for rel in Relationship.objects.filter(from_dataset=dataset):
+        if rel.to_dataset.id in combiened_relationships.keys():
+            combiened_relationships[rel.to_dataset.id]["relationship_types"].append(
+                str(rel)
+            )
+        else:
+            relationship = {
+                "relationship_types": [str(rel)],
+                "related_dataset": str(rel.to_dataset),
+            }
+            if rel.to_dataset.start_date is not None:
+                relationship["related_dataset_start_date"] = rel.to_dataset.start_date
+            if rel.to_dataset.end_date is not None:
+                relationship["related_dataset_end_date"] = rel.to_dataset.end_date
+            relationship["related_dataset_provider"] = (
+                rel.to_dataset.dataset_provider.name
+            )
+            relationship["description"] = rel.description
+            combiened_relationships[rel.to_dataset.id] = relationship
+
+        filters = []
+        for filter_ in rel.to_dataset.filters.all():
+            filters.append({filter_.name: filter_.value})
+        if len(filters) > 0:
+            relationship["filters"] = filters
+
+    data["relationships"] = list(combiened_relationships.values())
+    return data
+
+
+class SerializerTestCase(TestCase):
+    def setUp(self):
+        provider = Project.objects.create(name="CCI Open Data Portal", slug="cci")
+        ozone = ECV.objects.create(name="Ozone")
+        cloud = ECV.objects.create(name="Cloud")
+        derived = RelationType.objects.create(name="is derived from")
+        version = RelationType.objects.create(name="is a version of")
+        filters = [
+            Filter.objects.create(name=name, value=value)
+            for name, value in [("version", "1.0"), ("sensor", "ATSR"), ("drs", "a")]
+        ]
+
+        self.datasets = []
+        for number in range(4):
+            dataset = Dataset.objects.create(
+                url=f"https://example.com/{number}",
+                dataset_provider=provider,
+                start_date=datetime.date(2000 + number, 1, 1) if number else None,
+                end_date=datetime.date(2010, 1, 1),
+            )
+            dataset.ecvs.add(cloud, ozone)
+            dataset.filters.add(*filters[number % 3 :])
+            self.datasets.append(dataset)
+
+        # the first dataset is related to the second twice, with the third in
+        # between, so the filters of the second go on the entry of the third
+        first, second, third, fourth = self.datasets
+        for from_dataset, to_dataset, relation_types, description in [
+            (first, second, [derived], "The first"),
+            (first, third, [derived, version], ""),
+            (first, second, [version], "The second"),
+            (second, first, [version], ""),
+            (third, fourth, [derived], ""),
+            (fourth, first, [derived], "Back"),
+        ]:
+            relationship = Relationship.objects.create(
+                from_dataset=from_dataset,
+                to_dataset=to_dataset,
+                description=description,
+            )
+            relationship.relationships.add(*relation_types)
+
+
+class DatasetSerializerTest(SerializerTestCase):
+    def dumps(self, data):
+        return json.dumps(data, cls=DjangoJSONEncoder)
+
+    def test_baseline(self):
+        expected = self.dumps([get_baseline_data(dataset) for dataset in self.datasets])
+        self.assertEqual(self.dumps(DatasetSerializer(self.datasets).data()), expected)
+        snapshot = CatalogueSnapshot.load()
+        self.assertEqual(
+            self.dumps(DatasetSerializer(self.datasets, snapshot=snapshot).data()),
+            expected,
+        )
+
+    def test_quirk(self):
+        data = DatasetSerializer(self.datasets[:1]).data()[0]
+        second, third = data["relationships"]
+        self.assertEqual(
+            second["relationship_types"], ["is derived from", "is a version of"]
+        )
+        self.assertEqual(third["filters"], [{"sensor": "ATSR"}, {"drs": "a"}])
+
+    def test_queries(self):
+        # relationships, relation types, related datasets, filters and ECVs
+        for datasets in [self.datasets[:1], self.datasets]:
+            with self.assertNumQueries(5):
+                DatasetSerializer(datasets).data()
+
+
+class DatasetListStreamTest(SerializerTestCase):
+    def get_stream(self, params):
+        response = self.client.get("/dataset/", params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content).decode()
+
+    def get_page(self, params):
+        # the same datasets without streaming
+        response = self.client.get("/dataset/", {**params, "limit": 100})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.streaming)
+        return response
+
+    def test_json(self):
+        for params in [{"format": "json"}, {"format": "json", "url": "none"}]:
+            content = self.get_stream(params)
+            self.assertEqual(
+                json.loads(content), self.get_page(params).json()["results"]
+            )
+        self.assertEqual(content, "[]")
+
+    def test_ndjson(self):
+        for params in [{"format": "ndjson"}, {"format": "ndjson", "url": "none"}]:
+            content = self.get_stream(params)
+            self.assertEqual(content, self.get_page(params).content.decode())
+            self.assertEqual(
+                [json.loads(line) for line in content.splitlines()],
+                self.get_page({**params, "format": "json"}).json()["results"],
+            )
+        self.assertEqual(content, "")
+
+    def test_batches(self):
+        # a batch of 3 then a batch of 1
+        datasets = Dataset.objects.order_by("url", "id")
+        self.assertEqual(
+            list(iter_serialized_datasets(datasets, batch_size=3)),
+            DatasetSerializer(datasets).data(),
+        )
+
+
+class DatasetListPaginationTest(TestCase):
+    def setUp(self):
+        provider = Project.objects.create(name="CCI Open Data Portal", slug="cci")
+        for number in range(3):
+            Dataset.objects.create(
+                url=f"https://example.com/{number}", dataset_provider=provider
+            )
+
+    def test_page(self):
+        response = self.client.get("/dataset/", {"format": "json", "limit": 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["results"]), 2)
+
+    def test_bad_cursor(self):
+        response = self.client.get("/dataset/", {"format": "json", "cursor": "bad"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_bad_limit(self):
+        for limit in ["0", "-1", "ten"]:
+            response = self.client.get("/dataset/", {"format": "json", "limit": limit})
+            self.assertEqual(response.status_code, 400)
+
+
+class FilterSignatureTest(TestCase):
+    def setUp(self):
+        provider = Project.objects.create(name="CCI Open Data Portal", slug="cci")
+        self.dataset = Dataset.objects.create(
+            url="https://example.com/1", dataset_provider=provider
+        )
+        self.version = Filter.objects.create(name="version", value="1.0")
+        self.sensor = Filter.objects.create(name="sensor", value="ATSR")
+
+    def assertSignature(self, filters):
+        self.dataset.refresh_from_db()
+        self.assertEqual(
+            self.dataset.filter_signature, get_filter_signature(parse_filters(filters))
+        )
+
+    def test_new_dataset(self):
+        self.assertSignature([])
+        self.assertEqual(self.dataset.filter_signature, EMPTY_FILTER_SIGNATURE)
+
+    def test_add(self):
+        self.dataset.filters.add(self.version, self.sensor)
+        self.assertSignature(["version=1.0", "sensor=ATSR"])
+
+    def test_remove(self):
+        self.dataset.filters.add(self.version, self.sensor)
+        self.dataset.filters.remove(self.sensor)
+        self.assertSignature(["version=1.0"])
+
+    def test_clear(self):
+        self.dataset.filters.add(self.version, self.sensor)
+        self.dataset.filters.clear()
+        self.assertSignature([])
+
+    def test_reverse_add_remove_clear(self):
+        self.version.filter.add(self.dataset)
+        self.assertSignature(["version=1.0"])
+        self.sensor.filter.add(self.dataset)
+        self.assertSignature(["version=1.0", "sensor=ATSR"])
+        self.version.filter.remove(self.dataset)
+        self.assertSignature(["sensor=ATSR"])
+        self.sensor.filter.clear()
+        self.assertSignature([])
+
+    def test_filter_save(self):
+        self.dataset.filters.add(self.version)
+        self.version.value = "2.0"
+        self.version.save()
+        self.assertSignature(["version=2.0"])
+
+    def test_filter_delete(self):
+        self.dataset.filters.add(self.version, self.sensor)
+        self.sensor.delete()
+        self.assertSignature(["version=1.0"])
+
+    def test_order(self):
+        other = Dataset.objects.create(
+            url="https://example.com/2", dataset_provider=self.dataset.dataset_provider
+        )
+        self.dataset.filters.add(self.version, self.sensor)
+        other.filters.add(self.sensor)
+        other.filters.add(self.version)
+        other.refresh_from_db()
+        self.dataset.refresh_from_db()
+        self.assertEqual(other.filter_signature, self.dataset.filter_signature)
+
+
+class FiltersMatchTest(TestCase):
+    FILTERS = [[], ["a=1"], ["a=1", "b=2"], ["b=2"], ["a=1", "c=3"]]
+
+    EXPECTED = {
+        "exact": [2],
+        "all": [2],
+        "any": [1, 2, 3, 4],
+        "subset": [0, 1, 2, 3],
+    }
+
+    def setUp(self):
+        provider = Project.objects.create(name="CCI Open Data Portal", slug="cci")
+        filters = {}
+        self.urls = []
+        for number, dataset_filters in enumerate(self.FILTERS):
+            dataset = Dataset.objects.create(
+                url=f"https://example.com/{number}", dataset_provider=provider
+            )
+            for filter_ in dataset_filters:
+                name, value = filter_.split("=")
+                if filter_ not in filters:
+                    filters[filter_] = Filter.objects.create(name=name, value=value)
+                dataset.filters.add(filters[filter_])
+            self.urls.append(dataset.url)
+
+    def get_expected(self, filters_match):
+        return [self.urls[number] for number in self.EXPECTED[filters_match]]
+
+    def test_queryset(self):
+        for filters_match in self.EXPECTED:
+            datasets = get_queryset(filters="b=2,a=1", filters_match=filters_match)
+            self.assertEqual(
+                sorted(dataset.url for dataset in datasets),
+                self.get_expected(filters_match),
+                filters_match,
+            )
+
+    def test_snapshot(self):
+        snapshot = CatalogueSnapshot.load()
+        for filters_match in self.EXPECTED:
+            datasets = snapshot.get_queryset(
+                filters="b=2,a=1", filters_match=filters_match
+            )
+            self.assertEqual(
+                [dataset.url for dataset in datasets],
+                self.get_expected(filters_match),
+                filters_match,
+            )
+
+    def test_no_filters(self):
+        self.assertEqual(len(get_queryset(filters="*", filters_match="all")), 5)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            get_queryset(filters="a=1", filters_match="some")
+        with self.assertRaises(ValueError):
+            CatalogueSnapshot.load().get_queryset(filters="a=1", filters_match="some")
+
+    def test_view(self):
+        response = self.client.get(
+            "/dataset/",
+            {"format": "json", "limit": 10, "filters": "a=1", "filters_match": "any"},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["results"]), 3)
+
+        for params in [{"filters": "a=1", "filters_match": "some"}, {"filters": "a"}]:
+            response = self.client.get("/dataset/", {"format": "json", **params})
+            self.assertEqual(response.status_code, 400)
+
+
+class InboundRelationshipsTest(SerializerTestCase):
+    def get_expected(self):
+        # the relationships to the first dataset
+        entries = []
+        for number, relation_type, description, filters in [
+            (1, "is a version of", "", [{"sensor": "ATSR"}, {"drs": "a"}]),
+            (
+                3,
+                "is derived from",
+                "Back",
+                [{"version": "1.0"}, {"sensor": "ATSR"}, {"drs": "a"}],
+            ),
+        ]:
+            entries.append(
+                {
+                    "relationship_types": [relation_type],
+                    "related_dataset": f"https://example.com/{number}",
+                    "related_dataset_start_date": f"200{number}-01-01",
+                    "related_dataset_end_date": "2010-01-01",
+                    "related_dataset_provider": "CCI Open Data Portal",
+                    "description": description,
+                    "filters": filters,
+                }
+            )
+        return entries
+
+    def get_json(self, path, **params):
+        response = self.client.get(path, {"format": "json", **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_not_requested(self):
+        data = self.get_json(f"/dataset/{self.datasets[0].id}")
+        self.assertNotIn("inbound_relationships", data)
+        data = self.get_json("/dataset/", limit=10)
+        for dataset in data["results"]:
+            self.assertNotIn("inbound_relationships", dataset)
+
+    def test_detail(self):
+        data = self.get_json(f"/dataset/{self.datasets[0].id}", include="inbound")
+        self.assertEqual(data["inbound_relationships"], self.get_expected())
+        # the outbound relationships are unchanged
+        self.assertEqual(
+            data["relationships"],
+            self.get_json(f"/dataset/{self.datasets[0].id}")["relationships"],
+        )
+
+    def test_list(self):
+        data = self.get_json("/dataset/", limit=10, include="inbound")
+        self.assertEqual(
+            data["results"][0]["inbound_relationships"], self.get_expected()
+        )
+        # the two relationships from the first dataset to the second are combined
+        inbound = data["results"][1]["inbound_relationships"]
+        self.assertEqual(len(inbound), 1)
+        self.assertEqual(
+            inbound[0]["relationship_types"], ["is derived from", "is a version of"]
+        )
+
+    def test_snapshot(self):
+        snapshot = CatalogueSnapshot.load()
+        self.assertEqual(
+            DatasetSerializer(self.datasets, True, snapshot).data(),
+            DatasetSerializer(self.datasets, True).data(),
+        )
+
+
+class CatalogueSnapshotTest(SerializerTestCase):
+    def test_load(self):
+        snapshot = CatalogueSnapshot.load()
+        self.assertEqual(snapshot.version, get_catalogue_version())
+        self.assertEqual(
+            [dataset.url for dataset in snapshot.ordered],
+            [dataset.url for dataset in self.datasets],
+        )
+
+    def test_import_during_load(self):
+        # the version changes during the first load, so it is loaded again
+        with mock.patch(
+            "data_bridge_app.snapshot.get_catalogue_version", side_effect=[1, 2, 2, 2]
+        ) as get_version:
+            snapshot = CatalogueSnapshot.load()
+        self.assertEqual(get_version.call_count, 4)
+        self.assertEqual(snapshot.version, 2)
+
+    def test_import_during_every_load(self):
+        # the snapshot has an old version, so it is reloaded at the next check
+        with mock.patch(
+            "data_bridge_app.snapshot.get_catalogue_version", side_effect=range(1, 7)
+        ):
+            snapshot = CatalogueSnapshot.load()
+        self.assertEqual(snapshot.version, 5)
+
+
+class CompiledCatalogueTest(SerializerTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "catalogue.bin")
+
+    def test_compile(self):
+        compile_catalogue(self.path, 7)
+        compiled = CompiledCatalogue(self.path)
+        self.assertEqual(compiled.version, 7)
+        self.assertEqual(
+            list(compiled.dataset_ids), [dataset.id for dataset in self.datasets]
+        )
+        self.assertEqual(compiled.find_url("https://example.com/2"), [2])
+        self.assertEqual(
+            DatasetSerializer(
+                self.datasets, True, CatalogueSnapshot.load(compiled)
+            ).data(),
+            DatasetSerializer(self.datasets, True).data(),
+        )
+
+    def test_synced_before_rename(self):
+        calls = []
+        with (
+            mock.patch("os.fsync", side_effect=lambda fd: calls.append("fsync")),
+            mock.patch("os.replace", side_effect=lambda *args: calls.append("replace")),
+        ):
+            compile_catalogue(self.path)
+        # the file, then the directory
+        self.assertEqual(calls, ["fsync", "replace", "fsync"])
+
+
+class BaselineSankeyDiagram:
+    # the nodes and links of a Sankey diagram as they were before the edge list,
+    # several queries per relationship
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.last_id = -1
+        self.nodes = {}
+        self.node_names = {}
+        self.duplicates = {}
+        self.links = {}
+        self.node_colours = {}
+        self.link_colours = []
+        self.link_names = []
+
+    def get_data(self):
+        source, target, value = self._get_filter_links()
+        ivd = {v: k for k, v in self.nodes.items()}
+        ivd.update(self.duplicates)
+        keys = sorted(ivd.keys())
+        return {
+            "label": [ivd[key] for key in keys],
+            "node_colour": [self.node_colours[key] for key in keys],
+            "node_name": [self.node_names[key] for key in keys],
+            "source": source,
+            "target": target,
+            "value": value,
+            "link_colour": self.link_colours,
+            "link_name": self.link_names,
+        }
+
+    def _get_filter_links(self):
+        source = []
+        target = []
+        value = []
+        for dataset in self.datasets:
+            for relationship in dataset.relationship_set.all():
+                source_index = self._get_index(
+                    dataset.url, f"Dataset: {dataset}", sankey.SANKEY_COLOUR_1
+                )
+                last_colour = sankey.SANKEY_COLOUR_1.replace("1.0", sankey.SANKEY_FADE)
+                related_ds = relationship.to_dataset
+                if len(dataset.filters.all()) == 0:
+                    if len(related_ds.filters.all()) > 0:
+                        filter_index = self._add_filters(
+                            related_ds,
+                            source_index,
+                            source,
+                            target,
+                            value,
+                            last_colour,
+                            relationship,
+                        )
+                    else:
+                        filter_index = source_index
+                    target_index = self._get_index(
+                        related_ds.url, f"Dataset: {related_ds}", sankey.SANKEY_COLOUR_1
+                    )
+                else:
+                    primary_filter_index = self._add_filters(
+                        dataset,
+                        source_index,
+                        source,
+                        target,
+                        value,
+                        last_colour,
+                        relationship,
+                    )
+                    if len(related_ds.filters.all()) > 0:
+                        filter_index = self._add_filters(
+                            related_ds,
+                            primary_filter_index,
+                            source,
+                            target,
+                            value,
+                            last_colour,
+                            relationship,
+                        )
+                    else:
+                        filter_index = primary_filter_index
+                    target_index = self._get_index(
+                        related_ds.url, f"Dataset: {related_ds}"
+                    )
+                source.append(filter_index)
+                target.append(target_index)
+                value.append(1)
+                self.link_colours.append(last_colour)
+                self.link_names.append(str(relationship))
+        return source, target, value
+
+    def _add_filters(
+        self, dataset, source_index, source, target, value, last_colour, relationship
+    ):
+        first_index = source_index
+        filters = list(dataset.filters.all())
+        filters.sort(key=get_baseline_filter_order)
+        for filter_ in filters:
+            if filter_.name in ["processinglevel", "processing_level", "origin"]:
+                colour = sankey.SANKEY_COLOUR_2
+            elif filter_.name == "version":
+                colour = sankey.SANKEY_COLOUR_3
+            elif filter_.name.startswith("sensor"):
+                colour = sankey.SANKEY_COLOUR_4
+            elif filter_.name == "variable":
+                colour = sankey.SANKEY_COLOUR_5
+            elif filter_.name.startswith("algorithm") or filter_.name.startswith(
+                "projection"
+            ):
+                colour = sankey.SANKEY_COLOUR_6
+            else:
+                colour = sankey.SANKEY_COLOUR_7
+            filter_index = self._get_index(
+                str(filter_), f"Dataset filter: {filter_}", colour, first_index
+            )
+            source.append(first_index)
+            target.append(filter_index)
+            value.append(1)
+            self.link_colours.append(last_colour)
+            last_colour = colour.replace("1.0", sankey.SANKEY_FADE)
+            self.link_names.append(str(relationship))
+            first_index = filter_index
+        return first_index
+
+    def _get_index(self, value, node_name, colour=None, source_entity=None):
+        id_ = self.nodes.get(value)
+        if id_ is not None:
+            return id_
+        if source_entity is not None:
+            id_ = self.links.get(f"{source_entity}-{value}")
+            if id_ is not None:
+                return id_
+        self.last_id += 1
+        self.node_names[self.last_id] = node_name
+        if source_entity is not None:
+            self.duplicates[self.last_id] = value
+            self.links[f"{source_entity}-{value}"] = self.last_id
+        else:
+            self.nodes[value] = self.last_id
+        self.node_colours[self.last_id] = colour or sankey.SANKEY_COLOUR_7
+        return self.last_id
+
+
+def get_baseline_filter_order(filter_):
+    if filter_.name == "origin":
+        return 1
+    if filter_.name in ["processinglevel", "processing_level"]:
+        return 2
+    if filter_.name == "version":
+        return 3
+    if filter_.name.startswith("sensor"):
+        return 4
+    if filter_.name == "variable":
+        return 5
+    if filter_.name.startswith("algorithm"):
+        return 6
+    if filter_.name.startswith("projection"):
+        return 7
+    return 8
+
+
+class SankeyEdgesTest(SerializerTestCase):
+    def setUp(self):
+        super().setUp()
+        # a dataset without filters, related both ways
+        provider = self.datasets[0].dataset_provider
+        derived = RelationType.objects.get(name="is derived from")
+        dataset = Dataset.objects.create(
+            url="https://example.com/4", dataset_provider=provider
+        )
+        for from_dataset, to_dataset in [
+            (dataset, self.datasets[1]),
+            (self.datasets[2], dataset),
+            (dataset, self.datasets[0]),
+        ]:
+            relationship = Relationship.objects.create(
+                from_dataset=from_dataset, to_dataset=to_dataset
+            )
+            relationship.relationships.add(derived)
+        self.datasets.append(dataset)
+
+    def get_data(self, datasets, snapshot=None):
+        diagram = SankeyDiagram(datasets, "Title", snapshot)
+        figure = diagram.get_figure()
+        node = figure.data[0].node
+        link = figure.data[0].link
+        return {
+            "label": list(node.label),
+            "node_colour": list(node.color),
+            "node_name": list(node.customdata),
+            "source": list(link.source),
+            "target": list(link.target),
+            "value": list(link.value),
+            "link_colour": list(link.color),
+            "link_name": list(link.customdata),
+        }
+
+    def test_baseline(self):
+        snapshot = CatalogueSnapshot.load()
+        for datasets in [self.datasets, self.datasets[::-1], self.datasets[4:]]:
+            expected = BaselineSankeyDiagram(datasets).get_data()
+            self.assertEqual(self.get_data(datasets), expected)
+            records = [snapshot.datasets[dataset.id] for dataset in datasets]
+            self.assertEqual(self.get_data(records, snapshot), expected)
+
+    def test_queries(self):
+        # relationships, relation types and filters
+        for datasets in [self.datasets[:1], self.datasets]:
+            with self.assertNumQueries(3):
+                SankeyEdges.load(datasets)
+
+
+class SankeyMaxLinksTest(TestCase):
+    def setUp(self):
+        caches["sankey"].clear()
+        cache._sankey_index = None
+        self.addCleanup(caches["sankey"].clear)
+
+        ozone = ECV.objects.create(name="Ozone")
+        derived = RelationType.objects.create(name="is derived from")
+        filters = [
+            Filter.objects.create(name=name, value=value)
+            for name, value in [("version", "1.0"), ("sensor", "ATSR")]
+        ]
+        self.datasets = {}
+        for provider_name in ["A", "B"]:
+            provider = Project.objects.create(name=provider_name)
+            for number in range(1, 3):
+                name = f"{provider_name.lower()}{number}"
+                dataset = Dataset.objects.create(
+                    url=f"https://example.com/{name}", dataset_provider=provider
+                )
+                dataset.ecvs.add(ozone)
+                dataset.filters.add(*filters)
+                self.datasets[name] = dataset
+
+        for from_name, to_name in [
+            ("a1", "b1"),
+            ("a2", "b2"),
+            ("b1", "a1"),
+            ("a1", "b2"),
+        ]:
+            relationship = Relationship.objects.create(
+                from_dataset=self.datasets[from_name],
+                to_dataset=self.datasets[to_name],
+            )
+            relationship.relationships.add(derived)
+
+    def get_figure(self, max_links, drill_down_url=None):
+        diagram = SankeyDiagram(
+            Dataset.objects.order_by("id"), "Title", None, drill_down_url, max_links
+        )
+        return diagram.get_figure()
+
+    def get_drill_down_url(self, provider, ecv):
+        return f"/drill-down/{provider}/{ecv}"
+
+    def test_full(self):
+        # each relationship goes through the two filters at either end
+        figure = self.get_figure(20, self.get_drill_down_url)
+        self.assertEqual(figure.layout.title.text, "Title")
+        self.assertEqual(len(figure.data[0].link.source), 20)
+        self.assertIsNone(figure.layout.meta)
+
+    def test_without_filters(self):
+        figure = self.get_figure(4, self.get_drill_down_url)
+        self.assertEqual(figure.layout.title.text, "Title (filters not shown)")
+        self.assertEqual(len(figure.data[0].link.source), 4)
+        self.assertEqual(len(figure.data[0].node.label), 4)
+        self.assertEqual(list(figure.data[0].link.value), [1, 1, 1, 1])
+
+    def test_without_drill_down(self):
+        # the datasets are only grouped if the groups can be drilled into
+        figure = self.get_figure(3)
+        self.assertEqual(figure.layout.title.text, "Title (filters not shown)")
+        self.assertEqual(len(figure.data[0].link.source), 4)
+
+    def test_grouped(self):
+        figure = self.get_figure(3, self.get_drill_down_url)
+        self.assertEqual(
+            figure.layout.title.text, "Title (grouped by provider and ECV)"
+        )
+        node = figure.data[0].node
+        link = figure.data[0].link
+        # the groups on the left and the right are separate nodes
+        self.assertEqual(
+            list(node.label), ["A: Ozone", "B: Ozone", "B: Ozone", "A: Ozone"]
+        )
+        self.assertEqual(list(link.source), [0, 2])
+        self.assertEqual(list(link.target), [1, 3])
+        self.assertEqual(list(link.value), [3, 1])
+        # only the groups on the left can be drilled into
+        self.assertEqual(
+            figure.layout.meta["drill_down"],
+            ["/drill-down/A/Ozone", None, "/drill-down/B/Ozone", None],
+        )
+
+    def test_view(self):
+        with override_settings(SANKEY_MAX_LINKS=3):
+            response = self.client.get("/sankey/ozone", {"format": "json"})
+            self.assertEqual(response.status_code, 200)
+            spec = json.loads(response.content)
+            self.assertEqual(
+                spec["layout"]["title"]["text"],
+                "Sankey Diagram for Ozone Datasets (grouped by provider and ECV)",
+            )
+            drill_down_url = spec["layout"]["meta"]["drill_down"][0]
+            self.assertEqual(drill_down_url, "/sankey/ozone?provider=A&ecv=Ozone")
+
+            # the diagram for the group has one from-group, so it is not grouped
+            response = self.client.get(f"{drill_down_url}&format=json")
+            self.assertEqual(response.status_code, 200)
+            spec = json.loads(response.content)
+            self.assertEqual(
+                spec["layout"]["title"]["text"],
+                "Sankey Diagram for Ozone Datasets, A: Ozone (filters not shown)",
+            )
+            self.assertEqual(len(spec["data"][0]["link"]["source"]), 3)
+
+
+class DatasetGraphViewTest(SerializerTestCase):
+    def test_graph(self):
+        response = self.client.get(
+            f"/dataset/{self.datasets[2].id}/graph", {"depth": 1}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["nodes"]), 2)
+
+    def test_bad_parameters(self):
+        for params in [{"depth": "one"}, {"depth": -1}, {"direction": "up"}]:
+            response = self.client.get(f"/dataset/{self.datasets[0].id}/graph", params)
+            self.assertEqual(response.status_code, 400, params)
+
+    def test_not_found(self):
+        response = self.client.get("/dataset/999/graph")
+        self.assertEqual(response.status_code, 404)
+
+
+class PathViewTest(SerializerTestCase):
+    def get_path(self, **params):
+        params.setdefault("from", self.datasets[0].id)
+        params.setdefault("to", self.datasets[3].id)
+        return self.client.get("/path/", params)
+
+    def test_path(self):
+        response = self.get_path()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [dataset["id"] for dataset in response.json()["datasets"]],
+            [self.datasets[number].id for number in [0, 2, 3]],
+        )
+
+    def test_no_path(self):
+        self.assertEqual(self.get_path(max_depth=1).status_code, 404)
+
+    def test_bad_parameters(self):
+        for params in [{"max_depth": "six"}, {"max_depth": 99}, {"direction": "up"}]:
+            self.assertEqual(self.get_path(**params).status_code, 400, params)
+        self.assertEqual(self.client.get("/path/", {"from": 1}).status_code, 400)
+
+    def test_search_stopped(self):
+        with mock.patch(
+            "data_bridge_app.views.find_shortest_path",
+            side_effect=PathSearchLimitExceeded("Visited more than 1 datasets"),
+        ):
+            response = self.get_path()
+        self.assertEqual(response.status_code, 422)
+        self.assertIn(b"Visited more than 1 datasets", response.content)
+
+
+def fake_render_main(connection):
+    # stands in for the image engine in a render process, "sleep" takes longer than
+    # any test timeout and "fail" is an error, anything else is echoed back
+    result = ("ready", None)
+    while True:
+        try:
+            connection.send(result)
+            figure_json, format_ = connection.recv()
+        except (EOFError, OSError):
+            return
+        if figure_json == "sleep":
+            time.sleep(60)
+        if figure_json == "fail":
+            result = ("error", "The figure is not valid")
+        else:
+            result = ("ok", f"{format_}:{figure_json}".encode())
+
+
+class RenderPoolTestCase(SimpleTestCase):
+    def start_pool(self, workers=1, max_queue=1, timeout=60):
+        pool = RenderPool(workers, max_queue, timeout)
+        self.addCleanup(self.stop_pool, pool)
+        return pool
+
+    def stop_pool(self, pool):
+        while not pool._idle.empty():
+            process = pool._idle.get()
+            if process is not None:
+                process.stop()
+
+    def kill_worker(self, pool):
+        process = pool._idle.queue[0]
+        process.process.kill()
+        process.process.join()
+
+
+class RenderPoolTest(RenderPoolTestCase):
+    # the render processes are forked so that they run fake_render_main
+    def setUp(self):
+        for patcher in [
+            mock.patch("data_bridge_app.render_pool._render_main", fake_render_main),
+            mock.patch(
+                "data_bridge_app.render_pool.multiprocessing.get_context",
+                return_value=multiprocessing.get_context("fork"),
+            ),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def render_in_background(self, pool, figure_json):
+        # start a job in a thread, returning once it has a process
+        def render():
+            with contextlib.suppress(RenderError):
+                pool.render(figure_json, "png")
+
+        thread = threading.Thread(target=render)
+        thread.start()
+        self.addCleanup(thread.join)
+        while pool.metrics.busy == 0:
+            time.sleep(0.01)
+
+    def test_render(self):
+        pool = self.start_pool()
+        self.assertEqual(pool.render("figure", "png"), b"png:figure")
+        self.assertEqual(pool.render("figure", "svg"), b"svg:figure")
+        metrics = pool.metrics.as_dict()
+        self.assertEqual(metrics["jobs"], 2)
+        self.assertEqual(metrics["busy"], 0)
+        self.assertEqual(metrics["queue_depth"], 0)
+        self.assertEqual(metrics["restarts"], 0)
+
+    def test_error(self):
+        # the image fails, but the process is kept
+        pool = self.start_pool()
+        with self.assertRaisesMessage(RenderError, "The figure is not valid"):
+            pool.render("fail", "png")
+        self.assertEqual(pool.metrics.failures, 1)
+        self.assertEqual(pool.metrics.restarts, 0)
+        self.assertEqual(pool.render("figure", "png"), b"png:figure")
+
+    def test_timeout(self):
+        pool = self.start_pool(timeout=0.5)
+        pool.render("figure", "png")
+        stuck = pool._idle.queue[0]
+        with self.assertRaises(RenderTimeout):
+            pool.render("sleep", "png")
+        self.assertEqual(pool.metrics.timeouts, 1)
+        self.assertEqual(pool.metrics.restarts, 1)
+        # the stuck process is killed and replaced
+        self.assertFalse(stuck.process.is_alive())
+        self.assertEqual(pool.render("figure", "png"), b"png:figure")
+
+    def test_queue_full(self):
+        pool = self.start_pool(max_queue=0, timeout=0.5)
+        self.render_in_background(pool, "sleep")
+        with self.assertRaises(RenderQueueFull):
+            pool.render("figure", "png")
+        self.assertEqual(pool.metrics.rejected, 1)
+
+    def test_wait_timeout(self):
+        # the job waits for the only process, then gives up
+        pool = self.start_pool(timeout=0.5)
+        self.render_in_background(pool, "sleep")
+        with self.assertRaisesMessage(RenderTimeout, "No render process free"):
+            pool.render("figure", "png")
+        self.assertEqual(pool.metrics.max_queue_depth, 1)
+
+    def test_killed_worker(self):
+        pool = self.start_pool()
+        pool.render("figure", "png")
+        self.kill_worker(pool)
+
+        # the job on the dead process fails and the process is replaced
+        with self.assertRaises(RenderError):
+            pool.render("figure", "png")
+        self.assertEqual(pool.metrics.restarts, 1)
+        self.assertTrue(pool._idle.queue[0].process.is_alive())
+        self.assertEqual(pool.render("figure", "png"), b"png:figure")
+
+    def test_replacement_not_started(self):
+        pool = self.start_pool()
+        pool.render("figure", "png")
+        self.kill_worker(pool)
+
+        with mock.patch(
+            "data_bridge_app.render_pool._RenderProcess", side_effect=OSError
+        ):
+            with self.assertRaises(RenderError):
+                pool.render("figure", "png")
+            # the dead process is not put back
+            self.assertIsNone(pool._idle.queue[0])
+            with self.assertRaises(RenderError):
+                pool.render("figure", "png")
+
+        # the process is started by the next job
+        self.assertEqual(pool.render("figure", "png"), b"png:figure")
+
+    def test_metrics_view(self):
+        pool = self.start_pool()
+        pool.render("figure", "png")
+        with mock.patch("data_bridge_app.render_pool._pool", pool):
+            response = self.client.get("/metrics/render")
+        self.assertEqual(response.json()["jobs"], 1)
+
+        with mock.patch("data_bridge_app.render_pool._pool", None):
+            self.assertEqual(self.client.get("/metrics/render").status_code, 404)
+
+
+class KaleidoRenderPoolTest(RenderPoolTestCase):
+    def test_render(self):
+        pool = self.start_pool()
+        figure = '{"data": [{"type": "bar", "y": [1, 2]}], "layout": {}}'
+        self.assertTrue(pool.render(figure, "png").startswith(b"\x89PNG"))
+
+
+class GetRenderPoolTest(SimpleTestCase):
+    @mock.patch(
+        "data_bridge_app.render_pool.get_render_pool", side_effect=RenderError("No")
+    )
+    def test_start_fails(self, get_render_pool):
+        # a pool that cannot be started does not fail the request
+        with self.assertLogs("data_bridge_app.render_pool", "WARNING"):
+            render_pool.start_render_pool(sender=None)
+        get_render_pool.assert_called_once()
+
+    @mock.patch("data_bridge_app.render_pool.RenderPool")
+    def test_forked(self, pool_class):
+        # a pool inherited from a parent process is not used
+        parent_pool = mock.Mock(pid=-1)
+        with mock.patch("data_bridge_app.render_pool._pool", parent_pool):
+            self.assertIsNone(render_pool.get_render_metrics())
+            pool = render_pool.get_render_pool()
+            self.assertIs(pool, pool_class.return_value)
+            pool_class.assert_called_once()
+
+
+class SankeyTestCase(TestCase):
+    def setUp(self):
+        # the catalogue version is the same for every test, so nothing cached for
+        # one test may be used by another
+        caches["sankey"].clear()
+        cache._sankey_index = None
+        self.addCleanup(caches["sankey"].clear)
+
+        provider = Project.objects.create(name="CCI Open Data Portal", slug="cci")
+        relation_type = RelationType.objects.create(name="is derived from")
+        self.datasets = []
+        for number in range(3):
+            self.datasets.append(
+                Dataset.objects.create(
+                    url=f"https://example.com/{number}", dataset_provider=provider
+                )
+            )
+        for from_dataset, to_dataset in [self.datasets[:2], self.datasets[1:]]:
+            relationship = Relationship.objects.create(
+                from_dataset=from_dataset, to_dataset=to_dataset
+            )
+            relationship.relationships.add(relation_type)
+
+
+class SankeyDatasetViewTest(SankeyTestCase):
+    def test_index(self):
+        index = cache.get_sankey_index()
+        self.assertTrue(index.has_url("https://example.com/1"))
+        self.assertFalse(index.has_url("https://example.com/9"))
+        # the index is kept by the process
+        with self.assertNumQueries(1):
+            self.assertIs(cache.get_sankey_index(), index)
+
+    def test_dataset(self):
+        response = self.client.get("/sankey/https://example.com/1", {"format": "json"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertIn("data", json.loads(response.content))
+
+    def test_unknown_dataset(self):
+        response = self.client.get("/sankey/https://example.com/9", {"format": "json"})
+        self.assertEqual(response.status_code, 404)
+
+
+class SankeyViewTest(SankeyTestCase):
+    URLS = ["https://example.com/0", "https://example.com/2"]
+
+    def post(self, path="/sankey/", **kwargs):
+        return self.client.post(
+            path, json.dumps({"urls": self.URLS}), "application/json", **kwargs
+        )
+
+    def test_get(self):
+        response = self.client.get("/sankey/", {"urls": ",".join(self.URLS)})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/html"))
+
+    def test_get_json(self):
+        response = self.client.get("/sankey/", {"urls": self.URLS, "format": "json"})
+        self.assertEqual(response["Content-Type"], "application/json")
+
+    def test_post_json_body(self):
+        # the content type of the body does not choose the format of the response
+        response = self.post()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/html"))
+
+    def test_post_accept(self):
+        response = self.post(HTTP_ACCEPT="application/json")
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertIn("data", json.loads(response.content))
+
+    def test_post_format(self):
+        response = self.post("/sankey/?format=json", HTTP_ACCEPT="text/html")
+        self.assertEqual(response["Content-Type"], "application/json")
+
+    def test_post_form(self):
+        response = self.client.post(
+            "/sankey/", {"urls": self.URLS}, HTTP_ACCEPT="application/json"
+        )
+        self.assertEqual(response["Content-Type"], "application/json")
+
+    def test_unknown_url(self):
+        response = self.client.get(
+            "/sankey/", {"urls": "https://example.com/9", "format": "json"}
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_bad_json_body(self):
+        for body in ["{", json.dumps(self.URLS), json.dumps({"urls": "x"})]:
+            response = self.client.post("/sankey/", body, "application/json")
+            self.assertEqual(response.status_code, 400)
+
+    def test_no_urls(self):
+        response = self.client.get("/sankey/", {"urls": ",", "format": "json"})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post("/sankey/", {"urls": []}, "application/json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_too_many_urls(self):
+        with mock.patch("data_bridge_app.views.MAX_SANKEY_URLS", 1):
+            response = self.post("/sankey/?format=json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_filename(self):
+        response = self.client.get(
+            "/sankey/", {"urls": self.URLS, "format": "svg", "renderer": "native"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(
+            response["Content-Disposition"].startswith(
+                'attachment; filename="datasets-sankey.svg'
+            )
+        )
+
+
+class CachedSankeyTest(SankeyTestCase):
+    def get_sankey(self, diagram):
+        return cache.CachedSankey("dataset", "https://example.com/1", diagram)
+
+    def get_diagram(self):
+        diagram = mock.Mock()
+        diagram.get_figure.return_value = go.Figure(go.Sankey())
+        return diagram
+
+    def test_spec(self):
+        diagram = self.get_diagram()
+        spec = self.get_sankey(diagram).get_spec()
+        self.assertEqual(self.get_sankey(diagram).get_spec(), spec)
+        self.assertEqual(diagram.get_figure.call_count, 1)
+
+        # a new catalogue version is not served the old entry
+        CatalogueVersion.objects.create()
+        self.get_sankey(diagram).get_spec()
+        self.assertEqual(diagram.get_figure.call_count, 2)
+
+    @mock.patch("data_bridge_app.cache.render_image", return_value=b"image")
+    def test_image(self, render_image):
+        diagram = self.get_diagram()
+        for _ in range(2):
+            self.assertEqual(self.get_sankey(diagram).get_image("png"), b"image")
+        self.assertEqual(render_image.call_count, 1)
+        # each format is cached separately
+        self.get_sankey(diagram).get_image("svg")
+        self.assertEqual(render_image.call_count, 2)
+
+        CatalogueVersion.objects.create()
+        self.get_sankey(diagram).get_image("png")
+        self.assertEqual(render_image.call_count, 3)
+
+    def test_view(self):
+        def get_links():
+            response = self.client.get(
+                "/sankey/https://example.com/1", {"format": "json"}
+            )
+            return len(json.loads(response.content)["data"][0]["link"]["source"])
+
+        links = get_links()
+        relationship = Relationship.objects.create(
+            from_dataset=self.datasets[1], to_dataset=self.datasets[0]
+        )
+        relationship.relationships.add(RelationType.objects.get())
+        # the diagram is served from the cache until the catalogue version changes
+        self.assertEqual(get_links(), links)
+        CatalogueVersion.objects.create()
+        self.assertEqual(get_links(), links + 1)
+
+
+class SankeySpecTest(SankeyTestCase):
+    # a URL with the characters that could end the <script> element
+    URL = "https://example.com/a&b=</script><script>alert(1)</script>"
+
+    def setUp(self):
+        super().setUp()
+        dataset = Dataset.objects.create(
+            url=self.URL, dataset_provider=self.datasets[0].dataset_provider
+        )
+        relationship = Relationship.objects.create(
+            from_dataset=dataset, to_dataset=self.datasets[0]
+        )
+        relationship.relationships.add(RelationType.objects.get())
+        self.dataset = dataset
+
+    def get_spec(self):
+        response = self.client.get(
+            f"/sankey/{quote(self.URL, safe=':/')}", {"format": "json"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/json")
+        return json.loads(response.content)
+
+    def test_spec(self):
+        spec = self.get_spec()
+        self.assertEqual(set(spec), {"data", "layout"})
+        # plotly validates the figure against the same schema as plotly.js
+        figure = go.Figure(spec)
+        self.assertEqual(figure.data[0].type, "sankey")
+        self.assertIn(self.URL, figure.data[0].node.label)
+
+    def test_embedded_spec(self):
+        response = self.client.get(f"/dataset/{self.dataset.id}")
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        start = content.index('<script id="sankey-spec" type="application/json">')
+        start = content.index(">", start) + 1
+        embedded = content[start : content.index("</script>", start)]
+
+        # nothing in the spec can end the element, and it is the same JSON
+        for character in "<>&":
+            self.assertNotIn(character, embedded)
+        self.assertEqual(json.loads(embedded), self.get_spec())
+
+    def test_script_escapes(self):
+        # the escapes also cover JSON that plotly has not escaped itself
+        spec = {"layout": {"title": {"text": self.URL}}}
+        escaped = json.dumps(spec).translate(SCRIPT_ESCAPES)
+        for character in "<>&":
+            self.assertNotIn(character, escaped)
+        self.assertEqual(json.loads(escaped), spec)
+
+
+class SankeyImageTest(SankeyTestCase):
+    def get_spec(self):
+        response = self.client.get("/sankey/https://example.com/1", {"format": "json"})
+        return json.loads(response.content)
+
+    def test_native(self):
+        spec = self.get_spec()
+        self.assertTrue(
+            sankey_image.render_sankey_image(spec, "png").startswith(b"\x89PNG")
+        )
+        self.assertTrue(
+            sankey_image.render_sankey_image(spec, "jpeg").startswith(b"\xff\xd8")
+        )
+        self.assertIn(b"<svg", sankey_image.render_sankey_image(spec, "svg"))
+
+    def test_old_pillow(self):
+        # before Pillow 10.1 there is only a fixed size default font
+        # pylint: disable=import-outside-toplevel
+        from PIL import ImageFont
+
+        def load_default(*args):
+            if args:
+                raise TypeError("load_default() takes 0 positional arguments")
+            return ImageFont.load_default_imagefont()
+
+        old_image_font = mock.Mock(spec=["load_default"])
+        old_image_font.load_default.side_effect = load_default
+        with mock.patch("PIL.ImageFont", old_image_font):
+            image = sankey_image.render_sankey_image(self.get_spec(), "png")
+        self.assertTrue(image.startswith(b"\x89PNG"))
+
+
+RELATION_TYPES = [
+    ("is derived from", "The dataset is derived from the other"),
+    ("is a version of", "The dataset is a version of the other"),
+]
+
+# the columns of the "Mapping" sheet
+MAPPING = [
+    [
+        "https://example.com/1",
+        datetime.datetime(2000, 1, 1),
+        datetime.datetime(2010, 1, 1),
+        "version=1.0\nsensor=ATSR",
+        "CCI Open Data Portal",
+        "Ozone",
+        "is derived from",
+        None,
+        "https://example.com/c1",
+        "esacci.Ozone.drs0",
+        "C3S Climate Data Store",
+        "Ozone",
+        "The first",
+    ],
+    [
+        "https://example.com/2",
+        None,
+        None,
+        "-",
+        "CCI Archive on CEDA",
+        "Cloud",
+        "is a version of",
+        "is derived from\na/b",
+        "https://example.com/c1",
+        "esacci.Ozone.drs0",
+        "C3S Climate Data Store",
+        "Cloud",
+        None,
+    ],
+    [
+        "https://example.com/1",
+        None,
+        None,
+        "version=2.0",
+        "CCI Open Data Portal",
+        "Ozone\nCloud",
+        None,
+        None,
+        None,
+        None,
+        None,
+        None,
+        None,
+    ],
+]
+
+
+def write_workbook(directory, name, mapping=MAPPING, relation_types=RELATION_TYPES):
+    # a workbook with the layout of the mapping spreadsheet
+    w_book = Workbook()
+    w_sheet = w_book.active
+    w_sheet.title = "Relationship definitions"
+    w_sheet.append(["Relationship definitions"])
+    w_sheet.append([])
+    w_sheet.append(["Name", "Description"])
+    for relation_type in relation_types:
+        w_sheet.append(list(relation_type))
+    w_sheet = w_book.create_sheet("Mapping")
+    w_sheet.append(["Mapping"])
+    w_sheet.append(["ID 1", "Start date", "End date", "Filters"])
+    for row in mapping:
+        w_sheet.append(row)
+    path = os.path.join(directory, name)
+    w_book.save(path)
+    return path
+
+
+def read_workbook(path):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return read_catalogue(path)
+
+
+def dump_catalogue(using="default"):
+    # the catalogue in the database, without the ids
+    datasets = {}
+    for dataset in Dataset.objects.using(using).prefetch_related("ecvs", "filters"):
+        datasets[dataset.id] = (
+            dataset.url,
+            tuple(sorted(str(filter_) for filter_ in dataset.filters.all())),
+        )
+    relationships = []
+    for relationship in Relationship.objects.using(using).prefetch_related(
+        "relationships"
+    ):
+        relationships.append(
+            (
+                datasets[relationship.from_dataset_id],
+                datasets[relationship.to_dataset_id],
+                relationship.description,
+                tuple(sorted(str(type_) for type_ in relationship.relationships.all())),
+            )
+        )
+    return {
+        "relation_types": dict(
+            RelationType.objects.using(using).values_list("name", "description")
+        ),
+        "providers": sorted(
+            Project.objects.using(using).values_list("name", "slug", "aliases")
+        ),
+        "ecvs": sorted(ECV.objects.using(using).values_list("name", flat=True)),
+        "filters": sorted(
+            Filter.objects.using(using).values_list("name", "value", flat=False)
+        ),
+        "datasets": sorted(
+            (
+                datasets[dataset.id],
+                dataset.dataset_provider_id,
+                dataset.start_date,
+                dataset.end_date,
+                tuple(sorted(str(ecv) for ecv in dataset.ecvs.all())),
+                dataset.filter_signature,
+            )
+            for dataset in Dataset.objects.using(using).prefetch_related("ecvs")
+        ),
+        "relationships": sorted(relationships),
+    }
+
+
+def get_generated_mapping(rows):
+    # a larger mapping, with repeated and secondary only datasets, rows without a
+    # primary dataset and blank rows
+    mapping = list(MAPPING)
+    for number in range(rows):
+        if number % 10 == 9:
+            mapping.append([None] * 13)
+            continue
+        mapping.append(
+            [
+                None if number % 7 == 6 else f"https://example.com/g{number % 15}",
+                datetime.datetime(2000 + number % 20, 1, 1),
+                None if number % 3 else datetime.datetime(2020, 1, 1),
+                f"version={number % 4}\nsensor=S{number % 3}",
+                ["CCI Open Data Portal", "OSI SAF", "CM SAF"][number % 3],
+                ["Ozone", "Cloud", "Ozone\nCloud"][number % 3],
+                "is derived from" if number % 2 else None,
+                "is a version of" if number % 5 == 0 else None,
+                f"https://example.com/c{number % 4}" if number % 4 else None,
+                f"esacci.Ozone.drs{number % 2}",
+                "C3S Climate Data Store",
+                "Ozone",
+                f"Row {number}" if number % 2 else None,
+            ]
+        )
+    return mapping
+
+
+def read_baseline_workbook(path):
+    # the reader before the read only pass, the whole workbook is loaded and the
+    # cells are read by column
+    catalogue = ImportCatalogue()
+    w_book = load_workbook(filename=path)
+    w_sheet = w_book["Relationship definitions"]
+    for row in w_sheet.iter_rows(min_row=4, max_col=4, max_row=w_sheet.max_row):
+        if row[0].value is None:
+            continue
+        catalogue.add_relation_type(row[0].value, row[1].value or "")
+    for name, (slug, aliases) in import_spreadsheet.PROVIDERS.items():
+        catalogue.add_provider(name, slug, aliases)
+
+    w_sheet = w_book["Mapping"]
+    get_values = import_spreadsheet._get_optional_values
+    get_relationship_types = import_spreadsheet._get_relationship_types
+    for row in w_sheet.iter_rows(min_row=3, max_col=13, max_row=w_sheet.max_row):
+        ecvs_1 = get_values(row[import_spreadsheet.ECV_1].value)
+        ecvs_2 = get_values(row[import_spreadsheet.ECV_2].value)
+        filters_1 = get_values(row[import_spreadsheet.FILTER_1].value)
+        filters_2 = get_values(row[import_spreadsheet.FILTER_2].value, "drs=")
+        catalogue.add_ecvs(ecvs_1 + ecvs_2)
+        catalogue.add_filters(filters_1 + filters_2)
+
+        if row[import_spreadsheet.ID_1].value is None:
+            continue
+        catalogue.rows += 1
+        ds_1 = catalogue.add_dataset(
+            row[import_spreadsheet.ID_1].value,
+            row[import_spreadsheet.PROVIDER_1].value,
+            ecvs_1,
+            filters_1,
+            start_date=row[import_spreadsheet.START_DATE_1].value,
+            end_date=row[import_spreadsheet.END_DATE_1].value,
+        )
+        ds_1.primary = True
+
+        if row[import_spreadsheet.ID_2].value is None:
+            continue
+        ds_2 = catalogue.get_or_add_dataset(
+            row[import_spreadsheet.ID_2].value,
+            row[import_spreadsheet.PROVIDER_2].value,
+            ecvs_2,
+            filters_2,
+            start_date="2015-01-01",
+            end_date="2023-01-01",
+        )
+        description = row[import_spreadsheet.DESCRIPTION].value or ""
+        for from_dataset, to_dataset, column in [
+            (ds_1, ds_2, import_spreadsheet.RELATIONSHIP_1),
+            (ds_2, ds_1, import_spreadsheet.RELATIONSHIP_2),
+        ]:
+            relation_types = get_relationship_types(row[column].value)
+            if len(relation_types) > 0:
+                catalogue.add_relationship(
+                    from_dataset, to_dataset, relation_types, description
+                )
+    return catalogue
+
+
+class ImportTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+
+class ReadWorkbookTest(ImportTestCase):
+    def test_baseline(self):
+        path = write_workbook(
+            self.directory, "mapping.xlsx", get_generated_mapping(200)
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = read_baseline_workbook(path)
+        write_catalogue(expected)
+        expected_dump = dump_catalogue()
+
+        with mock.patch.object(
+            import_spreadsheet, "load_workbook", wraps=load_workbook
+        ) as patched:
+            catalogue = read_workbook(path)
+        # the workbook is streamed
+        self.assertTrue(patched.call_args.kwargs["read_only"])
+        self.assertEqual(catalogue.rows, expected.rows)
+        self.assertEqual(len(catalogue.datasets), len(expected.datasets))
+        write_catalogue(catalogue)
+        self.assertEqual(dump_catalogue(), expected_dump)
+
+
+def get_records(mapping, lists=False):
+    # the mapping as records, as in the CSV, JSON and NDJSON formats
+    records = [
+        {"relation_type": name, "description": description}
+        for name, description in RELATION_TYPES
+    ]
+    for row in mapping:
+        record = {}
+        for column, value in zip(import_spreadsheet.COLUMNS, row):
+            if isinstance(value, datetime.datetime):
+                value = value.isoformat()
+            elif lists and isinstance(value, str) and "\n" in value:
+                value = value.split("\n")
+            record[column] = value
+        records.append(record)
+    return records
+
+
+class ReadRecordsTest(ImportTestCase):
+    def setUp(self):
+        super().setUp()
+        self.mapping = get_generated_mapping(50)
+        write_catalogue(
+            read_workbook(write_workbook(self.directory, "mapping.xlsx", self.mapping))
+        )
+        self.expected = dump_catalogue()
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, "w", encoding="utf-8", newline="") as file_:
+            file_.write(content)
+        return path
+
+    def assert_catalogue(self, path):
+        write_catalogue(read_workbook(path))
+        self.assertEqual(dump_catalogue(), self.expected)
+
+    def test_csv(self):
+        content = io.StringIO()
+        writer = csv.DictWriter(content, import_spreadsheet.COLUMNS + ["relation_type"])
+        writer.writeheader()
+        writer.writerows(get_records(self.mapping))
+        self.assert_catalogue(self.write("mapping.csv", content.getvalue()))
+
+    def test_json(self):
+        content = json.dumps(get_records(self.mapping, lists=True))
+        self.assert_catalogue(self.write("mapping.json", content))
+
+    def test_ndjson(self):
+        lines = [json.dumps(record) for record in get_records(self.mapping)]
+        # blank lines are skipped
+        content = "\n\n".join(lines)
+        self.assert_catalogue(self.write("mapping.ndjson", content))
+
+    def test_malformed(self):
+        record = json.dumps({"id_1": "https://example.com/1", "filters_1": 1})
+        for name, content, message in [
+            ("bad.json", "[{", "The file is not valid JSON"),
+            ("object.json", '{"id_1": "x"}', "The JSON must be a list of records"),
+            ("list.json", '[["x"]]', "Record 1 is not an object"),
+            ("value.json", f"[{record}]", "Record 1: filters_1 must be text"),
+            ("bad.ndjson", '{"id_1": "x"}\n{', "Line 2 is not valid JSON"),
+        ]:
+            path = self.write(name, content)
+            with self.subTest(name=name):
+                with self.assertRaisesMessage(CommandError, message):
+                    read_workbook(path)
+        # the catalogue is unchanged
+        self.assertEqual(dump_catalogue(), self.expected)
+
+
+class WriteCatalogueTest(ImportTestCase):
+    def test_write(self):
+        catalogue = read_workbook(write_workbook(self.directory, "mapping.xlsx"))
+        version = write_catalogue(catalogue, source_hash="abc")
+
+        self.assertEqual(version.source_hash, "abc")
+        self.assertEqual(CatalogueVersion.objects.count(), 1)
+        self.assertEqual(
+            dict(RelationType.objects.values_list("name", "description")),
+            dict(RELATION_TYPES),
+        )
+        self.assertEqual(
+            sorted(ECV.objects.values_list("name", flat=True)), ["Cloud", "Ozone"]
+        )
+        self.assertEqual(
+            sorted(str(filter_) for filter_ in Filter.objects.all()),
+            ["drs=esacci.Ozone.drs0", "sensor=ATSR", "version=1.0", "version=2.0"],
+        )
+
+        datasets = {}
+        for dataset in Dataset.objects.all():
+            filters = sorted(str(filter_) for filter_ in dataset.filters.all())
+            datasets[(dataset.url, tuple(filters))] = dataset
+            # the signatures are calculated by the import, not the signals
+            self.assertEqual(
+                dataset.filter_signature, get_filter_signature(parse_filters(filters))
+            )
+        self.assertEqual(
+            sorted(datasets),
+            [
+                ("https://example.com/1", ("sensor=ATSR", "version=1.0")),
+                ("https://example.com/1", ("version=2.0",)),
+                ("https://example.com/2", ()),
+                ("https://example.com/c1", ("drs=esacci.Ozone.drs0",)),
+            ],
+        )
+
+        first = datasets[("https://example.com/1", ("sensor=ATSR", "version=1.0"))]
+        self.assertEqual(first.dataset_provider_id, "CCI Open Data Portal")
+        self.assertEqual(first.start_date, datetime.date(2000, 1, 1))
+        self.assertEqual(first.end_date, datetime.date(2010, 1, 1))
+        # the secondary dataset is shared by the first two rows
+        secondary = datasets[("https://example.com/c1", ("drs=esacci.Ozone.drs0",))]
+        self.assertEqual(
+            sorted(secondary.ecvs.values_list("name", flat=True)), ["Cloud", "Ozone"]
+        )
+
+        self.assertEqual(
+            dump_catalogue()["relationships"],
+            [
+                (
+                    ("https://example.com/1", ("sensor=ATSR", "version=1.0")),
+                    ("https://example.com/c1", ("drs=esacci.Ozone.drs0",)),
+                    "The first",
+                    ("is derived from",),
+                ),
+                (
+                    ("https://example.com/2", ()),
+                    ("https://example.com/c1", ("drs=esacci.Ozone.drs0",)),
+                    "",
+                    ("is a version of",),
+                ),
+                (
+                    ("https://example.com/c1", ("drs=esacci.Ozone.drs0",)),
+                    ("https://example.com/2", ()),
+                    "",
+                    ("is derived from",),
+                ),
+            ],
+        )
+
+    def test_replace(self):
+        path = write_workbook(self.directory, "mapping.xlsx")
+        write_catalogue(read_workbook(path))
+        expected = dump_catalogue()
+        write_catalogue(read_workbook(path))
+        self.assertEqual(dump_catalogue(), expected)
+        self.assertEqual(CatalogueVersion.objects.count(), 2)
+
+    def test_rollback(self):
+        write_catalogue(read_workbook(write_workbook(self.directory, "mapping.xlsx")))
+        expected = dump_catalogue()
+
+        # a failed import leaves the catalogue as it was
+        catalogue = read_workbook(write_workbook(self.directory, "other.xlsx"))
+        catalogue.datasets[-1].url = None
+        with self.assertRaises(IntegrityError):
+            write_catalogue(catalogue)
+        self.assertEqual(dump_catalogue(), expected)
+        self.assertEqual(CatalogueVersion.objects.count(), 1)
+
+
+def get_changed_mapping():
+    # MAPPING with a dataset, relationship, ECV and relation type changed, a row
+    # removed and a row added
+    mapping = [list(row) for row in MAPPING[:2]]
+    mapping[0][2] = datetime.datetime(2020, 1, 1)
+    mapping[0][12] = "The first, changed"
+    mapping[1][4] = "CCI Open Data Portal"
+    mapping[1][5] = "Cloud\nFire"
+    mapping[1][7] = None
+    mapping.append(
+        [
+            "https://example.com/3",
+            None,
+            None,
+            "version=3.0",
+            "CCI Open Data Portal",
+            "Fire",
+            "is a version of",
+            None,
+            "https://example.com/1",
+            "version=1.0\nsensor=ATSR",
+            "CCI Open Data Portal",
+            "Ozone",
+            None,
+        ]
+    )
+    return mapping
+
+
+class UpdateCatalogueTest(ImportTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path_a = write_workbook(self.directory, "a.xlsx")
+        relation_types = [
+            RELATION_TYPES[0],
+            ("is a version of", "Changed"),
+            ("is the same as", "The same"),
+        ]
+        self.path_b = write_workbook(
+            self.directory, "b.xlsx", get_changed_mapping(), relation_types
+        )
+
+    def assertUpdateMatchesWrite(self, path_from, path_to):
+        write_catalogue(read_workbook(path_from))
+        changes = update_catalogue(read_workbook(path_to))
+        self.assertTrue(changes)
+        self.assertEqual(changes.version.id, get_catalogue_version())
+        updated = dump_catalogue()
+
+        write_catalogue(read_workbook(path_to))
+        self.assertEqual(updated, dump_catalogue())
+
+    def test_update(self):
+        self.assertUpdateMatchesWrite(self.path_a, self.path_b)
+
+    def test_update_back(self):
+        self.assertUpdateMatchesWrite(self.path_b, self.path_a)
+
+    def test_no_changes(self):
+        write_catalogue(read_workbook(self.path_a))
+        update_catalogue(read_workbook(self.path_b), source_hash="b")
+        expected = dump_catalogue()
+        version = get_catalogue_version()
+
+        changes = update_catalogue(read_workbook(self.path_b), source_hash="b2")
+        self.assertFalse(changes)
+        self.assertIsNone(changes.version)
+        self.assertEqual(get_catalogue_version(), version)
+        self.assertEqual(get_catalogue_source_hash(), "b2")
+        self.assertEqual(dump_catalogue(), expected)
+        for line in changes.get_summary():
+            self.assertTrue(line.endswith(": 0 added, 0 updated, 0 deleted"), line)
+
+
+class MergeCatalogueTest(SimpleTestCase):
+    URL = "https://example.com/ozone"
+
+    def get_catalogue(self, *dates):
+        # a catalogue with a primary dataset with the same URL and filters for each
+        # start date, the last derived from another dataset
+        catalogue = ImportCatalogue()
+        for start_date in dates:
+            dataset = catalogue.add_dataset(
+                self.URL, "ESA", ["Ozone"], ["version=1.0"], start_date, "2020-01-01"
+            )
+            dataset.primary = True
+        other = catalogue.add_dataset(self.URL, "ESA", ["Ozone"], ["version=2.0"])
+        catalogue.add_relationship(dataset, other, ["is derived from"], "")
+        return catalogue
+
+    def assertMerged(
+        self, first, second, conflicts, start_dates=("2000-01-01", "2010-01-01")
+    ):
+        catalogue = ImportCatalogue()
+        self.assertEqual(catalogue.merge(first, "first"), [])
+        self.assertEqual(catalogue.merge(second, "second"), conflicts)
+        self.assertEqual(
+            sorted(
+                str(dataset.start_date)
+                for dataset in catalogue.datasets
+                if list(dataset.filters) == ["version=1.0"]
+            ),
+            list(start_dates),
+        )
+        for relationship in catalogue.relationships:
+            self.assertIn(relationship.from_dataset, catalogue.datasets)
+            self.assertIn(relationship.to_dataset, catalogue.datasets)
+        return catalogue
+
+    def test_merge_more(self):
+        # the second dataset of the later source is added, not merged
+        catalogue = self.assertMerged(
+            self.get_catalogue("2000-01-01"),
+            self.get_catalogue("2000-01-01", "2010-01-01"),
+            [],
+        )
+        self.assertEqual(len(catalogue.relationships), 2)
+
+    def test_merge_fewer(self):
+        catalogue = self.assertMerged(
+            self.get_catalogue("2000-01-01", "2010-01-01"),
+            self.get_catalogue("2000-01-01"),
+            [],
+        )
+        self.assertEqual(len(catalogue.relationships), 2)
+
+    def test_merge_conflict(self):
+        self.assertMerged(
+            self.get_catalogue("2010-01-01"),
+            self.get_catalogue("2000-01-01", "2010-01-01"),
+            [
+                f"{self.URL} [version=1.0]: the start date is '2000-01-01' in second, "
+                "but '2010-01-01' in first"
+            ],
+            ["2010-01-01", "2010-01-01"],
+        )
+
+
+class StagingTest(unittest.TestCase):
+    # staging needs an SQLite file, so the tests use their own database, outside
+    # of the test database that Django manages
+    ALIAS = "staging_test"
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_dict = dict(connections["default"].settings_dict)
+        settings_dict["NAME"] = os.path.join(directory.name, "db.sqlite3")
+        connections.settings[self.ALIAS] = settings_dict
+        self.addCleanup(self.remove_connections)
+        call_command("migrate", database=self.ALIAS, verbosity=0)
+
+        self.path_a = write_workbook(directory.name, "a.xlsx")
+        self.path_b = write_workbook(directory.name, "b.xlsx", get_changed_mapping())
+        write_catalogue(read_workbook(self.path_a), self.ALIAS)
+        self.live, self.staging, self.previous = get_database_paths(self.ALIAS)
+
+    def remove_connections(self):
+        for alias in [self.ALIAS, STAGING_ALIAS, PREVIOUS_ALIAS]:
+            if alias in connections.settings:
+                connections[alias].close()
+                del connections[alias]
+                del connections.settings[alias]
+
+    def test_switch(self):
+        expected_a = dump_catalogue(self.ALIAS)
+        using = create_staging_database(self.ALIAS)
+        self.assertTrue(os.path.exists(self.staging))
+        write_catalogue(read_workbook(self.path_b), using)
+        expected_b = dump_catalogue(using)
+
+        # the live database is unchanged until the switch
+        self.assertEqual(dump_catalogue(self.ALIAS), expected_a)
+        self.assertEqual(validate_database(using), [])
+        switch_database(self.ALIAS)
+
+        self.assertFalse(os.path.exists(self.staging))
+        self.assertTrue(os.path.exists(self.previous))
+        self.assertEqual(dump_catalogue(self.ALIAS), expected_b)
+        self.assertEqual(get_catalogue_version(self.ALIAS), 2)
+
+    def test_rollback(self):
+        expected_a = dump_catalogue(self.ALIAS)
+        using = create_staging_database(self.ALIAS)
+        write_catalogue(read_workbook(self.path_b), using)
+        switch_database(self.ALIAS)
+
+        version = rollback_database(self.ALIAS)
+        # a new version, after the version rolled back, so nothing cached is used
+        self.assertEqual(version.id, 3)
+        self.assertEqual(get_catalogue_version(self.ALIAS), 3)
+        self.assertEqual(dump_catalogue(self.ALIAS), expected_a)
+        self.assertFalse(os.path.exists(self.previous))
+
+        with self.assertRaises(StagingError):
+            rollback_database(self.ALIAS)
+
+    def test_validation_failure(self):
+        live_hash = get_file_hash(self.live)
+        using = create_staging_database(self.ALIAS)
+        Dataset.objects.using(using).all().delete()
+        self.assertEqual(validate_database(using), ["The catalogue is empty"])
+
+        discard_staging_database(self.ALIAS)
+        self.assertFalse(os.path.exists(self.staging))
+        self.assertEqual(get_file_hash(self.live), live_hash)
+
+    def test_wrong_signature(self):
+        using = create_staging_database(self.ALIAS)
+        Dataset.objects.using(using).update(filter_signature="")
+        problems = validate_database(using)
+        self.assertEqual(len(problems), 1)
+        self.assertIn("wrong filter signature", problems[0])
+        discard_staging_database(self.ALIAS)
+
+    def test_wal(self):
+        with connections[self.ALIAS].cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode=WAL")
+        with self.assertRaises(StagingError):
+            create_staging_database(self.ALIAS)
+        self.assertFalse(os.path.exists(self.staging))
+
+
+class FakeResponse:
+    # a streamed response from requests.get
+    def __init__(self, status_code, content=b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield self.content
+
+
+class FetchSourceTest(SimpleTestCase):
+    URL = "https://example.com/mapping.xlsx"
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache_dir = os.path.join(directory.name, "cache")
+
+    @mock.patch("requests.get")
+    def test_download_and_revalidate(self, get):
+        get.return_value = FakeResponse(200, b"one", {"ETag": '"1"'})
+        path, sha256 = fetch_source(self.URL, self.cache_dir)
+        self.assertEqual(get_file_hash(path), sha256)
+        self.assertTrue(path.endswith(".xlsx"))
+        self.assertEqual(os.stat(self.cache_dir).st_mode & 0o777, 0o700)
+
+        # not modified, the cached copy is used
+        get.return_value = FakeResponse(304)
+        self.assertEqual(fetch_source(self.URL, self.cache_dir), (path, sha256))
+        self.assertEqual(get.call_args.kwargs["headers"], {"If-None-Match": '"1"'})
+
+        # changed, the old copy is removed
+        get.return_value = FakeResponse(200, b"two", {"ETag": '"2"'})
+        new_path, new_sha256 = fetch_source(self.URL, self.cache_dir)
+        self.assertNotEqual(new_sha256, sha256)
+        self.assertFalse(os.path.exists(path))
+
+    @override_settings(IMPORT_CACHE_DIR=None)
+    def test_default_cache_dir(self):
+        # not in the shared temporary directory
+        self.assertEqual(
+            get_cache_dir(), os.path.join(settings.BASE_DIR, "import_cache")
+        )
+
+    @override_settings(IMPORT_SOURCE_URL=None)
+    def test_no_source(self):
+        with self.assertRaises(CommandError):
+            call_command("import_spreadsheet")
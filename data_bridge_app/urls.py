@@ -23,7 +23,11 @@ urlpatterns = [
     path("admin/", admin.site.urls),
     path("dataset/", views.DatasetListView.as_view(), name="dataset-list"),
     path("dataset/<int:pk>", views.DatasetDetailView.as_view(), name="dataset-detail"),
+    path(
+        "dataset/<int:pk>/graph", views.DatasetGraphView.as_view(), name="dataset-graph"
+    ),
     path("dataset/<path:url>", views.DatasetUrlDetailView.as_view()),
+    path("path/", views.PathView.as_view(), name="path"),
     path("project/", views.ProjectListView.as_view(), name="project-list"),
     path(
         "relationtype/", views.RelationTypeListView.as_view(), name="relation-type-list"
@@ -32,4 +36,8 @@ urlpatterns = [
     path("sankey/<slug:project>", views.SankeyProjectView.as_view(), name="sankey"),
     path("sankey/<path:url>", views.SankeyDatasetView.as_view(), name="sankey"),
     path("docs/api", views.DocsApiView.as_view(), name="docs-api"),
+    path(
+        "js/plotly-<str:version>.min.js", views.PlotlyJsView.as_view(), name="plotly-js"
+    ),
+    path("metrics/render", views.RenderMetricsView.as_view(), name="render-metrics"),
 ]
@@ -3,40 +3,100 @@ Views
 
 The "home" view redirects to "/dataset/" (DatasetListView) which lists all data sets
 
-The "DatasetListView" displays all datasets and allows filtering on url, filters,
-provider, ecv
+The "DatasetListView" displays all datasets, a page at a time, and allows filtering
+on url, filters, provider, ecv
 
 The "DatasetDetailView" displays a dataset based on an internal id
 
+The "DatasetGraphView" returns the datasets that can be reached from a dataset by
+following its relationships
+
+The "PathView" returns the shortest chain of relationships between two datasets
+
 The "DatasetUrlDetailView" gets data based on a dataset URL. If there is only one
 dataset for the url then display a detail view, otherwise display a list of datasets
 
+The Sankey diagrams are drawn in the browser by plotly.js, from the JSON spec of the
+figure embedded in the page, the same spec is returned by the Sankey views for
+'format=json'. plotly.js itself is served once, from a versioned URL that can be
+cached indefinitely, see "PlotlyJsView".
+
+The "SankeyView" draws a single Sankey diagram for a list of dataset URLs, given with
+GET or POST.
+
 """
 
-from django.db.models import Q
-from django.http import Http404, JsonResponse
+import json
+
+from django.conf import settings
+from django.core.exceptions import BadRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, F, Q
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.http.response import HttpResponse
 from django.shortcuts import redirect
+from django.urls import reverse
+from django.utils.decorators import method_decorator
+from django.utils.safestring import mark_safe
+from django.views.decorators.csrf import csrf_exempt
 from django.template.response import TemplateResponse
-from django.views.generic import TemplateView
-from django.views.generic.base import RedirectView
+from django.views.generic import TemplateView, View
 from django.views.generic.detail import DetailView
 from django.views.generic.list import ListView
-from plotly.offline import plot
-import plotly.graph_objects as go
-
-from data_bridge_app.models import Dataset, ECV, Project, Relationship, RelationType
-
-
-SANKEY_COLOUR_1 = "rgba(230, 159, 0, 1.0)"
-SANKEY_COLOUR_2 = "rgba(86, 180, 233, 1.0)"
-SANKEY_COLOUR_3 = "rgba(0, 158, 115, 1.0)"
-SANKEY_COLOUR_4 = "rgba(240, 228, 66, 1.0)"
-SANKEY_COLOUR_5 = "rgba(0, 114, 178 , 1.0)"
-SANKEY_COLOUR_6 = "rgba(213, 94, 0, 1.0)"
-SANKEY_COLOUR_7 = "rgba(204, 121, 167, 1.0)"
-SANKEY_COLOUR_8 = "rgba(0, 0, 0, 1.0)"
-SANKEY_FADE = "0.4"
+from plotly.offline import get_plotlyjs, get_plotlyjs_version
+
+from data_bridge_app.cache import (
+    CachedSankey,
+    get_project_sankey,
+    get_sankey_index,
+)
+from data_bridge_app.compiled import get_compiled_catalogue
+from data_bridge_app.graph import (
+    DEFAULT_GRAPH_DEPTH,
+    DEFAULT_PATH_DEPTH,
+    PathSearchLimitExceeded,
+    find_shortest_path,
+    get_subgraph,
+)
+from data_bridge_app.models import (
+    Dataset,
+    ECV,
+    Project,
+    Relationship,
+    RelationType,
+    EMPTY_FILTER_SIGNATURE,
+    get_filter_signature,
+    parse_filters,
+)
+from data_bridge_app.pagination import KeysetPaginator, get_page_size
+from data_bridge_app.render_pool import RenderError, get_render_metrics
+from data_bridge_app.sankey import SankeyDiagram
+from data_bridge_app.serializers import DatasetSerializer, iter_serialized_datasets
+from data_bridge_app.snapshot import get_catalogue_snapshot
+
+
+FILTERS_MATCH_MODES = ["exact", "all", "any", "subset"]
+
+# the Sankey formats other than html, by content type
+SANKEY_CONTENT_TYPES = {
+    "image/png": "png",
+    "image/svg": "svg",
+    "image/svg+xml": "svg",
+    "image/jpeg": "jpeg",
+    "application/json": "json",
+}
+
+# see data_bridge_app.sankey_image
+IMAGE_RENDERERS = ["plotly", "native"]
+
+# the maximum number of dataset URLs in a Sankey diagram, see SankeyView
+MAX_SANKEY_URLS = 500
+
+# escape the characters that could end the <script> element holding a Sankey spec
+SCRIPT_ESCAPES = {ord("<"): "\\u003C", ord(">"): "\\u003E", ord("&"): "\\u0026"}
+
+# the plotly.js bundle, read on first use
+_plotly_js = None
 
 # pylint: disable=C0330
 
@@ -56,7 +116,27 @@ class ImageResponseMixin:
         if format_ == "svg":
             filename = f"{filename}.+xml"
 
-        dataset = context.get("figure").to_image(format=format_)
+        renderer = self.request.GET.get("renderer") or getattr(
+            settings, "SANKEY_IMAGE_RENDERER", "plotly"
+        )
+        if renderer not in IMAGE_RENDERERS:
+            raise Http404(
+                f"Invalid renderer {renderer}, must be one of "
+                f"{', '.join(IMAGE_RENDERERS)}"
+            )
+
+        try:
+            dataset = context["sankey"].get_image(format_, renderer)
+        except RenderError as ex:
+            # the render pool is busy or the image failed, the client may retry later
+            response = HttpResponse(
+                f"The image could not be rendered: {ex}",
+                content_type="text/plain",
+                status=503,
+            )
+            response["Retry-After"] = "10"
+            return response
+
         response = HttpResponse(
             dataset,
             content_type=f"image/{format_}",
@@ -65,7 +145,25 @@ class ImageResponseMixin:
         return response
 
 
-class JSONResponseMixin:
+class SnapshotMixin:
+    """
+    A mixin that gives a view the catalogue snapshot, see data_bridge_app.snapshot.
+
+    """
+
+    def get_snapshot(self):
+        """
+        Returns the catalogue snapshot, or None if it is not enabled.
+
+        The same snapshot is used for the whole of a request.
+
+        """
+        if not hasattr(self, "snapshot"):
+            self.snapshot = get_catalogue_snapshot()
+        return self.snapshot
+
+
+class JSONResponseMixin(SnapshotMixin):
     """
     A mixin that can be used to render a JSON response.
 
@@ -78,80 +176,121 @@ class JSONResponseMixin:
         """
         if context.get("object") is not None:
             return JsonResponse(
-                self.get_j_data(context["object"], context["relationships"]),
+                DatasetSerializer(
+                    [context["object"]], self.include_inbound(), self.get_snapshot()
+                ).data()[0],
                 safe=False,
             )
 
-        data = []
-        for obj in context["object_list"]:
-            data.append(
-                self.get_j_data(obj, Relationship.objects.filter(from_dataset=obj))
-            )
-
         return JsonResponse(
-            data,
+            DatasetSerializer(
+                context["object_list"], self.include_inbound(), self.get_snapshot()
+            ).data(),
             safe=False,
         )
 
-    def get_j_data(self, dataset, relationships):
+    def include_inbound(self):
         """
-        Returns an object that will be serialized as JSON by json.dumps().
+        Returns True if the inbound relationships have been asked for with
+        "include=inbound".
 
         """
+        return "inbound" in self.request.GET.get("include", "").split(",")
 
-        data = {}
-        data["url"] = dataset.url
-        data["dataset_provider"] = dataset.dataset_provider_id
-
-        ecvs = []
-        for ecv in dataset.ecvs.values("name"):
-            ecvs.append(ecv["name"])
-        if len(ecvs) > 0:
-            data["ecvs"] = ecvs
-
-        filters = []
-        for filter_ in dataset.filters.all():
-            filters.append({filter_.name: filter_.value})
-        if len(filters) > 0:
-            data["filters"] = filters
-
-        combiened_relationships = {}
-        for rel in relationships:
-            # do we have an entry for this dataset id?
-            if rel.to_dataset.id in combiened_relationships.keys():
-                # add to existing data
-                combiened_relationships[rel.to_dataset.id]["relationship_types"].append(
-                    str(rel)
-                )
-            else:
-                # generate new relationship
-                relationship = {
-                    "relationship_types": [str(rel)],
-                    "related_dataset": str(rel.to_dataset),
-                }
+    def render_to_page_response(self, context, format_):
+        """
+        Returns a response for a single page of datasets, see
+        data_bridge_app.pagination.
 
-                if rel.to_dataset.start_date is not None:
-                    relationship[
-                        "related_dataset_start_date"
-                    ] = rel.to_dataset.start_date
+        For "json" the datasets are wrapped in an envelope that includes the
+        "next" and "prev" cursors. For both "json" and "ndjson" the links to the
+        next and previous pages are added as a "Link" header.
 
-                if rel.to_dataset.end_date is not None:
-                    relationship["related_dataset_end_date"] = rel.to_dataset.end_date
+        """
+        page = context["keyset_page"]
+        data = DatasetSerializer(
+            page.object_list, self.include_inbound(), self.get_snapshot()
+        ).data()
+
+        if format_ == "ndjson":
+            response = HttpResponse(
+                "".join(
+                    json.dumps(obj, cls=DjangoJSONEncoder) + "\n" for obj in data
+                ),
+                content_type="application/x-ndjson",
+            )
+        else:
+            response = JsonResponse(
+                {
+                    "next": page.next_cursor,
+                    "prev": page.prev_cursor,
+                    "results": data,
+                },
+                safe=False,
+            )
 
-                relationship[
-                    "related_dataset_provider"
-                ] = rel.to_dataset.dataset_provider.name
-                relationship["description"] = rel.description
-                combiened_relationships[rel.to_dataset.id] = relationship
+        _add_link_header(self.request, response, page)
+        return response
+
+    def render_to_stream_response(self, context, format_):
+        """
+        Returns a streaming response, serializing the datasets in "context" one at
+        a time.
 
-            filters = []
-            for filter_ in rel.to_dataset.filters.all():
-                filters.append({filter_.name: filter_.value})
-            if len(filters) > 0:
-                relationship["filters"] = filters
+        For "json" the content is the same as that of render_to_json_response, for
+        "ndjson" there is one JSON object per line.
 
-        data["relationships"] = list(combiened_relationships.values())
-        return data
+        """
+        if format_ == "ndjson":
+            return StreamingHttpResponse(
+                _ndjson_stream(
+                    context["object_list"], self.include_inbound(), self.get_snapshot()
+                ),
+                content_type="application/x-ndjson",
+            )
+
+        return StreamingHttpResponse(
+            _json_stream(
+                context["object_list"], self.include_inbound(), self.get_snapshot()
+            ),
+            content_type="application/json",
+        )
+
+
+def _json_stream(datasets, include_inbound, snapshot):
+    # the same separators as json.dumps so the output matches JsonResponse
+    separator = "["
+    for data in iter_serialized_datasets(datasets, include_inbound, snapshot):
+        yield separator + json.dumps(data, cls=DjangoJSONEncoder)
+        separator = ", "
+
+    if separator == "[":
+        yield "[]"
+    else:
+        yield "]"
+
+
+def _ndjson_stream(datasets, include_inbound, snapshot):
+    for data in iter_serialized_datasets(datasets, include_inbound, snapshot):
+        yield json.dumps(data, cls=DjangoJSONEncoder) + "\n"
+
+
+def _get_page_url(request, cursor):
+    if cursor is None:
+        return None
+    params = request.GET.copy()
+    params["cursor"] = cursor
+    return f"?{params.urlencode()}"
+
+
+def _add_link_header(request, response, page):
+    links = []
+    for rel, cursor in (("next", page.next_cursor), ("prev", page.prev_cursor)):
+        if cursor is not None:
+            url = request.build_absolute_uri(_get_page_url(request, cursor))
+            links.append(f'<{url}>; rel="{rel}"')
+    if len(links) > 0:
+        response["Link"] = ", ".join(links)
 
 
 class HomeView(TemplateView):
@@ -159,8 +298,18 @@ class HomeView(TemplateView):
 
 
 class DatasetListView(JSONResponseMixin, ListView):
+    """
+    List the datasets a page at a time, see data_bridge_app.pagination.
+
+    The HTML list is always paginated. The JSON and NDJSON lists are only paginated
+    if a "cursor" or "limit" is given, otherwise all of the datasets are streamed.
+
+    """
+
     model = Dataset
-    template_name = 'dataset_list.html'
+    template_name = "data_bridge_app/dataset_list.html"
+    # the page is a list rather than a queryset, so the name is not derived
+    context_object_name = "dataset_list"
 
     def render_to_response(self, context):
         # Look for a 'format=json' GET argument
@@ -168,31 +317,80 @@ class DatasetListView(JSONResponseMixin, ListView):
             self.request.GET.get("format") == "json"
             or self.request.content_type == "application/json"
         ):
-            return self.render_to_json_response(context)
+            if context["keyset_page"] is not None:
+                return self.render_to_page_response(context, "json")
+            return self.render_to_stream_response(context, "json")
+        # Look for a 'format=ndjson' GET argument
+        if (
+            self.request.GET.get("format") == "ndjson"
+            or self.request.content_type == "application/x-ndjson"
+        ):
+            if context["keyset_page"] is not None:
+                return self.render_to_page_response(context, "ndjson")
+            return self.render_to_stream_response(context, "ndjson")
 
-        if len(context["dataset_list"]) == 1:
+        page = context["keyset_page"]
+        if len(context["dataset_list"]) == 1 and not page.has_other_pages():
             id_ = context["dataset_list"][0].id
             return redirect("dataset-detail", pk=id_)
 
-        return super().render_to_response(context)
+        response = super().render_to_response(context)
+        _add_link_header(self.request, response, page)
+        return response
 
     def get_queryset(self):
         url = self.request.GET.get("url")
         filters = self.request.GET.get("filters")
         provider = self.request.GET.get("provider")
         ecv = self.request.GET.get("ecv")
+        filters_match = self.request.GET.get("filters_match") or "exact"
 
-        return get_queryset(url, filters, provider, ecv)
+        snapshot = self.get_snapshot()
+        try:
+            if snapshot is not None:
+                return snapshot.get_queryset(url, filters, provider, ecv, filters_match)
+            return get_queryset(url, filters, provider, ecv, filters_match)
+        except ValueError as ex:
+            # bad filters or filters_match are a client error
+            raise BadRequest(str(ex)) from ex
 
     def get_context_data(self, **kwargs):
+        page = None
+        if self._is_paginated():
+            try:
+                limit = get_page_size(self.request.GET.get("limit"))
+                page = KeysetPaginator(self.object_list, limit).page(
+                    self.request.GET.get("cursor")
+                )
+            except ValueError as ex:
+                # a bad cursor or limit is a client error
+                raise BadRequest(str(ex)) from ex
+            kwargs["object_list"] = page.object_list
+
         context = super().get_context_data(**kwargs)
-        context["ecvs"] = ECV.objects.all().order_by("name")
+        snapshot = self.get_snapshot()
+        if snapshot is not None:
+            context["ecvs"] = snapshot.ecv_names
+        else:
+            context["ecvs"] = ECV.objects.all().order_by("name")
+        context["keyset_page"] = page
+        if page is not None:
+            context["next_url"] = _get_page_url(self.request, page.next_cursor)
+            context["prev_url"] = _get_page_url(self.request, page.prev_cursor)
         return context
 
+    def _is_paginated(self):
+        if self.request.GET.get("format") in ["json", "ndjson"] or (
+            self.request.content_type in ["application/json", "application/x-ndjson"]
+        ):
+            return "cursor" in self.request.GET or "limit" in self.request.GET
+        return True
+
 
 class DatasetDetailView(JSONResponseMixin, DetailView):
     model = Dataset
     template = 'dataset_detail.html'
+    context_object_name = "dataset"
 
     def render_to_response(self, context):
         # Look for a 'format=json' GET argument
@@ -205,19 +403,125 @@ class DatasetDetailView(JSONResponseMixin, DetailView):
         # return html
         return super().render_to_response(context)
 
+    def get_object(self, queryset=None):
+        snapshot = self.get_snapshot()
+        if snapshot is None:
+            return super().get_object(queryset)
+
+        dataset = snapshot.datasets.get(self.kwargs["pk"])
+        if dataset is None:
+            raise Http404("Dataset not found")
+        return dataset
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        ds_id = self.kwargs["pk"]
-        dataset = Dataset.objects.get(id=ds_id)
-        context["relationships"] = Relationship.objects.filter(from_dataset=dataset)
+        dataset = self.object
+        context["relationships"] = _get_relationships(dataset, self.get_snapshot())
+        if self.include_inbound():
+            context["inbound_relationships"] = _get_inbound_relationships(
+                dataset, self.get_snapshot()
+            )
 
         title = f"Sankey Diagram for the {dataset.url} Dataset"
-        snakey_diagram = SankeyDiagram([dataset], title)
-        context["plot_div"] = snakey_diagram.plot_div()
+        snakey_diagram = SankeyDiagram([dataset], title, self.get_snapshot())
+        _add_sankey_context(
+            context,
+            CachedSankey(
+                "dataset", str(dataset.id), snakey_diagram, self.get_snapshot()
+            ),
+        )
 
         return context
 
 
+class DatasetGraphView(View):
+    """
+    Get the datasets that can be reached from a dataset by following up to "depth"
+    relationships, see data_bridge_app.graph.
+
+    """
+
+    def get(self, request, *args, **kwargs):
+        direction = request.GET.get("direction") or "out"
+        try:
+            depth = int(request.GET.get("depth") or DEFAULT_GRAPH_DEPTH)
+            graph = get_subgraph(self.kwargs["pk"], depth, direction)
+        except ValueError as ex:
+            # a bad depth or direction is a client error
+            raise BadRequest(str(ex)) from ex
+
+        if len(graph["nodes"]) == 0:
+            raise Http404("Dataset not found")
+
+        graph["root"] = self.kwargs["pk"]
+        graph["depth"] = depth
+        graph["direction"] = direction
+        return JsonResponse(graph, safe=False)
+
+
+class PathView(View):
+    """
+    Get the shortest chain of relationships between two datasets, see
+    data_bridge_app.graph.
+
+    The "from" and "to" datasets can be given as an id or a URL, a URL may match
+    more than one dataset.
+
+    If the search is stopped by its time or visit limit the response is a 422, as
+    there may be a path that was not found.
+
+    """
+
+    def get(self, request, *args, **kwargs):
+        from_ids = _get_dataset_ids(request.GET.get("from"))
+        to_ids = _get_dataset_ids(request.GET.get("to"))
+        direction = request.GET.get("direction") or "out"
+
+        try:
+            max_depth = int(request.GET.get("max_depth") or DEFAULT_PATH_DEPTH)
+            path = find_shortest_path(from_ids, to_ids, max_depth, direction)
+        except ValueError as ex:
+            # a bad max_depth or direction is a client error
+            raise BadRequest(str(ex)) from ex
+        except PathSearchLimitExceeded as ex:
+            # there may still be a path, the search was stopped before it was found,
+            # a smaller max_depth may help
+            return HttpResponse(
+                f"The search was stopped before a path was found: {ex}",
+                content_type="text/plain",
+                status=422,
+            )
+
+        if path is None:
+            raise Http404(f"No path found with up to {max_depth} relationships")
+
+        return JsonResponse(path, safe=False)
+
+
+def _get_dataset_ids(value):
+    # get the ids of the datasets for an id or a URL
+    if value is None or value == "":
+        raise BadRequest("Dataset not given")
+
+    compiled = get_compiled_catalogue()
+    if compiled is not None:
+        if value.isdigit():
+            indexes = [compiled.find_dataset(int(value))]
+        else:
+            indexes = compiled.find_url(_fix_url(value))
+        ids = [compiled.dataset_ids[index] for index in indexes if index is not None]
+    else:
+        if value.isdigit():
+            datasets = Dataset.objects.filter(id=int(value))
+        else:
+            datasets = Dataset.objects.filter(url=_fix_url(value))
+        ids = list(datasets.values_list("id", flat=True))
+
+    if len(ids) == 0:
+        raise Http404(f"Dataset not found {value}")
+    return ids
+
+
 class DatasetUrlDetailView(JSONResponseMixin, ListView):
     """
     When using a URL to select the datasets you may get multiple results.
@@ -228,7 +532,8 @@ class DatasetUrlDetailView(JSONResponseMixin, ListView):
     """
 
     model = Dataset
-    template_name = "dataset_list.html"
+    template_name = "data_bridge_app/dataset_list.html"
+    context_object_name = "dataset_list"
 
     def render_to_response(self, context):
         if len(context["dataset_list"]) == 0:
@@ -245,10 +550,19 @@ class DatasetUrlDetailView(JSONResponseMixin, ListView):
             # return html detail page
             dataset = context["object_list"][0]
             context["object"] = dataset
-            context["relationships"] = Relationship.objects.filter(from_dataset=dataset)
+            context["relationships"] = _get_relationships(dataset, self.get_snapshot())
+            if self.include_inbound():
+                context["inbound_relationships"] = _get_inbound_relationships(
+                    dataset, self.get_snapshot()
+                )
             title = f"Sankey Diagram for the {dataset.url} Dataset"
-            snakey_diagram = SankeyDiagram([dataset], title)
-            context["plot_div"] = snakey_diagram.plot_div()
+            snakey_diagram = SankeyDiagram([dataset], title, self.get_snapshot())
+            _add_sankey_context(
+                context,
+                CachedSankey(
+                    "dataset", str(dataset.id), snakey_diagram, self.get_snapshot()
+                ),
+            )
 
             return TemplateResponse(
                 self.request, "dataset_detail.html", context
@@ -258,16 +572,52 @@ class DatasetUrlDetailView(JSONResponseMixin, ListView):
 
     def get_queryset(self):
         url = _fix_url(self.kwargs["url"])
+        snapshot = self.get_snapshot()
+        if snapshot is not None:
+            return snapshot.for_url(url)
         return Dataset.objects.filter(url=url)
 
 
-def get_queryset(url=None, filters=None, provider=None, ecv=None):
+def _get_relationships(dataset, snapshot):
+    # the relationships from this dataset to other datasets
+    if snapshot is not None:
+        return dataset.relationship_set
+    return Relationship.objects.filter(from_dataset=dataset)
+
+
+def _get_inbound_relationships(dataset, snapshot):
+    # the relationships from other datasets to this one, loaded in bulk
+    if snapshot is not None:
+        return dataset.linked_dataset
+    return (
+        Relationship.objects.filter(to_dataset=dataset)
+        .select_related("from_dataset")
+        .prefetch_related("relationships", "from_dataset__filters")
+        .order_by("id")
+    )
+
+
+def get_queryset(url=None, filters=None, provider=None, ecv=None, filters_match="exact"):
+    """
+    Get the datasets that match the given parameters.
+
+    @param filters(str): a comma separated list of "name=value" filters
+
+    @param filters_match(str): how the filters are matched, one of
+        "exact": the dataset has exactly the given set of filters
+        "all": the dataset has all of the given filters, and may have others
+        "any": the dataset has at least one of the given filters
+        "subset": the dataset only has filters from the given set
+
+    @raises ValueError: if the filters or filters_match are not valid
+
+    """
     if url is not None and url != "":
         # get the datasets for the given url
         datasets = Dataset.objects.all().filter(url=url)
     else:
         # get all datasets
-        datasets = Dataset.objects.all().order_by("url")
+        datasets = Dataset.objects.all().order_by("url", "id")
 
     if provider is not None and provider != "":
         # get the datasets for the given provider
@@ -281,37 +631,43 @@ def get_queryset(url=None, filters=None, provider=None, ecv=None):
         # your job here is done
         return datasets
 
-    # now filter with the filters
-    filters = filters.split(",")
-    filter_count = len(filters)
+    filters = parse_filters(filters.split(","))
 
-    # first pass remove any results that do not have the same number of filters
-    datasets_to_exclude = []
-    for dataset in datasets:
-        if len(dataset.filters.all()) != filter_count:
-            datasets_to_exclude.append(dataset.id)
+    if filters_match == "exact":
+        # now filter with the filters, the set of filters must match exactly
+        signature = get_filter_signature(filters)
+        return datasets.filter(filter_signature=signature)
 
-    for exclude in datasets_to_exclude:
-        datasets = datasets.exclude(id=exclude)
+    if filters_match not in FILTERS_MATCH_MODES:
+        raise ValueError(f"Invalid filters_match {filters_match}")
 
-    # now need to make sure filters match
-    filter_dict = {}
-    for filter_ in filters:
-        name, value = filter_.split("=")
-        filter_dict[name] = value
+    # group the dataset filters by dataset, counting the ones in the given set
+    in_set = Q()
+    for name, value in filters:
+        in_set |= Q(filter__name=name, filter__value=value)
+    through = Dataset.filters.through.objects.values("dataset_id")
 
-    datasets_to_exclude = []
-    for dataset in datasets:
-        for dataset_filter in dataset.filters.all():
-            if filter_dict.get(dataset_filter.name) != dataset_filter.value:
-                datasets_to_exclude.append(dataset.id)
-                # no need to check the rest of the filters
-                break
+    if filters_match == "all":
+        # the datasets have every one of the filters, and maybe others
+        matching = (
+            through.filter(in_set)
+            .annotate(matched=Count("filter__id", distinct=True))
+            .filter(matched=len(set(filters)))
+        )
+        return datasets.filter(id__in=matching.values("dataset_id"))
 
-    for exclude in datasets_to_exclude:
-        datasets = datasets.exclude(id=exclude)
+    if filters_match == "any":
+        # the datasets have at least one of the filters
+        return datasets.filter(id__in=through.filter(in_set))
 
-    return datasets
+    # the datasets only have filters from the set, including datasets with none
+    matching = through.annotate(
+        total=Count("filter__id"), matched=Count("filter__id", filter=in_set)
+    ).filter(total=F("matched"))
+    return datasets.filter(
+        Q(id__in=matching.values("dataset_id"))
+        | Q(filter_signature=EMPTY_FILTER_SIGNATURE)
+    )
 
 
 class DocsApiView(TemplateView):
@@ -354,429 +710,234 @@ class RelationTypeListView(ListView):
         return super().render_to_response(context)
 
 
-class SankeyView(RedirectView):
-    url = "/sankey/cci"
-    template_name = "sankey.html"
-
-
-class SankeyProjectView(ImageResponseMixin, TemplateView):
-    template_name = "sankey.html"
-
-    def render_to_response(self, context):
-        # Look for a 'format=png' GET argument
-        if (
-            self.request.GET.get("format") == "png"
-            or self.request.content_type == "image/png"
-        ):
-            filename = f"{context.get('project')}-sankey"
-            return self.render_to_image_response(context, filename, "png")
-        # Look for a 'format=svg' GET argument
-        if (
-            self.request.GET.get("format") == "svg"
-            or self.request.content_type == "image/svg+xml"
-        ):
-            filename = f"{context.get('project')}-sankey"
-            return self.render_to_image_response(context, filename, "svg")
-        # Look for a 'format=jpeg' GET argument
-        if (
-            self.request.GET.get("format") == "jpeg"
-            or self.request.content_type == "image/jpeg"
-        ):
-            filename = f"{context.get('project')}-sankey"
-            return self.render_to_image_response(context, filename, "jpeg")
-
-        # return html
-        context["plot_div"] = plot(context["figure"], output_type="div")
-        context["figure"] = None
-        return super().render_to_response(context)
-
-    def get_context_data(self, *args, **kwargs):
-        context = super(SankeyProjectView, self).get_context_data(*args, **kwargs)
+class RenderMetricsView(View):
+    """
+    Get the metrics for the pool of processes that render the Sankey images, see
+    data_bridge_app.render_pool.
 
-        project = self.kwargs["project"]
-        if project.lower() == "cci":
-            datasets = Dataset.objects.filter(
-                Q(dataset_provider="CCI Open Data Portal")
-                | Q(dataset_provider="CCI Archive on CEDA")
-            )
-            project = "CCI"
-        elif project.lower() == "c3s":
-            datasets = Dataset.objects.filter(dataset_provider="C3S Climate Data Store")
-            project = "C3S"
-        elif project.lower() == "cm":
-            datasets = Dataset.objects.filter(dataset_provider="CM SAF")
-            project = "CM"
-        elif project.lower() == "osi":
-            datasets = Dataset.objects.filter(dataset_provider="OSI SAF")
-            project = "OSI"
-        else:
-            # could be an ecv
-            datasets = Dataset.objects.filter(ecvs=project)
+    """
 
-        if len(datasets.all()) == 0:
-            raise Http404(f"Project not found - Database empty")
+    def get(self, request, *args, **kwargs):
+        metrics = get_render_metrics()
+        if metrics is None:
+            raise Http404("The render pool has not been started")
+        return JsonResponse(metrics)
 
-        title = f"Sankey Diagram for {project} Datasets"
-        snakey_diagram = SankeyDiagram(datasets, title)
-        context["figure"] = snakey_diagram.get_figure()
-        context["project"] = project
 
-        context["dataset_list"] = (
-            Dataset.objects.values("url").order_by("url").distinct()
-        )
+class SankeyResponseMixin(SnapshotMixin, ImageResponseMixin):
+    """
+    A mixin for the Sankey views, which renders the Sankey diagram in
+    context["sankey"] as an image, as the JSON spec of the figure or as HTML.
 
-        return context
+    The image files are named after "sankey_filename", unless a view overrides
+    "get_sankey_filename".
 
+    """
 
-class SankeyDatasetView(ImageResponseMixin, TemplateView):
-    template_name = "sankey.html"
+    sankey_filename = "datasets"
 
     def render_to_response(self, context):
-        # Look for a 'format=png' GET argument
-        if (
-            self.request.GET.get("format") == "png"
-            or self.request.content_type == "image/png"
-        ):
-            filename = f"{context.get('dataset_url')}-sankey"
-            return self.render_to_image_response(context, filename, "png")
-        # Look for a 'format=svg' GET argument
-        if (
-            self.request.GET.get("format") == "svg"
-            or self.request.content_type == "image/svg"
-        ):
-            filename = f"{context.get('dataset_url')}-sankey"
-            return self.render_to_image_response(context, filename, "svg")
-        # Look for a 'format=jpeg' GET argument
-        if (
-            self.request.GET.get("format") == "jpeg"
-            or self.request.content_type == "image/jpeg"
-        ):
-            filename = f"{context.get('dataset_url')}-sankey"
-            return self.render_to_image_response(context, filename, "jpeg")
+        filename = f"{self.get_sankey_filename(context)}-sankey"
+        format_ = _get_sankey_format(self.request)
+        if format_ in ["png", "svg", "jpeg"]:
+            return self.render_to_image_response(context, filename, format_)
+        if format_ == "json":
+            return HttpResponse(
+                context["sankey"].get_spec(), content_type="application/json"
+            )
 
         # return html
-        context["plot_div"] = plot(context["figure"], output_type="div")
-        context["figure"] = None
+        _add_sankey_context(context, context["sankey"])
         return super().render_to_response(context)
 
-    def get_context_data(self, *args, **kwargs):
-        context = super(SankeyDatasetView, self).get_context_data(*args, **kwargs)
-
-        dataset_url = _fix_url(self.kwargs["url"])
-        datasets = Dataset.objects.filter(url=dataset_url)
-        if len(datasets.all()) == 0:
-            raise Http404(f"Dataset not found")
+    def get_sankey_filename(self, context):
+        """
+        Get the name of the image files, without the extension.
 
-        title = f"Sankey Diagram for the {dataset_url} Dataset"
-        snakey_diagram = SankeyDiagram(datasets, title)
-        context["figure"] = snakey_diagram.get_figure()
-        context["dataset_url"] = dataset_url
+        """
+        return self.sankey_filename
 
-        context["dataset_list"] = (
-            Dataset.objects.values("url").order_by("url").distinct()
-        )
 
-        return context
+@method_decorator(csrf_exempt, name="dispatch")
+class SankeyView(SankeyResponseMixin, TemplateView):
+    """
+    Without "urls" redirect to the Sankey diagram for CCI.
 
+    With "urls", GET or POST, show a single Sankey diagram for the datasets with any
+    of the URLs. The URLs may be given as several "urls" parameters, or separated by
+    commas, or POSTed as JSON, {"urls": [...]}.
 
-class SankeyDiagram:
     """
-    Produce a Sankey diagram.
 
-    """
+    template_name = "sankey.html"
 
-    def __init__(self, datasets, title):
-        self.datasets = datasets
-        self.title = title
-        self.dataset_url = None
-        self.filters = {}
-        self.last_id = -1
-        # nodes can be datasets or filters
-        self.nodes = {}
-        self.node_names = {}
-        self.duplicates = {}
-        self.links = {}
-        self.node_colours = {}
-        self.link_colours = []
-        self.link_names = []
-
-    def get_figure(self):
-        """
-        Generate a figure containing the Sankey diagram.
+    def get(self, request, *args, **kwargs):
+        if "urls" not in request.GET:
+            return redirect("/sankey/cci")
+        return super().get(request, *args, **kwargs)
 
-        """
-        source, target, value = self._get_filter_links()
+    def post(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
 
-        if source is None:
-            return None
+    def get_context_data(self, *args, **kwargs):
+        context = super(SankeyView, self).get_context_data(*args, **kwargs)
+
+        snapshot = self.get_snapshot()
+        sankey_index = get_sankey_index(snapshot)
+        urls = _get_sankey_urls(self.request)
+        # a 404 is only for URLs that are not in the catalogue
+        if len(urls) == 0:
+            raise BadRequest("No dataset URLs given")
+        if len(urls) > MAX_SANKEY_URLS:
+            raise BadRequest(f"Too many dataset URLs, the maximum is {MAX_SANKEY_URLS}")
+        missing = [url for url in urls if not sankey_index.has_url(url)]
+        if len(missing) > 0:
+            raise Http404(f"Dataset not found: {', '.join(missing[:10])}")
+
+        if snapshot is not None:
+            datasets = [dataset for url in urls for dataset in snapshot.for_url(url)]
+        else:
+            datasets = Dataset.objects.filter(url__in=urls).order_by("url", "id")
 
-        return self._plot(source, target, value)
+        if len(urls) == 1:
+            title = f"Sankey Diagram for the {urls[0]} Dataset"
+        else:
+            title = f"Sankey Diagram for {len(urls)} Dataset URLs"
+        snakey_diagram = SankeyDiagram(datasets, title, snapshot)
+        context["sankey"] = CachedSankey(
+            "urls", "\n".join(urls), snakey_diagram, snapshot, sankey_index.version
+        )
+        context["sankey_index"] = sankey_index
 
-    def plot_div(self):
-        """
-        Generate a div containing the Sankey diagram.
+        return context
 
-        """
-        source, target, value = self._get_filter_links()
 
-        if source is None:
-            return None
+class SankeyProjectView(SankeyResponseMixin, TemplateView):
+    template_name = "sankey.html"
 
-        fig = self._plot(source, target, value)
+    def get_context_data(self, *args, **kwargs):
+        context = super(SankeyProjectView, self).get_context_data(*args, **kwargs)
 
-        # Getting HTML needed to render the plot.
-        return plot(fig, output_type="div")
+        snapshot = self.get_snapshot()
+        sankey_index = get_sankey_index(snapshot)
+        project = sankey_index.get(self.kwargs["project"])
+        if project is None:
+            raise Http404(f"Project not found")
 
-    def _get_filter_links(self):
-        source = []
-        target = []
-        value = []
+        # a group of datasets, from the drill down URL of a simplified diagram
+        provider = self.request.GET.get("provider")
+        ecv = self.request.GET.get("ecv")
+        if provider or ecv:
+            datasets = project.get_datasets(snapshot, provider, ecv)
+            if len(datasets[:1]) == 0:
+                raise Http404("No datasets found for the provider and ECV")
 
-        for dataset in self.datasets:
-            # loop round all of the dataset(s)
-            # this could be all datasets for a URL, all CS3 datasets or all CCI datasets
+        context["sankey"] = get_project_sankey(
+            sankey_index, project, snapshot, provider, ecv
+        )
+        context["project"] = project.label
+        context["sankey_index"] = sankey_index
 
-            for relationship in dataset.relationship_set.all():
-                # now loop round all of the relationships for this dataset
-                source_index = self._get_index(
-                    dataset.url, f"Dataset: {dataset}", SANKEY_COLOUR_1
-                )
-                last_colour = SANKEY_COLOUR_1.replace("1.0", SANKEY_FADE)
-
-                if len(dataset.filters.all()) == 0:
-                    # No filters on the prime datasets
-                    related_ds = relationship.to_dataset
-                    if len(related_ds.filters.all()) > 0:
-                        filter_index = self._add_filters(
-                            related_ds,
-                            source_index,
-                            source,
-                            target,
-                            value,
-                            last_colour,
-                            relationship,
-                        )
-                    else:
-                        filter_index = source_index
-
-                    target_index = self._get_index(
-                        related_ds.url, f"Dataset: {related_ds}", SANKEY_COLOUR_1
-                    )
-                    source.append(filter_index)
-                    target.append(target_index)
-                    value.append(1)
-                    self.link_colours.append(last_colour)
-                    self.link_names.append(str(relationship))
-
-                else:
-                    # Filters on the prime datasets
-                    primary_filter_index = self._add_filters(
-                        dataset,
-                        source_index,
-                        source,
-                        target,
-                        value,
-                        last_colour,
-                        relationship,
-                    )
-
-                    related_ds = relationship.to_dataset
-
-                    if len(related_ds.filters.all()) > 0:
-                        filter_index = self._add_filters(
-                            related_ds,
-                            primary_filter_index,
-                            source,
-                            target,
-                            value,
-                            last_colour,
-                            relationship,
-                        )
-                    else:
-                        filter_index = primary_filter_index
-
-                    target_index = self._get_index(
-                        related_ds.url, f"Dataset: {related_ds}"
-                    )
-                    source.append(filter_index)
-                    target.append(target_index)
-                    value.append(1)
-                    self.link_colours.append(last_colour)
-                    self.link_names.append(str(relationship))
-
-        return source, target, value
-
-    def _add_filters(
-        self, dataset, source_index, source, target, value, last_colour, relationship
-    ):
-        # we need to include the filters in the diagram
-        # filter_indecies = []
-        first_index = source_index
-
-        # get the filters for the dataset
-        filters = list(dataset.filters.all())
-        filters.sort(key=_filter_sorter)
-
-        for filter_ in filters:
-            if filter_.name in [
-                "processinglevel",
-                "processing_level",
-                "origin",
-            ]:
-                colour = SANKEY_COLOUR_2
-            elif filter_.name == "version":
-                colour = SANKEY_COLOUR_3
-            elif filter_.name.startswith("sensor"):
-                colour = SANKEY_COLOUR_4
-            elif filter_.name == "variable":
-                colour = SANKEY_COLOUR_5
-            elif filter_.name.startswith("algorithm") or filter_.name.startswith(
-                "projection"
-            ):
-                colour = SANKEY_COLOUR_6
-            else:
-                colour = SANKEY_COLOUR_7
-
-            filter_index = self._get_index(
-                str(filter_),
-                f"Dataset filter: {filter_}",
-                colour,
-                first_index,
-            )
-            # filter_indecies.append(filter_index)
+        return context
 
-            source.append(first_index)
-            target.append(filter_index)
-            value.append(1)
+    def get_sankey_filename(self, context):
+        return context["project"]
 
-            self.link_colours.append(last_colour)
-            last_colour = colour.replace("1.0", SANKEY_FADE)
-            self.link_names.append(str(relationship))
-            first_index = filter_index
 
-        return first_index
+class SankeyDatasetView(SankeyResponseMixin, TemplateView):
+    template_name = "sankey.html"
 
-    # , source, target, value, last_colour
+    def get_context_data(self, *args, **kwargs):
+        context = super(SankeyDatasetView, self).get_context_data(*args, **kwargs)
 
-    def _get_index(self, value, node_name, colour=None, source_entity=None):
-        """
-        Get the index for a given value.
+        snapshot = self.get_snapshot()
+        sankey_index = get_sankey_index(snapshot)
+        dataset_url = _fix_url(self.kwargs["url"])
+        if not sankey_index.has_url(dataset_url):
+            raise Http404(f"Dataset not found")
+        if snapshot is not None:
+            datasets = snapshot.for_url(dataset_url)
+        else:
+            datasets = Dataset.objects.filter(url=dataset_url)
 
-        If this is a new value then store some information about this value,
-        otherwise store information about the link.
+        title = f"Sankey Diagram for the {dataset_url} Dataset"
+        snakey_diagram = SankeyDiagram(datasets, title, snapshot)
+        context["sankey"] = CachedSankey(
+            "dataset_url", dataset_url, snakey_diagram, snapshot, sankey_index.version
+        )
+        context["dataset_url"] = dataset_url
+        context["sankey_index"] = sankey_index
 
-        @param value(str): this may be a dataset URL or filter name
+        return context
 
-        @param source_entity(str): the id of the starting entity for a link
+    def get_sankey_filename(self, context):
+        return context["dataset_url"]
 
-        """
-        # do we already have a node for this value?
-        id_ = self.nodes.get(value)
 
-        if id_ is not None:
-            return id_
+class PlotlyJsView(View):
+    """
+    Serve the plotly.js bundle that comes with plotly, for the Sankey diagrams.
 
-        if source_entity is not None:
-            id_ = self.links.get(f"{source_entity}-{value}")
-            if id_ is not None:
-                return id_
+    The URL includes the plotly.js version, so the response can be cached by the
+    browser indefinitely.
 
-        self.last_id += 1
-        self.node_names[self.last_id] = node_name
+    """
 
-        if source_entity is not None:
-            self.duplicates[self.last_id] = value
-            self.links[f"{source_entity}-{value}"] = self.last_id
+    def get(self, request, *args, **kwargs):
+        global _plotly_js  # pylint: disable=global-statement
 
-        else:
-            self.nodes[value] = self.last_id
+        if self.kwargs["version"] != get_plotlyjs_version():
+            raise Http404("plotly.js version not found")
 
-        if colour is not None:
-            self.node_colours[self.last_id] = colour
-        else:
-            self.node_colours[self.last_id] = SANKEY_COLOUR_7
-
-        return self.last_id
-
-    def _plot(self, source, target, value):
-        ivd = {v: k for k, v in self.nodes.items()}
-        ivd.update(self.duplicates)
-        keys = sorted(ivd.keys())
-        labels = []
-        colours = []
-        node_names = []
-        for key in keys:
-            labels.append(ivd[key])
-            colours.append(self.node_colours[key])
-            node_names.append(self.node_names[key])
-
-        fig = go.Figure(
-            data=[
-                go.Sankey(
-                    node=dict(
-                        pad=15,
-                        thickness=20,
-                        line=dict(color="black", width=0.5),
-                        label=labels,
-                        color=colours,
-                        customdata=node_names,
-                        hovertemplate="%{customdata}<extra></extra>",
-                    ),
-                    link=dict(
-                        source=source,
-                        target=target,
-                        value=value,
-                        color=self.link_colours,
-                        customdata=self.link_names,
-                        hovertemplate="%{customdata}<extra></extra>",
-                    ),
-                )
-            ]
-        )
+        if _plotly_js is None:
+            _plotly_js = get_plotlyjs().encode("utf-8")
+        response = HttpResponse(_plotly_js, content_type="text/javascript")
+        response["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
 
-        font_size = 11
-        if len(source) < 10:
-            height = 300
-        elif len(source) < 20:
-            height = 400
-        elif len(source) < 40:
-            height = 600
-        elif len(source) < 80:
-            height = 800
-        elif len(source) < 120:
-            font_size = 10
-            height = 1500
-        elif len(source) < 200:
-            font_size = 10
-            height = 2000
-        else:
-            font_size = 10
-            height = 3000
 
-        fig.update_layout(
-            title_text=self.title,
-            font_size=font_size,
-            height=height,
-        )
-        return fig
-
-
-def _filter_sorter(filter_):
-    if filter_.name == "origin":
-        return 1
-    if filter_.name in ["processinglevel", "processing_level"]:
-        return 2
-    if filter_.name == "version":
-        return 3
-    if filter_.name.startswith("sensor"):
-        return 4
-    if filter_.name == "variable":
-        return 5
-    if filter_.name.startswith("algorithm"):
-        return 6
-    if filter_.name.startswith("projection"):
-        return 7
-    return 8
+def _add_sankey_context(context, sankey):
+    # the spec and plotly.js, for sankey_plot.html
+    context["sankey_spec"] = mark_safe(sankey.get_spec().translate(SCRIPT_ESCAPES))
+    context["plotly_js_url"] = getattr(settings, "PLOTLY_JS_URL", None) or reverse(
+        "plotly-js", args=[get_plotlyjs_version()]
+    )
+
+
+def _get_sankey_format(request):
+    # the format from a 'format' GET argument, otherwise from the content type of a
+    # GET request or the Accept header of a POST, whose content type is that of the
+    # body rather than the response
+    format_ = request.GET.get("format")
+    if format_ in SANKEY_CONTENT_TYPES.values():
+        return format_
+    if request.method != "POST":
+        return SANKEY_CONTENT_TYPES.get(request.content_type, "html")
+    content_type = request.get_preferred_type(["text/html", *SANKEY_CONTENT_TYPES])
+    return SANKEY_CONTENT_TYPES.get(str(content_type), "html")
+
+
+def _get_sankey_urls(request):
+    # the sorted, distinct URLs for SankeyView
+    if request.method == "POST" and request.content_type == "application/json":
+        try:
+            values = json.loads(request.body)["urls"]
+        except (ValueError, KeyError, TypeError) as ex:
+            raise BadRequest('The JSON must be an object, {"urls": [...]}') from ex
+        if not isinstance(values, list):
+            raise BadRequest('The JSON must be an object, {"urls": [...]}')
+    elif request.method == "POST":
+        values = request.POST.getlist("urls")
+    else:
+        values = request.GET.getlist("urls")
+
+    urls = set()
+    for value in values:
+        for url in str(value).split(","):
+            url = url.strip()
+            if url:
+                urls.add(_fix_url(url))
+    return sorted(urls)
 
 
 def _fix_url(url):
@@ -0,0 +1,20 @@
+// Draw the Sankey diagrams from the figure specs in the page, see sankey_plot.html
+document.querySelectorAll("[data-sankey-spec]").forEach(function (plot) {
+    var spec = JSON.parse(
+        document.getElementById(plot.dataset.sankeySpec).textContent
+    );
+    Plotly.newPlot(plot, spec.data, spec.layout, { responsive: true });
+
+    // a simplified diagram has a drill down URL for each group of datasets
+    var drillDown = (spec.layout.meta || {}).drill_down;
+    if (drillDown) {
+        plot.on("plotly_click", function (data) {
+            var point = data.points[0];
+            // only nodes have source links
+            var url = "sourceLinks" in point ? drillDown[point.pointNumber] : null;
+            if (url) {
+                window.location.href = url;
+            }
+        });
+    }
+});